@@ -0,0 +1,348 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range, str, bytes
+
+import re
+import nibabel as nb
+import numpy as np
+
+
+# -------------------------------------------------------------------------
+# .xmat.1D design matrices
+# -------------------------------------------------------------------------
+
+def _expand_groups(value):
+    """Expand an AFNI ColumnGroups string such as '-1*3,1,2*2'."""
+    groups = []
+    for token in value.split(','):
+        token = token.strip()
+        if not token:
+            continue
+        if '*' in token:
+            val, count = token.split('*')
+            groups += [int(val)] * int(count)
+        else:
+            groups.append(int(token))
+    return groups
+
+
+def _compress_groups(groups):
+    out = []
+    for g in groups:
+        if out and out[-1][0] == g:
+            out[-1][1] += 1
+        else:
+            out.append([g, 1])
+    return ','.join('%d*%d' % (g, n) if n > 1 else '%d' % g for g, n in out)
+
+
+def read_xmat(fname):
+    """Read an AFNI .xmat.1D file
+
+    Returns the matrix (rows x columns, float64) and a dict with the
+    header attributes. ColumnLabels, ColumnGroups, RunStart and
+    StimLabels are converted to lists, RowTR to float.
+    """
+    info = {}
+    rows = []
+    with open(fname) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                m = re.match(r'#\s*(\w+)\s*=\s*"(.*)"', line)
+                if m:
+                    info[m.group(1)] = m.group(2)
+                continue
+            rows.append(line.split())
+    X = np.array(rows, dtype=np.float64)
+    if X.ndim == 1:
+        X = X[:, None]
+
+    if 'ColumnLabels' in info:
+        info['ColumnLabels'] = [l.strip() for l in info['ColumnLabels'].split(';')]
+    else:
+        info['ColumnLabels'] = ['Col#%d' % i for i in range(X.shape[1])]
+    if 'ColumnGroups' in info:
+        info['ColumnGroups'] = _expand_groups(info['ColumnGroups'])
+    else:
+        info['ColumnGroups'] = [1] * X.shape[1]
+    if 'StimLabels' in info:
+        info['StimLabels'] = [l.strip() for l in info['StimLabels'].split(';')]
+    info['RunStart'] = [int(r) for r in info.get('RunStart', '0').split(',')]
+    info['RowTR'] = float(info.get('RowTR', 1.0))
+    return X, info
+
+
+def write_xmat(fname, X, labels, groups, tr, run_starts=(0,), stim_labels=None,
+               command=None):
+    """Write a design matrix with AFNI-compatible .xmat.1D headers"""
+    X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+    nrow, ncol = X.shape
+    stims = sorted(set(g for g in groups if g > 0))
+    header = [
+        ('ni_type', '%d*double' % ncol),
+        ('ni_dimen', '%d' % nrow),
+        ('ColumnLabels', ' ; '.join(labels)),
+        ('ColumnGroups', _compress_groups(groups)),
+        ('RowTR', '%g' % tr),
+        ('GoodList', '0..%d' % (nrow - 1)),
+        ('NRowFull', '%d' % nrow),
+        ('RunStart', ','.join('%d' % r for r in run_starts)),
+    ]
+    if stims:
+        bots = [groups.index(s) for s in stims]
+        tops = [len(groups) - 1 - groups[::-1].index(s) for s in stims]
+        header += [
+            ('Nstim', '%d' % len(stims)),
+            ('StimBots', ','.join('%d' % b for b in bots)),
+            ('StimTops', ','.join('%d' % t for t in tops)),
+        ]
+        if stim_labels is not None:
+            header.append(('StimLabels', ' ; '.join(stim_labels)))
+    if command is not None:
+        header.append(('CommandLine', command.replace('"', "'")))
+
+    with open(fname, 'w') as fp:
+        fp.write('# <matrix\n')
+        for key, value in header:
+            fp.write('#  %s = "%s"\n' % (key, value))
+        fp.write('# >\n')
+        for row in X:
+            fp.write(' ' + ' '.join('%g' % v for v in row) + '\n')
+        fp.write('# </matrix>\n')
+    return fname
+
+
+def stim_columns(info):
+    """Map each stimulus label to the indices of its xmat columns"""
+    groups = np.asarray(info['ColumnGroups'])
+    labels = info['ColumnLabels']
+    stims = []
+    for g in sorted(set(groups[groups > 0])):
+        cols = np.flatnonzero(groups == g)
+        if 'StimLabels' in info and g <= len(info['StimLabels']):
+            name = info['StimLabels'][g - 1]
+        else:
+            name = labels[cols[0]].split('#')[0]
+        stims.append((name, cols))
+    return stims
+
+
+# -------------------------------------------------------------------------
+# Datasets
+# -------------------------------------------------------------------------
+
+def load_mask(fname, shape=None):
+    """Boolean volume of the nonzero voxels of a mask dataset
+
+    Only the first sub-brick is used. With ``shape``, the mask must be on
+    that grid.
+    """
+    img = nb.load(fname)
+    if shape is not None and tuple(img.shape[:3]) != tuple(shape):
+        raise ValueError('mask %s has grid %s, the data has %s'
+                         % (fname, tuple(img.shape[:3]), tuple(shape)))
+    data = np.asanyarray(img.dataobj)
+    data = data.reshape(data.shape[:3] + (-1,))[..., 0]
+    return data != 0
+
+
+def load_series(in_files, dtype=np.float32, mask=None, mmap_file=None):
+    """Load and concatenate runs into a voxels x time matrix
+
+    Returns the matrix, the spatial shape, and the affine and header of
+    the first run. With a ``mask`` (a boolean volume, see load_mask),
+    only the in-mask voxels are kept, in C order; runs are gathered one
+    at a time so the full volume is never held for more than one run.
+    With ``mmap_file``, the matrix is a memory map backed by that file
+    (out-of-core), so only one run at a time is held in RAM.
+    """
+    if isinstance(in_files, (str, bytes)):
+        in_files = [in_files]
+    series = []
+    out = None
+    if mmap_file is not None:
+        infos = [dataset_info(f) for f in in_files]
+        nrows = int(mask.sum()) if mask is not None else int(np.prod(infos[0]['shape']))
+        out = np.memmap(mmap_file, dtype=dtype, mode='w+',
+                        shape=(nrows, sum(i['nvols'] for i in infos)))
+        col = 0
+    shape = affine = header = None
+    for fname in in_files:
+        img = nb.load(fname)
+        if shape is None:
+            shape, affine, header = img.shape[:3], img.affine, img.header
+        elif img.shape[:3] != shape:
+            raise ValueError('%s does not match the grid of %s' % (fname, in_files[0]))
+        data = np.asanyarray(img.dataobj)
+        if mask is None:
+            data = data.reshape(int(np.prod(shape)), -1)
+        elif mask.shape != tuple(shape):
+            raise ValueError('mask grid %s does not match %s' % (mask.shape, fname))
+        else:
+            data = data.reshape(tuple(shape) + (-1,))[mask]
+        if out is not None:
+            out[:, col:col + data.shape[1]] = data
+            col += data.shape[1]
+        else:
+            series.append(data.astype(dtype, copy=False))
+        del img, data
+    if out is not None:
+        out.flush()
+        return out, shape, affine, header
+    return np.concatenate(series, axis=1), shape, affine, header
+
+
+def parcel_series(in_files, atlas, mask=None, dtype=np.float32, chunk_size=32):
+    """Mean time series of every parcel of an atlas
+
+    ``atlas`` is a label volume on the data grid (0 = background). Runs
+    are streamed ``chunk_size`` volumes at a time, so only a chunk of the
+    data is in memory. Voxels outside ``mask`` (a boolean volume) are
+    left out of the means. Returns the parcels x time matrix and the
+    parcel labels.
+    """
+    if isinstance(in_files, (str, bytes)):
+        in_files = [in_files]
+    labels = np.asanyarray(nb.load(atlas).dataobj)
+    labels = np.rint(labels.reshape(labels.shape[:3] + (-1,))[..., 0]).astype(int)
+    if mask is not None:
+        labels[~mask] = 0
+    inside = labels != 0
+    parcels, index = np.unique(labels[inside], return_inverse=True)
+    if not len(parcels):
+        raise ValueError('atlas %s has no labelled voxel' % atlas)
+    counts = np.bincount(index)
+    order = np.argsort(index, kind='mergesort')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    series = []
+    for fname in in_files:
+        img = nb.load(fname)
+        if img.shape[:3] != labels.shape:
+            raise ValueError('atlas %s does not match the grid of %s' % (atlas, fname))
+        nt = img.shape[3] if len(img.shape) > 3 else 1
+        means = np.empty((len(parcels), nt), dtype=dtype)
+        for t0 in range(0, nt, chunk_size):
+            t1 = min(t0 + chunk_size, nt)
+            if len(img.shape) > 3:
+                block = np.asanyarray(img.dataobj[..., t0:t1])
+            else:
+                block = np.asanyarray(img.dataobj)[..., None]
+            vals = block[inside][order].astype(np.float64)
+            means[:, t0:t1] = np.add.reduceat(vals, starts, axis=0) / counts[:, None]
+        series.append(means)
+    return np.concatenate(series, axis=1), parcels
+
+
+def dataset_info(fname):
+    """Grid and timing of a NIfTI or AFNI dataset, from its header only
+
+    Returns a dict with the spatial 'shape', 'nvols', 'tr' (None when the
+    header has no time step) and voxel sizes ('zooms').
+    """
+    img = nb.load(fname)
+    shape = img.shape
+    zooms = img.header.get_zooms()
+    tr = float(zooms[3]) if len(zooms) > 3 and zooms[3] > 0 else None
+    if tr is not None and isinstance(img, nb.Nifti1Image) \
+            and img.header.get_xyzt_units()[1] == 'msec':
+        tr /= 1000.0
+    return {
+        'shape': tuple(shape[:3]),
+        'nvols': shape[3] if len(shape) > 3 else 1,
+        'tr': tr,
+        'zooms': tuple(float(z) for z in zooms[:3]),
+    }
+
+
+def run_lengths(in_files):
+    """Number of volumes of each run and the TR, read from the headers only"""
+    if isinstance(in_files, (str, bytes)):
+        in_files = [in_files]
+    infos = [dataset_info(f) for f in in_files]
+    tr = next((i['tr'] for i in infos if i['tr']), None)
+    return [i['nvols'] for i in infos], tr
+
+
+_AFNI_EXT = """<?xml version='1.0' ?>
+<AFNI_attributes
+  NIfTI_nums="%s"
+  ni_form="ni_group" >
+<AFNI_atr
+  ni_type="String"
+  ni_dimen="1"
+  atr_name="BRICK_LABS" >
+ "%s"
+</AFNI_atr>
+</AFNI_attributes>
+"""
+
+
+def save_bucket(fname, data, shape, affine, labels, header=None, mask=None):
+    """Save a voxels x sub-bricks array as an AFNI-style NIfTI bucket
+
+    The sub-brick labels are stored in the AFNI header extension, so
+    they show up in 3dinfo and the AFNI viewer. With a ``mask``, ``data``
+    holds the in-mask voxels only and is scattered back into the volume
+    (zero outside the mask).
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if data.ndim == 1:
+        data = data[:, None]
+    nbricks = data.shape[1]
+    if mask is not None:
+        vol = np.zeros(tuple(shape) + (nbricks,), dtype=np.float32)
+        vol[mask] = data
+        vol = vol[:, :, :, None, :]
+    else:
+        vol = data.reshape(tuple(shape) + (1, nbricks))
+    img = nb.Nifti1Image(vol, affine)
+    if header is not None:
+        img.header.set_xyzt_units(*header.get_xyzt_units())
+    img.header.set_intent('none')
+    nums = ','.join('%d' % n for n in tuple(shape) + (1, nbricks, 16))
+    ext = _AFNI_EXT % (nums, '~'.join(labels))
+    img.header.extensions.append(nb.nifti1.Nifti1Extension('afni', ext.encode()))
+    nb.save(img, fname)
+    return fname
+
+
+def save_table(fname, data, names, rows, row_name='parcel'):
+    """Save a rows x columns array as a tab-separated table
+
+    The first line holds the column names; the first column the row
+    labels (e.g. atlas parcel numbers).
+    """
+    data = np.asarray(data)
+    np.savetxt(fname, np.column_stack([rows, data]), delimiter='\t',
+               fmt=['%d'] + ['%.6g'] * data.shape[1],
+               header='\t'.join([row_name] + list(names)), comments='')
+    return fname
+
+
+def load_bucket(fname):
+    """Load a bucket as a voxels x sub-bricks array
+
+    Returns the array, the sub-brick labels (empty list when the file has
+    none), the spatial shape and the affine.
+    """
+    img = nb.load(fname)
+    shape = img.shape[:3]
+    data = np.asanyarray(img.dataobj).astype(np.float32, copy=False)
+    data = data.reshape(int(np.prod(shape)), -1)
+    labels = []
+    if isinstance(img, nb.Nifti1Image):
+        for ext in img.header.extensions:
+            if ext.get_code() == 4:
+                content = ext.get_content()
+                if isinstance(content, bytes):
+                    content = content.decode('utf-8', 'ignore')
+                m = re.search(r'atr_name="BRICK_LABS"\s*>\s*"([^"]*)"', content)
+                if m:
+                    labels = m.group(1).split('~')
+    elif hasattr(img.header, 'info'):
+        labels = img.header.info.get('BRICK_LABS', '').split('~')
+    labels = [l for l in labels if l]
+    return data, labels, shape, img.affine
@@ -0,0 +1,183 @@
+"""Run many Decon/REMLfit interfaces concurrently with asyncio
+
+Python 3 only. Command lines are launched as subprocesses directly,
+without a nipype node around each of them, and their stdout/stderr is
+read line by line while they run. Runs that need Python around the
+command (numpy engine, atlas mode, slabs, design cache, profiling) go
+to a process pool instead.
+
+Interfaces write their outputs to the current directory, so every job
+runs in its own directory under ``work_dir`` (job0000, ...) with its
+input paths made absolute, and a batch in which two jobs would still
+write the same file is rejected before anything starts.
+
+    results = run_batch(interfaces, max_jobs=16)
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from toolmonitor import kill_process
+from jobdirs import (abs_inputs, job_dirs, working_directory, output_paths,
+                     check_collisions)
+
+
+class JobResult(object):
+    """Outcome of one interface run"""
+
+    def __init__(self, index, interface, cwd):
+        self.index = index
+        self.interface = interface
+        self.cwd = cwd
+        self.returncode = None
+        self.outputs = None
+        self.stdout = []
+        self.stderr = []
+        self.error = None
+        self.duration = None
+
+    @property
+    def ok(self):
+        return self.error is None and self.returncode == 0
+
+    def __repr__(self):
+        return '<JobResult %d %s returncode=%s>' % (
+            self.index, self.interface._cmd, self.returncode)
+
+
+async def _pump(stream, lines, callback, index, name):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        line = line.decode('utf-8', 'replace').rstrip('\n')
+        if lines is not None:
+            lines.append(line)
+        if callback is not None:
+            callback(index, name, line)
+
+
+async def _run_cmdline(result, on_line, keep_output):
+    interface = result.interface
+    with working_directory(result.cwd):
+        if interface.inputs.check_inputs:
+            interface._check_inputs()
+        interface._preflight()
+        if hasattr(interface, '_decide_usetemp'):
+            interface._decide_usetemp()
+        cmdline = interface.cmdline
+    monitor = interface._make_monitor() if hasattr(interface, '_make_monitor') else None
+    interface._monitor = monitor
+
+    def feed(index, name, line):
+        if on_line is not None:
+            on_line(index, name, line)
+        if monitor is not None and monitor.abort_reason is None \
+                and monitor.feed(line, name):
+            kill_process(proc)
+
+    env = dict(os.environ)
+    env.update(interface.inputs.environ)
+    proc = await asyncio.create_subprocess_shell(
+        cmdline, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        cwd=result.cwd, env=env, start_new_session=(os.name != 'nt'))
+    try:
+        await asyncio.gather(
+            _pump(proc.stdout, result.stdout if keep_output else None, feed,
+                  result.index, 'stdout'),
+            _pump(proc.stderr, result.stderr if keep_output else None, feed,
+                  result.index, 'stderr'))
+        result.returncode = await proc.wait()
+    except asyncio.CancelledError:
+        kill_process(proc)
+        raise
+    if monitor is not None and monitor.abort_reason:
+        result.error = '%s stopped early: %s' % (interface._cmd, monitor.abort_reason)
+    elif result.returncode == 0:
+        with working_directory(result.cwd):
+            result.outputs = interface._list_outputs()
+    else:
+        result.error = '%s exited with code %d' % (interface._cmd, result.returncode)
+
+
+def _run_python(args):
+    klass, inputs, cwd = args
+    os.chdir(cwd)
+    res = klass(**inputs).run()
+    runtime = res.runtime
+    return (res.outputs.get(), getattr(runtime, 'returncode', 0) or 0,
+            getattr(runtime, 'stdout', None) or '', getattr(runtime, 'stderr', None) or '')
+
+
+async def _run_job(result, sem, executor, on_line, keep_output):
+    async with sem:
+        t0 = time.time()
+        try:
+            if result.interface._cmdline_only():
+                await _run_cmdline(result, on_line, keep_output)
+            else:
+                loop = asyncio.get_event_loop()
+                interface = result.interface
+                args = (type(interface), interface.inputs.get_traitsfree(), result.cwd)
+                outputs, returncode, stdout, stderr = await loop.run_in_executor(
+                    executor, _run_python, args)
+                result.returncode = returncode
+                result.outputs = outputs
+                if keep_output:
+                    result.stdout = stdout.splitlines()
+                    result.stderr = stderr.splitlines()
+        except Exception as exc:
+            result.error = '%s: %s' % (type(exc).__name__, exc)
+        result.duration = time.time() - t0
+    return result
+
+
+async def iter_batch(interfaces, max_jobs=None, on_line=None, keep_output=True,
+                     work_dir=None):
+    """Run interfaces with at most max_jobs at a time, yielding a
+    JobResult as each one finishes
+
+    Job k runs in ``work_dir/job%04d`` (``work_dir`` defaults to the
+    current directory) on a copy of interface k with absolute input
+    paths; JobResult.interface is that copy. Raises ValueError if two
+    jobs would write the same output file.
+
+    ``on_line(index, 'stdout'|'stderr', line)`` is called for every
+    output line of the directly launched command lines. Failures are
+    reported in JobResult.error and do not stop the batch.
+    """
+    if max_jobs is None:
+        max_jobs = os.cpu_count() or 1
+    dirs = job_dirs(os.getcwd() if work_dir is None else work_dir, len(interfaces))
+    jobs = [JobResult(k, type(iface)(**abs_inputs(iface.inputs.get_traitsfree())), cwd)
+            for k, (iface, cwd) in enumerate(zip(interfaces, dirs))]
+    paths = []
+    for job in jobs:
+        with working_directory(job.cwd):
+            paths.append(output_paths(job.interface))
+    check_collisions(paths)
+
+    sem = asyncio.Semaphore(max_jobs)
+    with ProcessPoolExecutor(max_workers=max_jobs) as executor:
+        tasks = [asyncio.ensure_future(_run_job(job, sem, executor, on_line, keep_output))
+                 for job in jobs]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def run_batch(interfaces, max_jobs=None, on_line=None, keep_output=True, work_dir=None):
+    """Run interfaces concurrently and return their JobResults in input order"""
+    async def collect():
+        results = [None] * len(interfaces)
+        async for res in iter_batch(interfaces, max_jobs, on_line, keep_output, work_dir):
+            results[res.index] = res
+        return results
+
+    return asyncio.run(collect())
@@ -0,0 +1,250 @@
+"""Offline benchmarks for the Decon/REMLfit code paths
+
+Times Decon and REMLfit command-line construction, design matrix
+building and the in-process fitting engines on synthetic data of
+increasing size, and reports throughput and peak memory (tracemalloc,
+which includes numpy buffers). Nothing here needs AFNI.
+
+    python benchmarks/bench_decon.py [--quick] [--json results.json]
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import nibabel as nb
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deconv1 import Decon
+from design import build_design, save_design
+from glmengine import OLSDesign
+from hrfbasis import regressors
+from remlengine import REMLEngine
+from remlfitv1 import REMLfit
+import stimtimes
+
+
+def measure(func, repeat=3):
+    """Best wall time of func() over repeat calls, and peak traced memory (MB)
+
+    Timing runs with tracemalloc off, since tracing slows down
+    allocation-heavy Python code; one more, traced call gives the peak.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak / 1024.0 ** 2
+
+
+def _stim_files(tmpdir, nstim, nruns, run_sec, rng):
+    files = []
+    for k in range(nstim):
+        fname = os.path.join(tmpdir, 'stim%04d.1D' % k)
+        with open(fname, 'w') as fp:
+            for _ in range(nruns):
+                onsets = np.sort(rng.uniform(0, run_sec - 20, 8))
+                fp.write(' '.join('%.1f' % o for o in onsets) + '\n')
+        files.append(fname)
+    return files
+
+
+def _runs(tmpdir, nruns, nt, tr=2.0):
+    files = []
+    for r in range(nruns):
+        fname = os.path.join(tmpdir, 'run%02d_%d.nii' % (r, nt))
+        img = nb.Nifti1Image(np.zeros((2, 2, 2, nt), dtype=np.float32), np.eye(4))
+        img.header.set_zooms((2.0, 2.0, 2.0, tr))
+        nb.save(img, fname)
+        files.append(fname)
+    return files
+
+
+def bench_cmdline(tmpdir, quick, rng):
+    results = []
+    nstims = [10, 50] if quick else [10, 50, 100, 500]
+    nruns = [1, 4] if quick else [1, 4, 10]
+    for nstim in nstims:
+        for nrun in nruns:
+            stims = _stim_files(tmpdir, nstim, nrun, 300, rng)
+            runs = _runs(tmpdir, nrun, 150)
+            decon = Decon(in_file=runs, num_stimts=nstim, stim_files=stims,
+                          models=['BLOCK(5,1)'] * nstim,
+                          labels=['s%d' % k for k in range(nstim)],
+                          tout=True, fout=True)
+            calls = 20
+            t, mem = measure(lambda: [decon.cmdline for _ in range(calls)])
+            results.append({
+                'bench': 'cmdline', 'stims': nstim, 'runs': nrun,
+                'seconds': t / calls, 'throughput': calls / t, 'unit': 'cmdlines/s',
+                'peak_mb': mem,
+            })
+
+    # 3dREMLfit command lines: one -gltsym per GLT, formatted in _format_arg
+    nglts = [10, 50] if quick else [10, 50, 200]
+    for nrun in nruns:
+        runs = _runs(tmpdir, nrun, 150)
+        stims = _stim_files(tmpdir, 10, nrun, 300, rng)
+        labels = ['s%d' % k for k in range(10)]
+        matrix = os.path.join(tmpdir, 'reml%02d.xmat.1D' % nrun)
+        X, info = build_design(stims, ['BLOCK(5,1)'] * 10, labels, [150] * nrun, 2.0)
+        save_design(matrix, X, info)
+        for nglt in nglts:
+            glts = ['+%s -%s' % (labels[k % 10], labels[(k + 1) % 10]) for k in range(nglt)]
+            reml = REMLfit(in_file=runs, matrix=matrix, glt=glts,
+                           labels=['g%d' % k for k in range(nglt)], tout=True, fout=True)
+            calls = 20
+            t, mem = measure(lambda: [reml.cmdline for _ in range(calls)])
+            results.append({
+                'bench': 'reml_cmd', 'glts': nglt, 'runs': nrun,
+                'seconds': t / calls, 'throughput': calls / t, 'unit': 'cmdlines/s',
+                'peak_mb': mem,
+            })
+    return results
+
+
+def bench_design(tmpdir, quick, rng):
+    results = []
+    nstims = [10, 50] if quick else [10, 50, 200]
+    for nstim in nstims:
+        for nrun, nt in [(1, 200), (4, 300)]:
+            stims = _stim_files(tmpdir, nstim, nrun, nt * 2.0, rng)
+            func = lambda: build_design(stims, ['BLOCK(5,1)'] * nstim,
+                                        ['s%d' % k for k in range(nstim)],
+                                        [nt] * nrun, 2.0)
+            t, mem = measure(func)
+            results.append({
+                'bench': 'design', 'stims': nstim, 'runs': nrun, 'timepoints': nt * nrun,
+                'seconds': t, 'throughput': 1.0 / t, 'unit': 'designs/s',
+                'peak_mb': mem,
+            })
+
+    # long naturalistic run: thousands of events, direct vs FFT regressors
+    nt = 1500 if quick else 6000
+    onsets = np.sort(rng.uniform(0, nt * 2.0, nt))
+    for method in ['direct', 'fft']:
+        t, mem = measure(lambda: regressors('SPMG2', onsets, None, nt, 2.0, method))
+        results.append({
+            'bench': 'regressors', 'method': method, 'events': len(onsets),
+            'timepoints': nt, 'seconds': t, 'throughput': 1.0 / t, 'unit': 'regressors/s',
+            'peak_mb': mem,
+        })
+    return results
+
+
+def bench_stimtimes(tmpdir, quick, rng):
+    results = []
+    for nevents in ([200, 2000] if quick else [200, 2000, 20000]):
+        fname = os.path.join(tmpdir, 'married%d.1D' % nevents)
+        with open(fname, 'w') as fp:
+            for _ in range(4):
+                onsets = np.sort(rng.uniform(0, 600, nevents // 4))
+                fp.write(' '.join('%.2f*%.2f:%.1f' % (o, a, 2.0)
+                                  for o, a in zip(onsets, rng.uniform(0, 2, len(onsets))))
+                         + '\n')
+
+        def parse():
+            stimtimes._CACHE.clear()
+            stimtimes.read_stim_times(fname)
+
+        for name, func in [('parse', parse),
+                           ('cached', lambda: stimtimes.read_stim_times(fname))]:
+            t, mem = measure(func)
+            results.append({
+                'bench': name, 'events': nevents,
+                'seconds': t, 'throughput': nevents / t, 'unit': 'events/s',
+                'peak_mb': mem,
+            })
+    return results
+
+
+def _sizes(quick):
+    if quick:
+        return [(2000, 200, 10), (10000, 300, 20)]
+    return [(2000, 200, 10), (20000, 300, 20), (100000, 400, 40), (200000, 600, 60)]
+
+
+def bench_engines(quick, rng):
+    results = []
+    for nvox, nt, p in _sizes(quick):
+        X = np.column_stack([np.ones(nt), rng.standard_normal((nt, p - 1))])
+        Y = rng.standard_normal((nvox, nt)).astype(np.float32)
+        for name, func in [
+                ('ols', lambda: OLSDesign(X).fit(Y)),
+                ('reml', lambda: REMLEngine(X, [0, nt // 2]).fit(Y))]:
+            t, mem = measure(func, repeat=1 if nvox > 50000 else 3)
+            results.append({
+                'bench': name, 'voxels': nvox, 'timepoints': nt, 'regressors': p,
+                'seconds': t, 'throughput': nvox / t, 'unit': 'voxels/s',
+                'peak_mb': mem,
+            })
+        del Y
+    return results
+
+
+def report(results):
+    print('%-8s %-42s %10s %12s %-10s %8s' % ('bench', 'size', 'seconds', 'throughput', '',
+                                              'peak MB'))
+    for res in results:
+        size = ', '.join('%s=%s' % (k, res[k]) for k in
+                         ('method', 'stims', 'glts', 'runs', 'events', 'voxels', 'timepoints',
+                          'regressors')
+                         if k in res)
+        print('%-8s %-42s %10.5f %12.1f %-10s %8.1f' % (
+            res['bench'], size, res['seconds'], res['throughput'], res['unit'],
+            res['peak_mb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='small sizes only')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--only', choices=['cmdline', 'design', 'stimtimes', 'engines'],
+                        help='run a single group of benchmarks')
+    args = parser.parse_args(argv)
+
+    rng = np.random.RandomState(0)
+    tmpdir = tempfile.mkdtemp(prefix='bench_decon_')
+    cwd = os.getcwd()
+    os.chdir(tmpdir)
+    try:
+        results = []
+        if args.only in (None, 'cmdline'):
+            results += bench_cmdline(tmpdir, args.quick, rng)
+        if args.only in (None, 'design'):
+            results += bench_design(tmpdir, args.quick, rng)
+        if args.only in (None, 'stimtimes'):
+            results += bench_stimtimes(tmpdir, args.quick, rng)
+        if args.only in (None, 'engines'):
+            results += bench_engines(args.quick, rng)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
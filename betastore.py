@@ -0,0 +1,135 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import object, str
+
+import errno
+import json
+import os
+
+import numpy as np
+
+from afniio import load_bucket, load_mask
+
+
+class BetaStore(object):
+    """Per-subject sub-bricks of first-level buckets in one memory map
+
+    A store is a directory holding ``betas.npy``, a subjects x in-mask
+    voxels x regressors array opened with ``mmap_mode='r'``, the mask
+    (``mask.npy``) and ``index.json``, which maps subject IDs and
+    regressor labels to positions and keeps the grid and affine. Loading
+    a store reads only the index; data pages are read from disk when an
+    array is first touched, so selecting one subject or one regressor
+    does not read the rest.
+
+        store = BetaStore.create('group', buckets, subjects, labels=['aud#0_Coef'])
+        aud = store.get(label='aud#0_Coef')         # subjects x voxels
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(os.path.join(self.path, 'index.json')) as fp:
+            index = json.load(fp)
+        self.subjects = index['subjects']
+        self.labels = index['labels']
+        self.shape = tuple(index['shape'])
+        self.affine = np.array(index['affine'])
+        self.sources = index.get('sources', [])
+        self._subject = dict((s, k) for k, s in enumerate(self.subjects))
+        self._label = dict((l, k) for k, l in enumerate(self.labels))
+        self.data = np.load(os.path.join(self.path, 'betas.npy'), mmap_mode='r')
+        self.mask = np.load(os.path.join(self.path, 'mask.npy')).astype(bool)
+
+    @classmethod
+    def create(cls, path, in_files, subjects, labels=None, mask=None, dtype=np.float32):
+        """Build a store from one bucket per subject
+
+        ``labels`` selects sub-bricks by their AFNI label, in that order
+        (all sub-bricks of the first bucket by default); every bucket must
+        have them. ``mask`` is a mask dataset or a boolean volume; without
+        one the whole grid is stored. Buckets are read one at a time, and
+        the index is written last, so an interrupted build leaves no
+        store that opens.
+        """
+        if len(in_files) != len(subjects):
+            raise ValueError('%d buckets but %d subject IDs' % (len(in_files), len(subjects)))
+        if len(set(subjects)) != len(subjects):
+            raise ValueError('subject IDs must be unique')
+
+        path = os.path.abspath(path)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        index_file = os.path.join(path, 'index.json')
+        if os.path.exists(index_file):
+            os.remove(index_file)
+
+        shape = affine = store = None
+        for k, fname in enumerate(in_files):
+            data, names, grid, aff = load_bucket(fname)
+            if shape is None:
+                shape, affine = tuple(grid), aff
+                if labels is None:
+                    if not names:
+                        raise ValueError('%s has no sub-brick labels; give labels' % fname)
+                    labels = list(names)
+                if mask is None:
+                    mask = np.ones(shape, dtype=bool)
+                elif not isinstance(mask, np.ndarray):
+                    mask = load_mask(mask, shape)
+                store = np.lib.format.open_memmap(
+                    os.path.join(path, 'betas.npy'), mode='w+', dtype=dtype,
+                    shape=(len(in_files), int(mask.sum()), len(labels)))
+            elif tuple(grid) != shape:
+                raise ValueError('%s has grid %s but %s has %s'
+                                 % (fname, tuple(grid), in_files[0], shape))
+            missing = [l for l in labels if l not in names]
+            if missing:
+                raise ValueError('%s has no sub-brick labelled %s' % (fname, ', '.join(missing)))
+            cols = [names.index(l) for l in labels]
+            store[k] = data[mask.ravel()][:, cols]
+            del data
+        store.flush()
+        del store
+
+        np.save(os.path.join(path, 'mask.npy'), mask.astype(np.uint8))
+        index = {
+            'subjects': [str(s) for s in subjects],
+            'labels': list(labels),
+            'shape': [int(n) for n in shape],
+            'affine': np.asarray(affine).tolist(),
+            'sources': [os.path.abspath(f) for f in in_files],
+        }
+        with open(index_file + '.tmp', 'w') as fp:
+            json.dump(index, fp, indent=2)
+        os.rename(index_file + '.tmp', index_file)
+        return cls(path)
+
+    def subject_index(self, subject):
+        try:
+            return self._subject[subject]
+        except KeyError:
+            raise ValueError('subject %r is not in the store' % subject)
+
+    def label_index(self, label):
+        try:
+            return self._label[label]
+        except KeyError:
+            raise ValueError('regressor %r is not in the store' % label)
+
+    def get(self, subject=None, label=None):
+        """Betas of some subjects and regressors: subject and label are an
+        ID, a label, a list of them or None (all). A single subject or all
+        subjects give a memory-mapped view; lists give a copy."""
+        def select(keys, lookup):
+            if keys is None:
+                return slice(None)
+            if isinstance(keys, (list, tuple)):
+                return [lookup(k) for k in keys]
+            return lookup(keys)
+        data = self.data[select(subject, self.subject_index)]
+        return data[..., select(label, self.label_index)]
+
+    def __len__(self):
+        return len(self.subjects)
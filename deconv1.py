@@ -3,12 +3,14 @@ from __future__ import print_function, division, unicode_literals, absolute_impo
 from builtins import range, str, bytes
 
 import os
+import shutil
 import warnings
 import sys
 import re
 import nibabel as nb
 import numpy as np
 
+from nipype import logging
 from nipype.utils.filemanip import split_filename
 
 from nipype.interfaces.base import (BaseInterface, TraitedSpec, traits, File, OutputMultiPath,
@@ -20,6 +22,21 @@ from nipype.interfaces.afni.base import (
     AFNICommand, AFNICommandBase, AFNICommandInputSpec,
     AFNICommandOutputSpec)
 
+from afniio import (read_xmat, load_mask, load_series, parcel_series, save_bucket,
+                    save_table, run_lengths)
+from design import build_design, save_design, check_design_inputs
+from xmatcache import XmatCache, design_key
+from slabs import run_slabs
+from jobdirs import (abs_inputs, job_dirs, working_directory, output_paths,
+                     check_collisions)
+from runprofile import RunProfile, phase
+from diagnostics import preflight
+from toolmonitor import WarningMonitor, FATAL_PATTERNS, run_monitored
+from glmengine import shared_design, decon_bucket, blas_threads
+from glt import GLTMatrix
+
+iflogger = logging.getLogger('nipype.interface')
+
 
 class DeconInputSpec(CommandLineInputSpec):
     # TODO: Add position metadata. Check if better using traits.Enum for local and global options
@@ -52,6 +69,15 @@ class DeconInputSpec(CommandLineInputSpec):
         position=4
     )
 
+    num_threads = traits.Int(
+        1,
+        desc='number of threads: sets OMP_NUM_THREADS and -jobs, and tells '
+             'the nipype scheduler how many cores the node uses',
+        argstr='-jobs %d \\\n',
+        usedefault=True,
+        nohash=True
+    )
+
     output_datatype = traits.Enum(
         'float', 'short',
         desc='Specify output datasets format. Valid types are \'float\' and \'short\'',
@@ -72,6 +98,20 @@ class DeconInputSpec(CommandLineInputSpec):
         copyfile=False
     )
 
+    mask = File(
+        desc='only fit the voxels inside this mask (zero elsewhere). The '
+             'in-process engine then keeps only in-mask voxels in memory',
+        argstr='-mask %s \\\n',
+        exists=True
+    )
+
+    atlas = File(
+        desc='atlas label volume on the data grid. Fits the mean time series of '
+             'every parcel in-process and writes a parcels x statistics table '
+             '(out_table) instead of a bucket',
+        exists=True
+    )
+
     num_stimts = traits.Int(
         desc='number of stim time files',
         argstr='-num_stimts %d \\\n',
@@ -106,6 +146,20 @@ class DeconInputSpec(CommandLineInputSpec):
         exists=True
     )
 
+    glt = traits.List(
+        traits.Str,
+        argstr='%s',
+        desc='symbolic GLTs (-gltsym), e.g. \'+aud -vis\'',
+        minlen=1,
+        requires=['glt_labels']
+    )
+
+    glt_labels = traits.List(
+        traits.Str,
+        desc='List of labels for the GLTs. Must be sorted as in glt',
+        minlen=1
+    )
+
     out_xmat = File('X.xmat.1D',
                     desc='name of output design matrix',
                     argstr='-x1D %s \n',
@@ -171,6 +225,138 @@ class DeconInputSpec(CommandLineInputSpec):
                     usedefault=True
                     )
 
+    engine = traits.Enum(
+        'afni', 'numpy',
+        desc='\'afni\' runs the full fit in 3dDeconvolve. \'numpy\' only lets '
+             '3dDeconvolve build the design matrix and fits all voxels in-process',
+        usedefault=True
+    )
+
+    alternatives = traits.List(
+        traits.Dict(traits.Str, traits.Any),
+        desc='alternative model specifications fitted in-process to the same data, '
+             'loaded once. Each is a dict overriding models and/or polort (also '
+             'stim_files, labels) with an optional name. Writes one bucket and '
+             'matrix per alternative and a fit-comparison bucket (AIC per model, '
+             'best model by AIC and BIC; 0 is the main model)'
+    )
+
+    xmat_builder = traits.Enum(
+        'afni', 'python',
+        desc='build the design matrix with 3dDeconvolve -x1D_stop (\'afni\') or '
+             'in-process (\'python\'). The python builder is used when stop is '
+             'set or the engine is \'numpy\'',
+        usedefault=True
+    )
+
+    convolution = traits.Enum(
+        'direct', 'fft',
+        desc='how the python builder computes regressors: evaluating the response '
+             'at every event (\'direct\', exact) or FFT convolution on a ~0.1s grid '
+             '(\'fft\', much faster for thousands of events, up to ~5e-3 relative '
+             'error)',
+        usedefault=True
+    )
+
+    xmat_cache = Directory(
+        desc='directory of design matrices shared between runs. Designs with '
+             'identical timing file contents, models, labels, polort, timing, '
+             'run lengths and TR are copied from it instead of being rebuilt',
+        nohash=True
+    )
+
+    xmat_cache_size = traits.Int(
+        1000,
+        desc='maximum number of design matrices kept in xmat_cache',
+        usedefault=True,
+        nohash=True
+    )
+
+    check_inputs = traits.Bool(
+        True,
+        desc='check run lengths, TR, timing files and num_stimts from the '
+             'headers before running',
+        usedefault=True,
+        nohash=True
+    )
+
+    profile = traits.Bool(
+        False,
+        desc='record wall/CPU time, peak RSS, I/O and phase times of the run '
+             'in a JSON file next to out_file',
+        usedefault=True,
+        nohash=True
+    )
+
+    diagnostics = traits.Enum(
+        'report', 'fail', 'off',
+        desc='check the conditioning of the design matrix (condition number, '
+             'regressor correlations, variance inflation) before fitting: save '
+             'a JSON report, or also stop when the design has problems. Default: '
+             '\'report\' with the numpy engine, \'off\' with afni',
+        nohash=True
+    )
+
+    max_condition = traits.Float(
+        1000.0,
+        desc='largest tolerated condition number of the design (diagnostics)',
+        usedefault=True,
+        nohash=True
+    )
+
+    max_correlation = traits.Float(
+        0.9,
+        desc='largest tolerated correlation between two regressors (diagnostics)',
+        usedefault=True,
+        nohash=True
+    )
+
+    max_vif = traits.Float(
+        10.0,
+        desc='largest tolerated variance inflation factor (diagnostics)',
+        usedefault=True,
+        nohash=True
+    )
+
+    monitor = traits.Bool(
+        True,
+        desc='watch the 3dDeconvolve output while it runs and kill it as soon as '
+             'max_warnings, monitor_max_condition or a fatal pattern is hit',
+        usedefault=True,
+        nohash=True
+    )
+
+    max_warnings = traits.Int(
+        desc='number of design matrix warnings tolerated before the run is '
+             'aborted (defaults to goforit)',
+        nohash=True
+    )
+
+    monitor_max_condition = traits.Float(
+        desc='abort when a matrix condition number reported by 3dDeconvolve '
+             'exceeds this (monitor)',
+        nohash=True
+    )
+
+    fatal_patterns = traits.List(
+        traits.Str,
+        desc='regular expressions of output lines that abort the run '
+             '(defaults to AFNI error messages)',
+        nohash=True
+    )
+
+    slab_workers = traits.Int(
+        desc='fit the volume in z-slabs with this many local worker processes '
+             'and stitch the slab buckets back together',
+        nohash=True
+    )
+
+    num_slabs = traits.Int(
+        desc='number of z-slabs (default: twice slab_workers)',
+        requires=['slab_workers'],
+        nohash=True
+    )
+
 
 class DeconOutputSpec(TraitedSpec):
     out_xmat = File(
@@ -183,6 +369,36 @@ class DeconOutputSpec(TraitedSpec):
     out_file = File(
         desc='output statistics'
     )
+    out_table = File(
+        desc='parcel statistics (tab-separated), atlas mode only'
+    )
+    out_profile = File(
+        desc='resource profile of the run (JSON)'
+    )
+    out_alternatives = traits.List(
+        File,
+        desc='bucket (or parcel table) of each alternative model'
+    )
+    out_alt_xmats = traits.List(
+        File,
+        desc='design matrix of each alternative model'
+    )
+    out_comparison = File(
+        desc='fit comparison of the main and alternative models'
+    )
+    out_diagnostics = File(
+        desc='design matrix diagnostics (JSON)'
+    )
+    warnings = traits.List(
+        traits.Str,
+        desc='warning lines printed by 3dDeconvolve'
+    )
+    num_matrix_warnings = traits.Int(
+        desc='number of warnings about the design matrix'
+    )
+    matrix_condition = traits.Dict(
+        desc='condition numbers reported by 3dDeconvolve, by matrix'
+    )
 
 
 class Decon(CommandLine):
@@ -192,12 +408,35 @@ class Decon(CommandLine):
     input_spec = DeconInputSpec
     output_spec = DeconOutputSpec
 
+    def __init__(self, **inputs):
+        super(Decon, self).__init__(**inputs)
+        self._profile = None
+        self._monitor = None
+        self._diagnostics = None
+        self.inputs.on_trait_change(self._nthreads_update, 'num_threads')
+        self._nthreads_update()
+
+    @property
+    def num_threads(self):
+        return self.inputs.num_threads
+
+    @num_threads.setter
+    def num_threads(self, value):
+        self.inputs.num_threads = value
+
+    def _nthreads_update(self):
+        self.inputs.environ['OMP_NUM_THREADS'] = '%d' % self.inputs.num_threads
+
     def _format_arg(self, name, trait_spec, value):
 
         if name == 'out_xmat':
             xmat = self._gen_filename('out_xmat')
             return trait_spec.argstr % xmat
 
+        # 3dDeconvolve runs single-threaded unless -jobs is given
+        if name == 'num_threads' and value <= 1:
+            return None
+
         if name == 'out_file' and not self.inputs.no_bucket:
             bucket = self._gen_filename('out_file')
             return trait_spec.argstr % bucket
@@ -214,6 +453,14 @@ class Decon(CommandLine):
             arg = ' '.join([arg,arg_aux])
             return arg
 
+        if name == 'glt':
+            if len(value) != len(self.inputs.glt_labels):
+                raise ValueError('glt and glt_labels must have the same length')
+            num = range(1, len(value) + 1)
+            return '-num_glt %d \\\n ' % len(value) + ' '.join(
+                '-gltsym \'SYM: %s\' -glt_label %d %s \\\n' % z
+                for z in zip(value, num, self.inputs.glt_labels))
+
         return super(Decon, self)._format_arg(name, trait_spec, value)
 
     def _gen_filename(self, name):
@@ -232,23 +479,439 @@ class Decon(CommandLine):
             output = filename + '_stats.nii.gz'
             return output
 
+        if name == 'out_table':
+            _, filename, ext = split_filename(self._gen_filename('out_file'))
+            return filename + '_parcels.tsv'
+
+        if name == 'out_diagnostics':
+            _, filename, ext = split_filename(self._gen_filename('out_file'))
+            return filename + '_diagnostics.json'
+
+        if name == 'out_profile':
+            _, filename, ext = split_filename(self._gen_filename('out_file'))
+            return filename + '_profile.json'
+
         return None
 
+    def _alt_filename(self, name, model):
+        """out_xmat, out_file or out_table of an alternative model"""
+        if name == 'out_xmat':
+            xmat = self._gen_filename('out_xmat')
+            for suffix in ('.xmat.1D', '.1D'):
+                if xmat.endswith(suffix):
+                    xmat = xmat[:-len(suffix)]
+                    break
+            return '%s_%s.xmat.1D' % (xmat, model)
+        _, filename, ext = split_filename(self._gen_filename('out_file'))
+        if name == 'out_table':
+            return '%s_%s_parcels.tsv' % (filename, model)
+        return '%s_%s%s' % (filename, model, ext)
+
     def _parse_inputs(self, skip=None):
         # Skip the arguments without argstr metadata
         if skip is None:
             skip = []
-        skip += ['stim_files', 'labels', 'models']
+        skip += ['stim_files', 'labels', 'models', 'glt_labels', 'engine', 'atlas',
+                 'alternatives',
+                 'xmat_builder', 'convolution',
+                 'xmat_cache', 'xmat_cache_size', 'check_inputs', 'profile',
+                 'diagnostics', 'max_correlation', 'max_vif',
+                 'monitor', 'max_warnings', 'monitor_max_condition', 'max_condition',
+                 'fatal_patterns',
+                 'slab_workers', 'num_slabs']
 
         # Skip output bucket if no_bucket == True
         if self.inputs.no_bucket:
             skip += ['out_file']
 
-        return super(Decon, self)._parse_inputs(skip=skip)
-
+        all_args = super(Decon, self)._parse_inputs(skip=skip)
+
+        # The numpy engine only needs the design matrix from 3dDeconvolve
+        if self._in_process() and not self.inputs.stop:
+            all_args.insert(0, self.inputs.trait('stop').argstr)
+
+        return all_args
+
+    def _run_interface(self, runtime):
+        if not self.inputs.profile:
+            return self._run_decon(runtime)
+
+        self._profile = RunProfile(self._cmd)
+        with self._profile:
+            runtime = self._run_decon(runtime)
+        self._profile.add_output('\n'.join([getattr(runtime, 'stdout', None) or '',
+                                            getattr(runtime, 'stderr', None) or '']))
+        self._profile.save(self._gen_filename('out_profile'))
+        return runtime
+
+    def _check_inputs(self):
+        check_design_inputs(self.inputs.in_file, self.inputs.stim_files,
+                            self.inputs.models, self.inputs.labels,
+                            self.inputs.num_stimts, timing=self.inputs.timing)
+
+    def _cmdline_only(self):
+        """True when a run is nothing but the 3dDeconvolve command line
+        (after the input checks), so it can be launched directly"""
+        return not (self._in_process() or self.inputs.profile
+                    or isdefined(self.inputs.xmat_cache)
+                    or (isdefined(self.inputs.slab_workers) and self.inputs.slab_workers > 1)
+                    or (self.inputs.stop and self.inputs.xmat_builder == 'python'))
+
+    def _run_decon(self, runtime):
+        if self.inputs.check_inputs:
+            self._check_inputs()
+        self._preflight()
+
+        # parcels span slabs, and parcel fits are cheap anyway
+        if isdefined(self.inputs.slab_workers) and self.inputs.slab_workers > 1 \
+                and not self.inputs.stop and not isdefined(self.inputs.atlas) \
+                and not self.inputs.alternatives:
+            stitch = {}
+            if not self.inputs.no_bucket:
+                stitch['out_file'] = os.path.abspath(self._gen_filename('out_file'))
+            num_slabs = self.inputs.num_slabs if isdefined(self.inputs.num_slabs) else None
+            run_slabs(self, stitch,
+                      copy={'out_xmat': os.path.abspath(self._gen_filename('out_xmat'))},
+                      num_workers=self.inputs.slab_workers, num_slabs=num_slabs)
+            runtime.returncode = 0
+            return runtime
+
+        design_only = self.inputs.stop or self._in_process()
+        xmat = self._gen_filename('out_xmat')
+
+        cache = key = None
+        if design_only and isdefined(self.inputs.xmat_cache):
+            cache = XmatCache(self.inputs.xmat_cache, self.inputs.xmat_cache_size)
+            key = self._xmat_key()
+
+        if cache is not None and cache.get(key, xmat):
+            runtime.returncode = 0
+        else:
+            if design_only and self.inputs.xmat_builder == 'python':
+                with phase(self._profile, 'matrix_setup'):
+                    self._build_xmat()
+                runtime.returncode = 0
+            else:
+                runtime = self._run_command(runtime)
+
+            if cache is not None and runtime.returncode == 0 and os.path.exists(xmat):
+                cache.put(key, xmat)
+
+        if self._in_process() and not self.inputs.stop and not self.inputs.no_bucket:
+            self._fit_numpy()
+
+        return runtime
+
+    def _in_process(self):
+        return self.inputs.engine == 'numpy' or isdefined(self.inputs.atlas) \
+            or bool(self.inputs.alternatives)
+
+    def _make_monitor(self):
+        if not self.inputs.monitor:
+            return None
+        max_warnings = self.inputs.max_warnings
+        if not isdefined(max_warnings):
+            max_warnings = self.inputs.goforit if isdefined(self.inputs.goforit) else None
+        max_condition = self.inputs.monitor_max_condition
+        fatal = self.inputs.fatal_patterns
+        return WarningMonitor(max_warnings=max_warnings,
+                              max_condition=max_condition if isdefined(max_condition) else None,
+                              fatal=fatal if isdefined(fatal) else FATAL_PATTERNS)
+
+    def _run_command(self, runtime):
+        self._monitor = self._make_monitor()
+        if self._monitor is None and self._profile is None:
+            return super(Decon, self)._run_interface(runtime)
+
+        # run_monitored also measures the tool process for the profile
+        runtime.cmdline = self.cmdline
+        runtime.environ.update(self._get_environ())
+        runtime.success_codes = (0,)
+        runtime = run_monitored(runtime, self._monitor)
+        if self._profile is not None:
+            self._profile.add_child(runtime.rusage)
+        if self._monitor is not None and self._monitor.abort_reason:
+            raise RuntimeError('%s stopped early: %s\nCommand:\n%s\nStandard error:\n%s'
+                               % (self._cmd, self._monitor.abort_reason, runtime.cmdline,
+                                  runtime.stderr))
+        return runtime
+
+    def _xmat_key(self):
+        lengths, tr = run_lengths(self.inputs.in_file)
+        ortvec = self.inputs.ortvec if isdefined(self.inputs.ortvec) else None
+        return design_key(self.inputs.stim_files, self.inputs.models,
+                          self.inputs.labels, lengths, tr,
+                          polort=self.inputs.polort, timing=self.inputs.timing,
+                          ortvec=ortvec, builder=self.inputs.xmat_builder,
+                          convolution=self.inputs.convolution)
+
+    def _design(self):
+        lengths, tr = run_lengths(self.inputs.in_file)
+        if not tr:
+            raise ValueError('Cannot read the TR from %s' % self.inputs.in_file[0])
+        ortvec = self.inputs.ortvec if isdefined(self.inputs.ortvec) else None
+        return build_design(self.inputs.stim_files, self.inputs.models,
+                            self.inputs.labels, lengths, tr,
+                            polort=self.inputs.polort, timing=self.inputs.timing,
+                            ortvec=ortvec, convolution=self.inputs.convolution)
+
+    def _diagnostics_mode(self):
+        if isdefined(self.inputs.diagnostics):
+            return self.inputs.diagnostics
+        return 'off' if self.inputs.engine == 'afni' else 'report'
+
+    def _preflight(self):
+        """Design diagnostics on the matrix built in Python, before AFNI
+        or the numpy engine load any data. Designs the Python builder
+        cannot build are only an error in 'fail' mode; in 'report' mode
+        they are logged and skipped."""
+        self._diagnostics = None
+        mode = self._diagnostics_mode()
+        if mode == 'off':
+            return
+        try:
+            X, info = self._design()
+        except Exception as exc:
+            if mode == 'fail':
+                raise
+            iflogger.warning('Design diagnostics skipped, the design could not be '
+                             'built in Python: %s: %s', type(exc).__name__, exc)
+            return
+        self._diagnostics = preflight(
+            X, info, mode=mode,
+            out_file=self._gen_filename('out_diagnostics'),
+            max_condition=self.inputs.max_condition,
+            max_correlation=self.inputs.max_correlation, max_vif=self.inputs.max_vif)
+
+    def _build_xmat(self):
+        X, info = self._design()
+        save_design(self._gen_filename('out_xmat'), X, info,
+                    command=self.cmdline.replace('\\\n', '').replace('\n', ''))
+
+    def _alternatives(self):
+        """Names and settings of the alternative models"""
+        allowed = set(['name', 'models', 'polort', 'stim_files', 'labels'])
+        alts = []
+        for k, alt in enumerate(self.inputs.alternatives):
+            unknown = set(alt) - allowed
+            if unknown:
+                raise ValueError('alternative %d: unknown keys %s' % (k + 1, sorted(unknown)))
+            name = alt.get('name', 'alt%d' % (k + 1))
+            if not re.match(r'^[\w.-]+$', name) or name in ('main', 'compare'):
+                raise ValueError('alternative %d: invalid name %r' % (k + 1, name))
+            alts.append((name, alt))
+        if len(set(name for name, _ in alts)) != len(alts):
+            raise ValueError('alternative names must be unique')
+        return alts
+
+    def _build_alternatives(self):
+        """Build and save the design matrix of every alternative model"""
+        lengths, tr = run_lengths(self.inputs.in_file)
+        ortvec = self.inputs.ortvec if isdefined(self.inputs.ortvec) else None
+        designs = []
+        for name, alt in self._alternatives():
+            X, info = build_design(alt.get('stim_files', self.inputs.stim_files),
+                                   alt.get('models', self.inputs.models),
+                                   alt.get('labels', self.inputs.labels), lengths, tr,
+                                   polort=alt.get('polort', self.inputs.polort),
+                                   timing=self.inputs.timing, ortvec=ortvec,
+                                   convolution=self.inputs.convolution)
+            save_design(self._alt_filename('out_xmat', name), X, info)
+            designs.append((name, X, info))
+        return designs
+
+    def _fit_numpy(self):
+        X, info = read_xmat(self._gen_filename('out_xmat'))
+        designs = [(None, X, info)]
+        if self.inputs.alternatives:
+            with phase(self._profile, 'matrix_setup'):
+                designs += self._build_alternatives()
+        with phase(self._profile, 'loading'):
+            Y, where = self._load_data()
+        if Y.shape[1] != X.shape[0]:
+            raise ValueError('Design matrix has %d rows but the input has %d volumes'
+                             % (X.shape[0], Y.shape[1]))
+
+        # every model is fitted from the one copy of the data
+        fits = []
+        for model, X, info in designs:
+            with blas_threads(self.inputs.num_threads), phase(self._profile, 'fitting'):
+                design = shared_design(X)
+                beta, sse = design.fit(Y)
+                bricks, names = self._bucket(design, info, beta, sse)
+            with phase(self._profile, 'output'):
+                self._save_bucket(bricks, names, where, model)
+            fits.append((model or 'main', sse, design.rank))
+            del beta, bricks
+
+        if len(fits) > 1:
+            bricks, names = fit_comparison(fits, Y.shape[1])
+            self._save_bucket(bricks, names, where, 'compare')
+
+    def _load_data(self):
+        """Voxels (or parcels) x time matrix, and where its rows go on output"""
+        mask = load_mask(self.inputs.mask) if isdefined(self.inputs.mask) else None
+        if isdefined(self.inputs.atlas):
+            Y, parcels = parcel_series(self.inputs.in_file, self.inputs.atlas, mask=mask)
+            return Y, {'parcels': parcels}
+        Y, shape, affine, header = load_series(self.inputs.in_file, mask=mask)
+        return Y, {'shape': shape, 'affine': affine, 'header': header, 'mask': mask}
+
+    def _bucket(self, design, info, beta, sse):
+        bricks, names = decon_bucket(design, info, beta, sse,
+                                     fout=bool(self.inputs.fout),
+                                     rout=bool(self.inputs.rout),
+                                     tout=bool(self.inputs.tout),
+                                     vout=bool(self.inputs.vout),
+                                     bout=bool(self.inputs.bout))
+        if not isdefined(self.inputs.glt):
+            return bricks, names
+        if len(self.inputs.glt) != len(self.inputs.glt_labels):
+            raise ValueError('glt and glt_labels must have the same length')
+        # all GLTs in one contrast matrix, after the stimulus sub-bricks
+        glts = GLTMatrix.from_sym(self.inputs.glt, self.inputs.glt_labels, info['ColumnLabels'])
+        gbricks, gnames = glts.bricks(beta, sse / design.dof, design.xtxinv, design.dof,
+                                      fout=bool(self.inputs.fout), rout=bool(self.inputs.rout))
+        return np.hstack([bricks, gbricks]), names + gnames
+
+    def _save_bucket(self, bricks, names, where, model=None):
+        """Save the bucket (or parcel table) of the main model or, by
+        name, of an alternative model"""
+        if 'parcels' in where:
+            fname = self._alt_filename('out_table', model) if model \
+                else self._gen_filename('out_table')
+            save_table(fname, bricks, names, where['parcels'])
+        else:
+            fname = self._alt_filename('out_file', model) if model \
+                else self._gen_filename('out_file')
+            save_bucket(fname, bricks, where['shape'], where['affine'], names,
+                        header=where['header'], mask=where['mask'])
 
     def _list_outputs(self):
         outputs = self.output_spec().get()
-        # outputs['out_file'] = 'hola.nii'
+        outputs['out_xmat'] = os.path.abspath(self._gen_filename('out_xmat'))
+        if not self.inputs.stop and not self.inputs.no_bucket:
+            if isdefined(self.inputs.atlas):
+                outputs['out_table'] = os.path.abspath(self._gen_filename('out_table'))
+            else:
+                outputs['out_file'] = os.path.abspath(self._gen_filename('out_file'))
+            if self.inputs.alternatives:
+                kind = 'out_table' if isdefined(self.inputs.atlas) else 'out_file'
+                alts = [name for name, _ in self._alternatives()]
+                outputs['out_alternatives'] = [
+                    os.path.abspath(self._alt_filename(kind, name)) for name in alts]
+                outputs['out_alt_xmats'] = [
+                    os.path.abspath(self._alt_filename('out_xmat', name)) for name in alts]
+                outputs['out_comparison'] = os.path.abspath(self._alt_filename(kind, 'compare'))
+        if self.inputs.profile:
+            outputs['out_profile'] = os.path.abspath(self._gen_filename('out_profile'))
+        if self._diagnostics is not None:
+            outputs['out_diagnostics'] = os.path.abspath(self._gen_filename('out_diagnostics'))
+        if self._monitor is not None:
+            summary = self._monitor.summary()
+            outputs['warnings'] = summary['warnings']
+            outputs['num_matrix_warnings'] = summary['num_matrix_warnings']
+            outputs['matrix_condition'] = summary['condition']
+        return outputs
+
+def fit_comparison(fits, nt):
+    """Sub-bricks comparing models fitted to the same data
+
+    ``fits`` holds (name, residual sum of squares per voxel, rank) of
+    each model. Returns the AIC of every model, n log(SSE/n) + 2k, and
+    the index (in fits) of the best model by AIC and by BIC,
+    n log(SSE/n) + k log(n).
+    """
+    sse = np.column_stack([f[1] for f in fits]).astype(np.float64)
+    rank = np.array([f[2] for f in fits], dtype=np.float64)
+    tiny = np.finfo(np.float64).tiny
+    loglik = nt * np.log(np.maximum(sse, tiny) / nt)
+    aic = loglik + 2 * rank
+    bic = loglik + rank * np.log(nt)
+    fitted = np.any(sse > 0, axis=1)
+    best_aic = np.where(fitted, np.argmin(aic, axis=1), 0)
+    best_bic = np.where(fitted, np.argmin(bic, axis=1), 0)
+    aic[~fitted] = 0
+    names = ['%s_AIC' % f[0] for f in fits] + ['best_AIC', 'best_BIC']
+    return np.column_stack([aic, best_aic, best_bic]), names
+
+
+def fit_shared_designs(interfaces, batch_size=8, work_dir=None):
+    """Run numpy-engine Decons, factorizing every distinct design once
+
+    Interfaces are grouped by their design (same stimulus timing
+    content, models, labels, run lengths, TR, polort, timing and
+    ortvec). For each group the design matrix is built once, by a
+    design-only run of the first member, and copied to the out_xmat of
+    the others. The data of up to ``batch_size`` subjects is then
+    stacked into one (subjects x voxels) x time matrix and fitted with a
+    single multiply by the shared pseudo-inverse.
+
+    Outputs are written to their basenames in the current directory, so
+    each interface runs in its own directory, ``work_dir/job0000`` and
+    on (``work_dir`` defaults to the current directory), with its input
+    paths made absolute. A ValueError is raised before anything is
+    fitted if an interface does not use the numpy engine, or if two
+    interfaces would write the same file. Returns the outputs of every
+    interface, in order.
+
+    A single Decon run already reuses the factorization of a design it
+    has seen in this process (see ``glmengine.shared_design``); this
+    function adds the stacking of several subjects' data into one fit.
+    """
+    dirs = job_dirs(os.getcwd() if work_dir is None else work_dir, len(interfaces))
+    interfaces = [Decon(**abs_inputs(decon.inputs.get_traitsfree())) for decon in interfaces]
+    groups = {}
+    paths = []
+    for k, (decon, cwd) in enumerate(zip(interfaces, dirs)):
+        if decon.inputs.engine != 'numpy':
+            raise ValueError('interface %d uses the %s engine; only numpy fits can share '
+                             'a design' % (k, decon.inputs.engine))
+        if decon.inputs.alternatives:
+            raise ValueError('interface %d has alternatives; run it on its own' % k)
+        if decon.inputs.check_inputs:
+            decon._check_inputs()
+        with working_directory(cwd):
+            paths.append(output_paths(decon))
+        groups.setdefault(decon._xmat_key(), []).append(k)
+    check_collisions(paths)
+
+    for members in groups.values():
+        first = interfaces[members[0]]
+        inputs = first.inputs.get_traitsfree()
+        inputs.update(stop=True, check_inputs=False, profile=False)
+        xmat = Decon(**inputs).run(cwd=dirs[members[0]]).outputs.out_xmat
+        for k in members[1:]:
+            dest = os.path.join(dirs[k], interfaces[k]._gen_filename('out_xmat'))
+            shutil.copyfile(xmat, dest)
+
+        X, info = read_xmat(xmat)
+        design = shared_design(X)
+        for start in range(0, len(members), batch_size):
+            batch = members[start:start + batch_size]
+            loaded = [interfaces[k]._load_data() for k in batch]
+            for k, (Y, _) in zip(batch, loaded):
+                if Y.shape[1] != X.shape[0]:
+                    raise ValueError('Design matrix has %d rows but %s has %d volumes'
+                                     % (X.shape[0], interfaces[k].inputs.in_file, Y.shape[1]))
+            bounds = np.cumsum([0] + [Y.shape[0] for Y, _ in loaded])
+            wheres = [where for _, where in loaded]
+            Y = np.vstack([Y for Y, _ in loaded])
+            del loaded[:]
+            with blas_threads(first.inputs.num_threads):
+                beta, sse = design.fit(Y)
+            del Y
+            for k, where, b0, b1 in zip(batch, wheres, bounds[:-1], bounds[1:]):
+                decon = interfaces[k]
+                bricks, names = decon._bucket(design, info, beta[b0:b1], sse[b0:b1])
+                with working_directory(dirs[k]):
+                    decon._save_bucket(bricks, names, where)
+
+    outputs = []
+    for decon, cwd in zip(interfaces, dirs):
+        with working_directory(cwd):
+            outputs.append(decon._list_outputs())
+    return outputs
+
 
 # command to output
\ No newline at end of file
@@ -0,0 +1,147 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range, str
+
+import warnings
+
+import numpy as np
+
+from afniio import write_xmat, dataset_info
+from hrfbasis import model_ncols, regressors
+from stimtimes import read_stim_times
+
+
+# -------------------------------------------------------------------------
+# Stimulus timing files
+# -------------------------------------------------------------------------
+
+def check_design_inputs(in_files, stim_files, models, labels, num_stimts,
+                        timing='local'):
+    """Reject inconsistent 3dDeconvolve inputs before anything is launched
+
+    Only headers and timing files are read. Checks that num_stimts
+    matches the stim_files/models/labels lists, that all runs share one
+    grid and a TR and that local timing files have one line per run,
+    raising ValueError otherwise. Onsets outside their run only give a
+    warning: 3dDeconvolve ignores them too, and truncated runs are
+    common. Returns the run lengths and TR.
+    """
+    if num_stimts != len(stim_files):
+        raise ValueError('num_stimts is %d but %d stim_files were given'
+                         % (num_stimts, len(stim_files)))
+    if not len(stim_files) == len(models) == len(labels):
+        raise ValueError('stim_files (%d), models (%d) and labels (%d) must have '
+                         'the same length' % (len(stim_files), len(models), len(labels)))
+
+    infos = [dataset_info(f) for f in in_files]
+    for fname, info in zip(in_files[1:], infos[1:]):
+        if info['shape'] != infos[0]['shape']:
+            raise ValueError('%s has grid %s but %s has %s' % (
+                fname, info['shape'], in_files[0], infos[0]['shape']))
+    tr = infos[0]['tr']
+    if not tr:
+        raise ValueError('%s has no TR in its header' % in_files[0])
+    lengths = [i['nvols'] for i in infos]
+
+    for fname in stim_files:
+        if timing == 'global':
+            onsets = read_stim_times(fname, timing)[0][0]
+            bad = (onsets < 0) | (onsets >= sum(lengths) * tr)
+            if np.any(bad):
+                warnings.warn('%s has onsets outside [0, %gs), which are ignored: %s'
+                              % (fname, sum(lengths) * tr, onsets[bad]))
+            continue
+        runs = read_stim_times(fname, timing, lengths, tr)
+        for r, ((onsets, _), n) in enumerate(zip(runs, lengths)):
+            bad = (onsets < 0) | (onsets >= n * tr)
+            if np.any(bad):
+                warnings.warn('%s: run %d has onsets outside [0, %gs), which are '
+                              'ignored: %s' % (fname, r + 1, n * tr, onsets[bad]))
+    return lengths, tr
+
+
+# -------------------------------------------------------------------------
+# Design matrix
+# -------------------------------------------------------------------------
+
+def polort_order(polort, run_length, tr):
+    """Resolve polort 'A' as 3dDeconvolve does: 1 + floor(duration/150s)"""
+    if polort == 'A':
+        return 1 + int(np.floor(run_length * tr / 150.0))
+    return int(polort)
+
+
+def _legendre(order, n):
+    x = np.linspace(-1, 1, n)
+    return np.polynomial.legendre.legvander(x, order)
+
+
+def build_design(stim_files, models, labels, run_lengths, tr, polort='A',
+                 timing='local', ortvec=None, convolution='direct'):
+    """Build a 3dDeconvolve design matrix without running 3dDeconvolve
+
+    ``convolution`` is the method of hrfbasis.regressors ('direct' or
+    'fft'). Returns the matrix and a dict with the .xmat.1D header
+    information (ColumnLabels, ColumnGroups, RunStart, RowTR, StimLabels).
+    """
+    if not len(stim_files) == len(models) == len(labels):
+        raise ValueError('stim_files, models and labels must have the same length')
+
+    run_lengths = [int(n) for n in run_lengths]
+    ntotal = sum(run_lengths)
+    run_starts = np.concatenate([[0], np.cumsum(run_lengths)[:-1]]).astype(int)
+
+    columns = []
+    col_labels = []
+    groups = []
+
+    # Baseline: Legendre polynomials, one set per run
+    for r, (start, n) in enumerate(zip(run_starts, run_lengths)):
+        order = polort_order(polort, n, tr)
+        if order < 0:
+            continue
+        base = np.zeros((ntotal, order + 1))
+        base[start:start + n] = _legendre(order, n)
+        columns.append(base)
+        col_labels += ['Run#%dPol#%d' % (r + 1, k) for k in range(order + 1)]
+        groups += [-1] * (order + 1)
+
+    if ortvec is not None:
+        ort = np.loadtxt(ortvec, ndmin=2)
+        if ort.shape[0] != ntotal:
+            ort = ort.T
+        if ort.shape[0] != ntotal:
+            raise ValueError('ortvec %s does not have %d rows' % (ortvec, ntotal))
+        columns.append(ort)
+        col_labels += ['ortvec[%d]' % k for k in range(ort.shape[1])]
+        groups += [0] * ort.shape[1]
+
+    for k, (fname, model, label) in enumerate(zip(stim_files, models, labels)):
+        runs = read_stim_times(fname, timing, run_lengths, tr)
+        ncols = model_ncols(model)
+        reg = np.zeros((ntotal, ncols))
+        for (onsets, durs), start, n in zip(runs, run_starts, run_lengths):
+            # as 3dDeconvolve, ignore onsets outside their run
+            keep = (onsets >= 0) & (onsets < n * tr)
+            if np.any(keep):
+                reg[start:start + n] = regressors(model, onsets[keep], durs[keep], n, tr,
+                                                  convolution)
+        columns.append(reg)
+        col_labels += ['%s#%d' % (label, j) for j in range(ncols)]
+        groups += [k + 1] * ncols
+
+    X = np.column_stack(columns) if columns else np.zeros((ntotal, 0))
+    info = {
+        'ColumnLabels': col_labels,
+        'ColumnGroups': groups,
+        'RunStart': list(run_starts),
+        'RowTR': float(tr),
+        'StimLabels': list(labels),
+    }
+    return X, info
+
+
+def save_design(fname, X, info, command=None):
+    """Write the output of build_design as an .xmat.1D file"""
+    return write_xmat(fname, X, info['ColumnLabels'], info['ColumnGroups'],
+                      info['RowTR'], info['RunStart'],
+                      stim_labels=info.get('StimLabels'), command=command)
@@ -0,0 +1,91 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range, str
+
+import json
+
+import numpy as np
+
+
+def _condition(A):
+    if not A.shape[1]:
+        return None
+    s = np.linalg.svd(A, compute_uv=False)
+    return float(s[0] / s[-1]) if s[-1] > 0 else float('inf')
+
+
+def design_diagnostics(X, info, max_condition=1000.0, max_correlation=0.9, max_vif=10.0):
+    """Conditioning of a design matrix, before any data is loaded
+
+    Condition numbers are those of the unit-norm columns, for the whole
+    matrix and for its signal and baseline parts (the [X], [Xsignal]
+    and [Xbaseline] of 3dDeconvolve). Pairwise correlations and
+    variance-inflation factors are computed among the signal regressors
+    after projecting out the baseline (polynomials and ortvec), so
+    regressors only look collinear when they are so within runs.
+    Returns a dict; its 'problems' list is empty for a usable design.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    labels = list(info['ColumnLabels'])
+    signal = np.asarray(info['ColumnGroups']) > 0
+    problems = []
+
+    norms = np.linalg.norm(X, axis=0)
+    zero = norms <= 1e-12 * max(norms.max(), 1.0)
+    for j in np.flatnonzero(zero):
+        problems.append('regressor %s is all zero' % labels[j])
+    Xn = X[:, ~zero] / norms[~zero]
+    condition = {
+        'X': _condition(Xn),
+        'Xsignal': _condition(Xn[:, signal[~zero]]),
+        'Xbaseline': _condition(Xn[:, ~signal[~zero]]),
+    }
+    if condition['X'] > max_condition:
+        problems.append('condition number of X is %.4g (limit %g)'
+                        % (condition['X'], max_condition))
+
+    cols = np.flatnonzero(signal & ~zero)
+    S = X[:, cols]
+    B = X[:, ~signal]
+    if B.shape[1]:
+        S = S - np.dot(B, np.dot(np.linalg.pinv(B), S))
+    snorm = np.linalg.norm(S, axis=0)
+    inbase = snorm <= 1e-8 * norms[cols]
+    for j in cols[inbase]:
+        problems.append('regressor %s is explained by the baseline' % labels[j])
+    cols, S = cols[~inbase], S[:, ~inbase] / snorm[~inbase]
+
+    R = np.dot(S.T, S)
+    iu = np.triu_indices(len(cols), 1)
+    high = np.flatnonzero(np.abs(R[iu]) > max_correlation)
+    correlations = [(labels[cols[iu[0][k]]], labels[cols[iu[1][k]]], float(R[iu][k]))
+                    for k in high]
+    for a, b, r in correlations:
+        problems.append('regressors %s and %s are correlated (r = %.3f)' % (a, b, r))
+
+    try:
+        vif = np.diag(np.linalg.inv(R)) if len(cols) else np.zeros(0)
+    except np.linalg.LinAlgError:
+        vif = np.full(len(cols), np.inf)
+    vif = dict((labels[j], float(v)) for j, v in zip(cols, vif))
+    for name, v in vif.items():
+        if v > max_vif:
+            problems.append('variance inflation of %s is %.3g (limit %g)' % (name, v, max_vif))
+
+    return {
+        'condition': condition,
+        'correlations': correlations,
+        'vif': vif,
+        'problems': problems,
+    }
+
+
+def preflight(X, info, mode='report', out_file=None, **limits):
+    """Run design_diagnostics, save the report as JSON and, in 'fail'
+    mode, raise ValueError when the design has problems"""
+    report = design_diagnostics(X, info, **limits)
+    if out_file is not None:
+        with open(out_file, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    if mode == 'fail' and report['problems']:
+        raise ValueError('Ill-conditioned design matrix:\n  ' + '\n  '.join(report['problems']))
+    return report
@@ -0,0 +1,183 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from afniio import stim_columns
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+class _NoLimit(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def blas_threads(num_threads):
+    """Limit the BLAS/OpenMP threads used by numpy inside a with block
+
+    Needs threadpoolctl; without it the limit is not applied.
+    """
+    if threadpool_limits is None or num_threads is None:
+        return _NoLimit()
+    return threadpool_limits(limits=num_threads)
+
+
+class OLSDesign(object):
+    """Factorization of a design matrix, computed once and applied to any
+    number of voxels
+
+    The pseudo-inverse is used (as 3dDeconvolve does) so collinear
+    designs still give the minimum-norm solution.
+    """
+
+    def __init__(self, X):
+        self.X = np.asarray(X, dtype=np.float64)
+        self.nt, self.p = self.X.shape
+        self.pinv = np.linalg.pinv(self.X)
+        self.xtxinv = np.dot(self.pinv, self.pinv.T)
+        self.rank = np.linalg.matrix_rank(self.X)
+        self.dof = self.nt - self.rank
+
+    def fit(self, Y, chunk_size=20000):
+        """Fit voxels x time data
+
+        Returns the betas (voxels x regressors) and the residual sum of
+        squares per voxel. Voxels are processed in chunks, so the
+        residual matrix never holds more than ``chunk_size`` rows.
+        """
+        Y = np.asarray(Y)
+        nvox = Y.shape[0]
+        beta = np.empty((nvox, self.p), dtype=np.float64)
+        sse = np.empty(nvox, dtype=np.float64)
+        for start in range(0, nvox, chunk_size):
+            stop = min(start + chunk_size, nvox)
+            y = Y[start:stop].astype(np.float64)
+            b = np.dot(y, self.pinv.T)
+            res = y - np.dot(b, self.X.T)
+            beta[start:stop] = b
+            sse[start:stop] = np.einsum('ij,ij->i', res, res)
+        return beta, sse
+
+
+_SHARED = OrderedDict()
+
+
+def shared_design(X, cache_size=16):
+    """OLSDesign of X, reused for byte-identical matrices
+
+    Subjects with the same timing get the same design matrix, so the
+    factorization is kept (for the ``cache_size`` most recent designs)
+    and computed once per process instead of once per subject.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    key = hashlib.sha1(X.tobytes() + str(X.shape).encode()).hexdigest()
+    if key in _SHARED:
+        _SHARED[key] = _SHARED.pop(key)
+        return _SHARED[key]
+    design = OLSDesign(X)
+    _SHARED[key] = design
+    while len(_SHARED) > cache_size:
+        _SHARED.popitem(last=False)
+    return design
+
+
+def contrast_stats(beta, sigma2, xtxinv, C):
+    """Estimates, t and F statistics of the rows of C for every voxel
+
+    ``xtxinv`` is the unscaled covariance of the estimates, either one
+    (p x p) matrix shared by all voxels or a (voxels x p x p) stack.
+    Returns estimates (voxels x q), t (voxels x q) and F (voxels).
+    """
+    C = np.atleast_2d(np.asarray(C, dtype=np.float64))
+    q = C.shape[0]
+    est = np.dot(beta, C.T)
+    if xtxinv.ndim == 2:
+        ccov = np.dot(np.dot(C, xtxinv), C.T)
+        scale = np.diag(ccov)[None, :]
+        ccov_inv = np.linalg.pinv(ccov)
+        quad = np.einsum('vi,ij,vj->v', est, ccov_inv, est)
+    else:
+        ccov = np.einsum('ij,vjk,lk->vil', C, xtxinv, C)
+        scale = np.einsum('vii->vi', ccov)
+        ccov_inv = np.linalg.pinv(ccov)
+        quad = np.einsum('vi,vij,vj->v', est, ccov_inv, est)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se = np.sqrt(sigma2[:, None] * scale)
+        t = np.where(se > 0, est / se, 0.0)
+        F = np.where(sigma2 > 0, quad / (q * sigma2), 0.0)
+    return est, t, F
+
+
+def decon_bucket(design, info, beta, sse, fout=False, rout=False, tout=False,
+                 vout=False, bout=False):
+    """Assemble the sub-bricks of a 3dDeconvolve -bucket
+
+    Sub-brick order and labels follow 3dDeconvolve: optional baseline
+    coefficients, the full-model statistics, then for each stimulus its
+    coefficients (and t-statistics), R^2 and F-statistic.
+    """
+    return stat_bricks(design.xtxinv, design.dof, info, beta, sse / design.dof,
+                       fout=fout, rout=rout, tout=tout, vout=vout, bout=bout)
+
+
+def stat_bricks(xtxinv, dof, info, beta, sigma2, fout=False, rout=False,
+                tout=False, vout=False, bout=False):
+    """Statistics sub-bricks for voxels sharing one (p x p) covariance
+
+    Used by decon_bucket, and by the REML engine once per group of
+    voxels with the same noise model.
+    """
+    labels = info['ColumnLabels']
+    groups = np.asarray(info['ColumnGroups'])
+    p = len(groups)
+
+    bricks = []
+    names = []
+
+    def add(name, value):
+        names.append(name)
+        bricks.append(np.asarray(value, dtype=np.float32))
+
+    if vout:
+        add('Full_MSE', sigma2)
+
+    if bout:
+        for col in np.flatnonzero(groups <= 0):
+            add('%s_Coef' % labels[col], beta[:, col])
+            if tout:
+                _, t, _ = contrast_stats(beta, sigma2, xtxinv, np.eye(p)[col])
+                add('%s_Tstat' % labels[col], t[:, 0])
+
+    stim_cols = np.flatnonzero(groups > 0)
+    if len(stim_cols):
+        _, _, F = contrast_stats(beta, sigma2, xtxinv, np.eye(p)[stim_cols])
+        q = len(stim_cols)
+        if rout:
+            add('Full_R^2', q * F / (q * F + dof))
+        add('Full_Fstat', F)
+
+    for name, cols in stim_columns(info):
+        C = np.eye(p)[cols]
+        est, t, F = contrast_stats(beta, sigma2, xtxinv, C)
+        for k in range(len(cols)):
+            add('%s#%d_Coef' % (name, k), est[:, k])
+            if tout:
+                add('%s#%d_Tstat' % (name, k), t[:, k])
+        if rout:
+            q = len(cols)
+            add('%s_R^2' % name, q * F / (q * F + dof))
+        if fout:
+            add('%s_Fstat' % name, F)
+
+    return np.column_stack(bricks), names
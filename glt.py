@@ -0,0 +1,160 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import object, range, str
+
+import re
+import numpy as np
+
+
+_TERM = re.compile(r'''
+    \s*(?P<sign>[+-]?)\s*
+    (?:(?P<weight>\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+)\s*\*\s*)?
+    (?P<name>[^\s\[+*-]+)
+    (?:\[(?P<double>\[)?(?P<lo>\d+)(?:\.\.(?P<hi>\d+))?\]\]?)?
+    ''', re.VERBOSE)
+
+
+def _column_map(column_labels):
+    """Map stimulus names and exact column labels to column indices"""
+    names = {}
+    for i, label in enumerate(column_labels):
+        names.setdefault(label, []).append(i)
+        if '#' in label and not label.startswith('Run#'):
+            names.setdefault(label.rsplit('#', 1)[0], []).append(i)
+    return names
+
+
+def parse_sym(sym, column_labels):
+    """Contrast matrix of an AFNI symbolic GLT
+
+    Understands the -gltsym syntax: terms such as '+vis', '-0.5*aud',
+    'ten[2]', 'ten[1..3]' (sum of coefficients 1 to 3) and 'ten[[1..3]]'
+    (one row per coefficient), with rows separated by '\\'. A name
+    without index refers to all columns of that stimulus. Returns a
+    (rows x columns) array.
+    """
+    sym = re.sub(r'^\s*SYM:\s*', '', sym)
+    names = _column_map(column_labels)
+    ncol = len(column_labels)
+    rows = []
+    for part in sym.split('\\'):
+        part = part.strip()
+        if not part:
+            continue
+        row = np.zeros(ncol)
+        extra = []
+        pos = 0
+        while pos < len(part):
+            m = _TERM.match(part, pos)
+            if not m or m.end() == pos:
+                raise ValueError('Cannot parse GLT %r near %r' % (sym, part[pos:]))
+            pos = m.end()
+            if not m.group('name'):
+                continue
+            name = m.group('name')
+            if name not in names:
+                raise ValueError('GLT %r refers to unknown label %r' % (sym, name))
+            cols = names[name]
+            if m.group('lo') is not None:
+                lo = int(m.group('lo'))
+                hi = int(m.group('hi')) if m.group('hi') is not None else lo
+                if hi >= len(cols):
+                    raise ValueError('GLT %r: %s has only %d coefficients'
+                                     % (sym, name, len(cols)))
+                cols = cols[lo:hi + 1]
+            weight = float(m.group('weight')) if m.group('weight') else 1.0
+            if m.group('sign') == '-':
+                weight = -weight
+            if m.group('double'):
+                for c in cols:
+                    r = np.zeros(ncol)
+                    r[c] = weight
+                    extra.append(r)
+            else:
+                row[cols] += weight
+        if np.any(row):
+            rows.append(row)
+        rows.extend(extra)
+    if not rows:
+        raise ValueError('GLT %r is empty' % sym)
+    return np.array(rows)
+
+
+class GLTMatrix(object):
+    """Many GLTs compiled into one contrast matrix
+
+    The rows of every GLT are stacked, so the estimates of all GLTs come
+    from one (voxels x p) by (p x rows) product and their variances from
+    the diagonal of one C (X'X)^-1 C'. For the F-statistics, the
+    covariances of all multi-row GLTs of one size are pseudo-inverted in
+    one stacked call and applied with one batched product.
+
+    Sub-bricks are labelled as in 3dDeconvolve/3dREMLfit. For each GLT
+    in turn: label_GLT#k_Coef and label_GLT#k_Tstat for every row k,
+    then label_GLT_R^2 (with rout) and label_GLT_Fstat (with fout) of
+    the whole GLT.
+    """
+
+    def __init__(self, glts):
+        """``glts`` is a list of (label, C) pairs, C as from parse_sym"""
+        self.labels = [label for label, _ in glts]
+        self.C = np.vstack([np.atleast_2d(C) for _, C in glts])
+        sizes = [np.atleast_2d(C).shape[0] for _, C in glts]
+        self.starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(int)
+        self.sizes = np.array(sizes, dtype=int)
+        # multi-row GLTs grouped by size: their indices and (GLTs x n) rows
+        self.blocks = []
+        for n in np.unique(self.sizes[self.sizes > 1]):
+            glts = np.flatnonzero(self.sizes == n)
+            self.blocks.append((glts, self.starts[glts][:, None] + np.arange(n)))
+
+    @classmethod
+    def from_sym(cls, syms, labels, column_labels):
+        return cls([(label, parse_sym(sym, column_labels)) for sym, label in zip(syms, labels)])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _layout(self, fout, rout):
+        """Output column of every estimate, t, R^2 and F, and the labels"""
+        coef, tstat, r2, fstat, names = [], [], [], [], []
+        for label, n in zip(self.labels, self.sizes):
+            for k in range(n):
+                coef.append(len(names))
+                tstat.append(len(names) + 1)
+                names += ['%s_GLT#%d_Coef' % (label, k), '%s_GLT#%d_Tstat' % (label, k)]
+            if rout:
+                r2.append(len(names))
+                names.append('%s_GLT_R^2' % label)
+            if fout:
+                fstat.append(len(names))
+                names.append('%s_GLT_Fstat' % label)
+        return coef, tstat, r2, fstat, names
+
+    def bricks(self, beta, sigma2, xtxinv, dof, fout=True, rout=False):
+        """GLT sub-bricks of voxels sharing one (p x p) xtxinv"""
+        est = np.dot(beta, self.C.T)
+        ccov = np.dot(np.dot(self.C, xtxinv), self.C.T)
+        scale = np.diag(ccov)
+        with np.errstate(divide='ignore'):
+            rsd = np.where(sigma2 > 0, 1.0 / np.sqrt(sigma2), 0.0)
+            rscale = np.where(scale > 0, 1.0 / np.sqrt(scale), 0.0)
+        t = est * rsd[:, None] * rscale[None, :]
+
+        # F of a one-row GLT is t^2; the others need their inverse covariance
+        F = t[:, self.starts] ** 2
+        for glts, idx in self.blocks:
+            winv = np.linalg.pinv(ccov[idx[:, :, None], idx[:, None, :]])
+            sub = est[:, idx].transpose(1, 0, 2)
+            quad = np.einsum('gvi,gvi->vg', np.matmul(sub, winv), sub)
+            F[:, glts] = quad * (rsd ** 2)[:, None] / idx.shape[1]
+
+        # filled brick by brick (rows), returned as voxels x bricks
+        coef, tstat, r2, fstat, names = self._layout(fout, rout)
+        out = np.empty((len(names), est.shape[0]), dtype=np.float32)
+        out[coef] = est.T
+        out[tstat] = t.T
+        if rout:
+            out[r2] = (self.sizes * F / (self.sizes * F + dof)).T
+        if fout:
+            out[fstat] = F.T
+        return out.T, names
@@ -0,0 +1,120 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range, str, bytes
+
+import os
+import numpy as np
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, TraitedSpec,
+                                    traits, File)
+
+from afniio import read_xmat, load_bucket, save_bucket
+from glt import GLTMatrix
+from remlengine import REMLEngine
+
+
+class GLTfitInputSpec(BaseInterfaceInputSpec):
+    beta_file = File(
+        desc='Rbeta dataset written by REMLfit (out_beta)',
+        exists=True,
+        mandatory=True
+    )
+
+    var_file = File(
+        desc='Rvar dataset written by REMLfit (out_var)',
+        exists=True,
+        mandatory=True
+    )
+
+    matrix = File(
+        desc='design matrix (.xmat.1D) the betas were estimated with',
+        exists=True,
+        mandatory=True
+    )
+
+    glt = traits.List(
+        traits.Str,
+        desc='symbolic GLTs, as for REMLfit (\'SYM: \' prefix optional)',
+        mandatory=True,
+        minlen=1
+    )
+
+    labels = traits.List(
+        traits.Str,
+        desc='List of labels for the GLTs. Must be sorted as in glt',
+        mandatory=True,
+        minlen=1
+    )
+
+    max_a = traits.Float(0.8, desc='-MAXa used for the fit', usedefault=True)
+    max_b = traits.Float(0.8, desc='-MAXb used for the fit', usedefault=True)
+    grid = traits.Int(3, desc='-Grid used for the fit', usedefault=True)
+
+    fout = traits.Bool(True, desc='output the F-statistic of each GLT', usedefault=True)
+    rout = traits.Bool(desc='output the R^2 of each GLT')
+
+    out_file = File('GLT.nii.gz',
+                    desc='name of output bucket',
+                    usedefault=True
+                    )
+
+
+class GLTfitOutputSpec(TraitedSpec):
+    out_file = File(
+        desc='GLT estimates and statistics',
+        exists=True
+    )
+
+
+class GLTfit(BaseInterface):
+    """Evaluate new GLTs from a finished REMLfit without refitting
+
+    The ARMA(1,1) parameters in the Rvar dataset identify the noise model
+    of every voxel, so the GLS covariance of the betas is rebuilt once
+    per (a,b) grid point and applied to all voxels that share it.
+    """
+
+    input_spec = GLTfitInputSpec
+    output_spec = GLTfitOutputSpec
+
+    def _run_interface(self, runtime):
+        if len(self.inputs.glt) != len(self.inputs.labels):
+            raise ValueError('glt and labels must have the same length')
+
+        X, info = read_xmat(self.inputs.matrix)
+        glts = GLTMatrix.from_sym(self.inputs.glt, self.inputs.labels, info['ColumnLabels'])
+
+        beta, _, shape, affine = load_bucket(self.inputs.beta_file)
+        var, var_labels, _, _ = load_bucket(self.inputs.var_file)
+        if beta.shape[1] != X.shape[1]:
+            raise ValueError('%s has %d sub-bricks but the matrix has %d columns'
+                             % (self.inputs.beta_file, beta.shape[1], X.shape[1]))
+        col = dict((name, k) for k, name in enumerate(var_labels or
+                                                     ['a', 'b', 'lam', 'StDev', '-LogLik']))
+        a, b = var[:, col['a']], var[:, col['b']]
+        sigma2 = var[:, col['StDev']].astype(np.float64) ** 2
+
+        engine = REMLEngine(X, info['RunStart'], max_a=self.inputs.max_a,
+                            max_b=self.inputs.max_b, grid=self.inputs.grid)
+        cells = engine.quantize(a, b)
+        inside = np.flatnonzero(sigma2 > 0)
+
+        bucket = names = None
+        for c, idx in engine.groups(cells[inside]):
+            idx = inside[idx]
+            cell = engine.cell(c)
+            bricks, names = glts.bricks(beta[idx].astype(np.float64), sigma2[idx],
+                                        cell.xtxinv, cell.dof, fout=self.inputs.fout,
+                                        rout=bool(self.inputs.rout))
+            if bucket is None:
+                bucket = np.zeros((beta.shape[0], bricks.shape[1]), dtype=np.float32)
+            bucket[idx] = bricks
+
+        if bucket is None:
+            raise ValueError('%s has no voxel with a positive StDev' % self.inputs.var_file)
+        save_bucket(self._list_outputs()['out_file'], bucket, shape, affine, names)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+        return outputs
@@ -0,0 +1,76 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import str
+
+import os
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, TraitedSpec,
+                                    traits, File, Directory, InputMultiPath, isdefined)
+
+from betastore import BetaStore
+
+
+class GroupBetasInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(
+        File(exists=True),
+        desc='one bucket per subject: out_beta of REMLfit or out_file of Decon',
+        mandatory=True
+    )
+
+    subjects = traits.List(
+        traits.Str,
+        desc='subject IDs, sorted as in_files',
+        mandatory=True
+    )
+
+    labels = traits.List(
+        traits.Str,
+        desc='labels of the sub-bricks to store (all sub-bricks of the first bucket '
+             'by default)'
+    )
+
+    mask = File(
+        desc='group mask; only its voxels are stored',
+        exists=True
+    )
+
+    out_dir = Directory('betastore',
+                        desc='directory of the store',
+                        usedefault=True
+                        )
+
+
+class GroupBetasOutputSpec(TraitedSpec):
+    out_dir = Directory(
+        desc='beta store, to open with betastore.BetaStore',
+        exists=True
+    )
+
+    out_index = File(
+        desc='index of the store (subjects, regressor labels, grid)',
+        exists=True
+    )
+
+
+class GroupBetas(BaseInterface):
+    """Collect first-level sub-bricks of many subjects into one
+    memory-mapped store (subjects x in-mask voxels x regressors)
+
+    Group analyses then open the store instead of decompressing every
+    subject's bucket on every run.
+    """
+
+    input_spec = GroupBetasInputSpec
+    output_spec = GroupBetasOutputSpec
+
+    def _run_interface(self, runtime):
+        BetaStore.create(self._list_outputs()['out_dir'], self.inputs.in_files,
+                         self.inputs.subjects,
+                         labels=self.inputs.labels if isdefined(self.inputs.labels) else None,
+                         mask=self.inputs.mask if isdefined(self.inputs.mask) else None)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_dir'] = os.path.abspath(self.inputs.out_dir)
+        outputs['out_index'] = os.path.join(outputs['out_dir'], 'index.json')
+        return outputs
@@ -0,0 +1,138 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range
+
+import numpy as np
+
+
+def _safe_t(est, se):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(se > 0, est / np.where(se > 0, se, 1.0), 0.0)
+
+
+def ttest_one(y):
+    """One-sample t-test of subjects x voxels data against zero
+
+    Returns the mean, t (n - 1 degrees of freedom) and the dof. A paired
+    test is the one-sample test of the differences.
+    """
+    n = y.shape[0]
+    mean = y.mean(axis=0)
+    se = y.std(axis=0, ddof=1) / np.sqrt(n)
+    return mean, _safe_t(mean, se), n - 1
+
+
+def ttest_two(ya, yb, pooled=True):
+    """Two-sample t-test of set A minus set B, each subjects x voxels
+
+    With ``pooled`` the variance is shared by the sets (n_a + n_b - 2
+    dof, as 3dttest++); otherwise Welch's test, whose dof is returned per
+    voxel.
+    """
+    na, nb = ya.shape[0], yb.shape[0]
+    diff = ya.mean(axis=0) - yb.mean(axis=0)
+    va, vb = ya.var(axis=0, ddof=1), yb.var(axis=0, ddof=1)
+    if pooled:
+        dof = na + nb - 2
+        se = np.sqrt(((na - 1) * va + (nb - 1) * vb) / dof * (1.0 / na + 1.0 / nb))
+        return diff, _safe_t(diff, se), dof
+    sa, sb = va / na, vb / nb
+    se = np.sqrt(sa + sb)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dof = (sa + sb) ** 2 / (sa ** 2 / (na - 1) + sb ** 2 / (nb - 1))
+    return diff, _safe_t(diff, se), np.nan_to_num(dof)
+
+
+def beta_variance(beta, tstat):
+    """Sampling variance of first-level estimates from their t-statistics,
+    (beta / t)^2, as 3dMEMA derives it; infinite (zero weight) where t is 0"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(tstat != 0, (beta / np.where(tstat != 0, tstat, 1.0)) ** 2, np.inf)
+
+
+def _mema(y, v, max_iter, tol):
+    y = np.asarray(y, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    n = y.shape[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = 1.0 / v
+        sw = w.sum(axis=0)
+        mu = (w * y).sum(axis=0) / sw
+        q = (w * (y - mu) ** 2).sum(axis=0)
+        tau2 = (q - (n - 1)) / (sw - (w ** 2).sum(axis=0) / sw)
+        tau2 = np.maximum(np.nan_to_num(tau2), 0.0)
+
+        active = np.ones(y.shape[1], dtype=bool)
+        for _ in range(max_iter):
+            if not active.any():
+                break
+            ya, va, ta = y[:, active], v[:, active], tau2[active]
+            w = 1.0 / (va + ta)
+            sw = w.sum(axis=0)
+            sw2 = (w ** 2).sum(axis=0)
+            mu = (w * ya).sum(axis=0) / sw
+            score = ((w * (ya - mu)) ** 2).sum(axis=0) - sw + sw2 / sw
+            info = sw2 - 2 * (w ** 3).sum(axis=0) / sw + (sw2 / sw) ** 2
+            step = np.where(info > 0, score / np.where(info > 0, info, 1.0), 0.0)
+            new = np.maximum(np.nan_to_num(ta + step), 0.0)
+            done = np.abs(new - ta) <= tol * np.maximum(ta, 1e-12)
+            tau2[active] = new
+            active[np.flatnonzero(active)[done]] = False
+
+        w = 1.0 / (v + tau2)
+        sw = w.sum(axis=0)
+        mu = np.where(sw > 0, (w * y).sum(axis=0) / sw, 0.0)
+        se = np.where(sw > 0, 1.0 / np.sqrt(sw), 0.0)
+    return np.nan_to_num(mu), np.nan_to_num(se), tau2
+
+
+def mema_one(y, v, max_iter=50, tol=1e-8):
+    """Random-effects mean of subjects x voxels estimates y with known
+    sampling variances v (3dMEMA one-sample model)
+
+    Each subject is weighted by 1 / (v + tau2), where the between-subject
+    variance tau2 is estimated per voxel by REML: Fisher scoring started
+    from the DerSimonian-Laird estimate, run on all voxels of the chunk
+    at once. Returns the mean, t (n - 1 dof), tau2 and the dof.
+    """
+    mu, se, tau2 = _mema(y, v, max_iter, tol)
+    return mu, _safe_t(mu, se), tau2, y.shape[0] - 1
+
+
+def mema_two(ya, va, yb, vb, max_iter=50, tol=1e-8):
+    """Set A minus set B with a separate between-subject variance per set
+    (3dMEMA two-sample model). Returns the difference, t (n_a + n_b - 2
+    dof), tau2 of each set and the dof."""
+    mua, sea, tau2a = _mema(ya, va, max_iter, tol)
+    mub, seb, tau2b = _mema(yb, vb, max_iter, tol)
+    diff = mua - mub
+    return (diff, _safe_t(diff, np.sqrt(sea ** 2 + seb ** 2)), tau2a, tau2b,
+            ya.shape[0] + yb.shape[0] - 2)
+
+
+def group_bricks(ya, yb=None, va=None, vb=None, test='onesample', model='ols',
+                 pooled=True, set_labels=('SetA', 'SetB')):
+    """Sub-bricks (voxels x bricks) and labels of one group test
+
+    ``test`` is 'onesample' (ya), 'paired' (ya - yb, same subjects) or
+    'twosample' (ya - yb, different subjects); ``model`` is 'ols' (t-test)
+    or 'mema' (variance-weighted, needs the sampling variances va, vb).
+    Paired MEMA adds the variances of the two conditions.
+    """
+    a, b = set_labels
+    if test == 'paired':
+        ya, va = ya - yb, (va + vb if model == 'mema' else None)
+    name = '%s-%s' % (a, b) if test != 'onesample' else a
+
+    if test == 'twosample':
+        if model == 'mema':
+            est, t, tau2a, tau2b, _ = mema_two(ya, va, yb, vb)
+            return (np.column_stack([est, t, tau2a, tau2b]),
+                    ['%s_mean' % name, '%s_Tstat' % name, '%s_tau2' % a, '%s_tau2' % b])
+        est, t, _ = ttest_two(ya, yb, pooled=pooled)
+    elif model == 'mema':
+        est, t, tau2, _ = mema_one(ya, va)
+        return (np.column_stack([est, t, tau2]),
+                ['%s_mean' % name, '%s_Tstat' % name, '%s_tau2' % name])
+    else:
+        est, t, _ = ttest_one(ya)
+    return np.column_stack([est, t]), ['%s_mean' % name, '%s_Tstat' % name]
@@ -0,0 +1,171 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range, str
+
+import os
+import numpy as np
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec, TraitedSpec,
+                                    traits, File, Directory, isdefined)
+
+from afniio import save_bucket
+from betastore import BetaStore
+from groupengine import beta_variance, group_bricks
+
+
+class GroupTestInputSpec(BaseInterfaceInputSpec):
+    store = Directory(
+        desc='beta store written by GroupBetas (out_dir)',
+        exists=True,
+        mandatory=True
+    )
+
+    test = traits.Enum(
+        'onesample', 'paired', 'twosample',
+        desc='one-sample test of set_a, paired test of coef minus coef_b in set_a, '
+             'or two-sample test of set_a minus set_b',
+        usedefault=True
+    )
+
+    model = traits.Enum(
+        'ols', 'mema',
+        desc='ols: t-test (3dttest++); mema: weight subjects by the sampling variance '
+             'of their estimates, (coef / tstat)^2, and a REML between-subject '
+             'variance (3dMEMA)',
+        usedefault=True
+    )
+
+    coef = traits.Str(
+        desc='label of the estimate sub-brick in the store, e.g. aud#0_Coef',
+        mandatory=True
+    )
+
+    tstat = traits.Str(
+        desc='label of the t-statistic of coef (model mema)'
+    )
+
+    coef_b = traits.Str(
+        desc='estimate of the second condition (paired test)'
+    )
+
+    tstat_b = traits.Str(
+        desc='t-statistic of coef_b (paired test, model mema)'
+    )
+
+    set_a = traits.List(
+        traits.Str,
+        desc='subject IDs of set A (all subjects of the store by default)'
+    )
+
+    set_b = traits.List(
+        traits.Str,
+        desc='subject IDs of set B (two-sample test)'
+    )
+
+    label_a = traits.Str('SetA', desc='name of set A in sub-brick labels', usedefault=True)
+    label_b = traits.Str('SetB', desc='name of set B in sub-brick labels', usedefault=True)
+
+    pooled = traits.Bool(
+        True,
+        desc='two-sample t-test with a pooled variance (False: Welch)',
+        usedefault=True
+    )
+
+    chunk_size = traits.Int(
+        20000,
+        desc='voxels read from the store and tested at a time',
+        usedefault=True,
+        nohash=True
+    )
+
+    out_file = File('GROUP.nii.gz',
+                    desc='name of output bucket',
+                    usedefault=True
+                    )
+
+
+class GroupTestOutputSpec(TraitedSpec):
+    out_file = File(
+        desc='group estimate, t-statistic (and tau^2 with mema)',
+        exists=True
+    )
+
+
+class GroupTest(BaseInterface):
+    """Voxelwise group t-tests and 3dMEMA-style mixed-effects tests,
+    in process, on a beta store
+
+    Voxels are read from the memory-mapped store and tested in chunks of
+    ``chunk_size``, so group statistics can run right after first level
+    without 3dttest++/3dMEMA or any dataset conversion.
+    """
+
+    input_spec = GroupTestInputSpec
+    output_spec = GroupTestOutputSpec
+
+    def _labels(self):
+        """Store labels of the (estimate, t-statistic) of each condition"""
+        mema = self.inputs.model == 'mema'
+        if mema and not isdefined(self.inputs.tstat):
+            raise ValueError('model mema needs tstat')
+        conds = [(self.inputs.coef, self.inputs.tstat if mema else None)]
+        if self.inputs.test == 'paired':
+            if not isdefined(self.inputs.coef_b) or (mema and not isdefined(self.inputs.tstat_b)):
+                raise ValueError('a paired test needs coef_b (and tstat_b with mema)')
+            conds.append((self.inputs.coef_b, self.inputs.tstat_b if mema else None))
+        return conds
+
+    def _sets(self, store):
+        set_a = self.inputs.set_a if isdefined(self.inputs.set_a) else store.subjects
+        set_a = [store.subject_index(s) for s in set_a]
+        if self.inputs.test != 'twosample':
+            return set_a, None
+        if not isdefined(self.inputs.set_b):
+            raise ValueError('a two-sample test needs set_b')
+        set_b = [store.subject_index(s) for s in self.inputs.set_b]
+        if set(set_a) & set(set_b):
+            raise ValueError('set_a and set_b share subjects')
+        return set_a, set_b
+
+    def _run_interface(self, runtime):
+        store = BetaStore(self.inputs.store)
+        conds = [(store.label_index(c), t if t is None else store.label_index(t))
+                 for c, t in self._labels()]
+        set_a, set_b = self._sets(store)
+        if len(set_a) < 2 or (set_b is not None and len(set_b) < 2):
+            raise ValueError('each set needs at least 2 subjects')
+
+        def read(subjects, cond, chunk):
+            coef, tstat = cond
+            y = np.asarray(store.data[subjects, chunk, coef], dtype=np.float64)
+            if tstat is None:
+                return y, None
+            t = np.asarray(store.data[subjects, chunk, tstat], dtype=np.float64)
+            return y, beta_variance(y, t)
+
+        nvox = store.data.shape[1]
+        bucket = names = None
+        for start in range(0, nvox, self.inputs.chunk_size):
+            chunk = slice(start, min(start + self.inputs.chunk_size, nvox))
+            ya, va = read(set_a, conds[0], chunk)
+            yb = vb = None
+            if self.inputs.test == 'paired':
+                yb, vb = read(set_a, conds[1], chunk)
+            elif self.inputs.test == 'twosample':
+                yb, vb = read(set_b, conds[0], chunk)
+            bricks, names = group_bricks(ya, yb, va, vb, test=self.inputs.test,
+                                         model=self.inputs.model, pooled=self.inputs.pooled,
+                                         set_labels=(self.inputs.label_a, self.inputs.label_b))
+            if bucket is None:
+                bucket = np.zeros((nvox, bricks.shape[1]), dtype=np.float32)
+            bucket[chunk] = bricks
+        if bucket is None:
+            raise ValueError('%s has no voxel in its mask' % self.inputs.store)
+
+        save_bucket(self._list_outputs()['out_file'], bucket, store.shape, store.affine,
+                    names, mask=store.mask)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = os.path.abspath(self.inputs.out_file)
+        return outputs
@@ -0,0 +1,259 @@
+"""Response models of 3dDeconvolve's -stim_times, evaluated in NumPy
+
+Models are given as in ``Decon.models``: GAM, BLOCK, dmBLOCK, TENT,
+CSPLIN and SPMG1/2/3. ``model_response`` evaluates a model directly at
+times since each onset; ``regressors`` builds the regressors of a run
+from it or, on request, by FFT convolution of the event train with the
+sampled response on an upsampled grid, which is what makes runs with
+thousands of events cheap.
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range
+
+import re
+import numpy as np
+
+
+_GAM_P, _GAM_Q = 8.6, 0.547
+_DT = 0.1
+
+
+def _block_integral(t):
+    """Integral from 0 to t of s^4 exp(-s), normalized as in 3dDeconvolve"""
+    t = np.maximum(t, 0.0)
+    poly = 1 + t + t ** 2 / 2 + t ** 3 / 6 + t ** 4 / 24
+    return 24 * (1 - np.exp(-t) * poly) / (4 ** 4 * np.exp(-4))
+
+
+def _block(t, dur):
+    return _block_integral(t) - _block_integral(t - dur)
+
+
+def _block_peak(dur):
+    grid = np.arange(0, dur + 15, _DT)
+    return _block(grid, dur).max()
+
+
+def _gamma(t, p=_GAM_P, q=_GAM_Q):
+    ts = np.maximum(t, 0.0)
+    return np.where(t > 0, (ts / (p * q)) ** p * np.exp(p - ts / q), 0.0)
+
+
+def _spm_raw(t):
+    ts = np.maximum(t, 0.0)
+    h = np.exp(-ts) * (ts ** 5 / 120.0 - ts ** 15 / (6 * 1.307674368e12))
+    return np.where(t > 0, h, 0.0)
+
+
+# SPMG1 is scaled to a peak of 1
+_SPM_PEAK = _spm_raw(np.arange(0, 30, 0.01)).max()
+
+
+def _spm(t):
+    return _spm_raw(t) / _SPM_PEAK
+
+
+def _spm_deriv(t):
+    return (_spm(t + _DT / 2) - _spm(t - _DT / 2)) / _DT
+
+
+def _spm_disp(t):
+    return (_spm(t) - _spm(t / 1.01)) / 0.01
+
+
+def _tent(x, width):
+    return np.maximum(0.0, 1 - np.abs(x) / width)
+
+
+def _csplin(x, width):
+    a = np.abs(x) / width
+    inner = 1.5 * a ** 3 - 2.5 * a ** 2 + 1
+    outer = -0.5 * a ** 3 + 2.5 * a ** 2 - 4 * a + 2
+    return np.where(a < 1, inner, np.where(a < 2, outer, 0.0))
+
+
+def _with_duration(kernel, t, dur):
+    """Convolve an impulse response with a boxcar of the given duration"""
+    if dur < _DT:
+        return kernel(t)
+    return sum(kernel(t - s) for s in np.arange(0, dur, _DT)) * _DT
+
+
+def parse_model(model):
+    """Split a model string such as 'BLOCK(5,1)' into name and parameters"""
+    m = re.match(r'^\s*([A-Za-z]+\d?)\s*(?:\((.*)\))?\s*$', model)
+    if not m:
+        raise ValueError('Cannot parse model %r' % model)
+    params = [float(p) for p in m.group(2).split(',')] if m.group(2) else []
+    return m.group(1), params
+
+
+def model_ncols(model):
+    """Number of regressors a model adds to the design matrix"""
+    name, params = parse_model(model)
+    if name in ('TENT', 'CSPLIN'):
+        return int(params[2])
+    if name in ('SPMG', 'SPMG2'):
+        return 2
+    if name == 'SPMG3':
+        return 3
+    return 1
+
+
+def model_response(model, t, durations=None):
+    """Response of a model to events, evaluated at times since onset
+
+    ``t`` is an (events x times) array of times relative to each onset,
+    ``durations`` the per-event durations (for dmBLOCK). Returns an array
+    of shape (events x times x regressors).
+    """
+    name, params = parse_model(model)
+
+    if name == 'GAM':
+        p, q = params[:2] if len(params) >= 2 else (_GAM_P, _GAM_Q)
+        dur = params[2] if len(params) > 2 else 0
+        return _with_duration(lambda s: _gamma(s, p, q), t, dur)[..., None]
+
+    if name == 'BLOCK':
+        if not params:
+            raise ValueError('BLOCK needs a duration: %r' % model)
+        dur = params[0]
+        h = _block(t, dur)
+        if len(params) > 1 and params[1] > 0:
+            h = h * params[1] / _block_peak(dur)
+        return h[..., None]
+
+    if name == 'dmBLOCK':
+        if durations is None or np.any(np.isnan(durations)):
+            raise ValueError('dmBLOCK needs married durations (onset:duration)')
+        amp = params[0] if params else 0
+        h = _block(t, durations[:, None])
+        if amp > 0:
+            peaks = np.array([_block_peak(d) for d in durations])
+            h = h * amp / peaks[:, None]
+        return h[..., None]
+
+    if name in ('TENT', 'CSPLIN'):
+        b, c, n = params[0], params[1], int(params[2])
+        width = (c - b) / (n - 1)
+        knots = b + width * np.arange(n)
+        func = _tent if name == 'TENT' else _csplin
+        return func(t[..., None] - knots, width)
+
+    if name in ('SPMG1', 'SPMG', 'SPMG2', 'SPMG3'):
+        dur = params[0] if params else 0
+        funcs = [_spm]
+        if name in ('SPMG', 'SPMG2', 'SPMG3'):
+            funcs.append(_spm_deriv)
+        if name == 'SPMG3':
+            funcs.append(_spm_disp)
+        return np.stack([_with_duration(f, t, dur) for f in funcs], axis=-1)
+
+    raise ValueError('Model %r is not supported by the python design builder' % model)
+
+
+# -------------------------------------------------------------------------
+# Regressors by FFT convolution
+# -------------------------------------------------------------------------
+
+def _support(name, params):
+    """Time span (since onset) outside which a model's response is zero,
+    or negligible"""
+    if name == 'GAM':
+        p, q = params[:2] if len(params) >= 2 else (_GAM_P, _GAM_Q)
+        dur = params[2] if len(params) > 2 else 0
+        return 0.0, dur + max(6 * p * q, 15.0)
+    if name == 'BLOCK':
+        return 0.0, params[0] + 30.0
+    if name in ('TENT', 'CSPLIN'):
+        b, c, n = params[0], params[1], int(params[2])
+        width = (c - b) / (n - 1)
+        reach = width if name == 'TENT' else 2 * width
+        return b - reach, c + reach
+    dur = params[0] if params else 0
+    return 0.0, dur + 32.0
+
+
+def _event_train(times, weights, qmin, length, dt):
+    """Events on a grid of step dt starting at qmin * dt, each split
+    between its two neighbouring grid points (linear interpolation)"""
+    pos = times / dt - qmin
+    q = np.floor(pos).astype(int)
+    frac = pos - q
+    idx = np.concatenate([q, q + 1])
+    w = np.concatenate([weights * (1 - frac), weights * frac])
+    keep = (idx >= 0) & (idx < length)
+    return np.bincount(idx[keep], weights=w[keep], minlength=length)
+
+
+def _fft_convolve(train, kernel):
+    """Linear convolution of a 1D train with every column of kernel"""
+    size = len(train) + len(kernel) - 1
+    nfft = 1 << (size - 1).bit_length()
+    spec = np.fft.rfft(train, nfft)[:, None] * np.fft.rfft(kernel, nfft, axis=0)
+    return np.fft.irfft(spec, nfft, axis=0)[:size]
+
+
+def regressors(model, onsets, durations, nvols, tr, method='direct'):
+    """Regressors of one run (nvols x model_ncols) for events at onsets
+    (seconds from the start of the run)
+
+    method is 'direct' (sum of model_response over events) or 'fft'
+    (convolution on a grid of about 0.1s that contains the TR). Onsets
+    off the grid are split between grid points, so 'fft' is only an
+    approximation: relative to the largest regressor value it is off by
+    up to ~1e-2 for TENT (at TRs that are not a multiple of 0.1s, and
+    with few events), ~3e-3 for SPMG3, ~1e-3 for CSPLIN and ~3e-4 for
+    GAM.
+    """
+    onsets = np.asarray(onsets, dtype=np.float64)
+    if durations is None:
+        durations = np.full(len(onsets), np.nan)
+    durations = np.asarray(durations, dtype=np.float64)
+    ncols = model_ncols(model)
+    if not len(onsets):
+        return np.zeros((nvols, ncols))
+
+    if method == 'direct':
+        t = np.arange(nvols) * tr
+        return model_response(model, t[None, :] - onsets[:, None], durations).sum(axis=0)
+    if method != 'fft':
+        raise ValueError('Unknown convolution method %r' % method)
+
+    up = int(np.ceil(tr / _DT - 1e-9))
+    dt = tr / up
+    name, params = parse_model(model)
+
+    if name == 'dmBLOCK':
+        # _block(t, d) = I(t) - I(t - d): the integral convolved with
+        # +1 at each onset and -1 at each offset
+        if np.any(np.isnan(durations)):
+            raise ValueError('dmBLOCK needs married durations (onset:duration)')
+        weights = np.ones(len(onsets))
+        if params and params[0] > 0:
+            uniq, inv = np.unique(durations, return_inverse=True)
+            weights = params[0] / np.array([_block_peak(d) for d in uniq])[inv]
+        times = np.concatenate([onsets, onsets + durations])
+        weights = np.concatenate([weights, -weights])
+        # events before the run need the integral past the run's end
+        lo, hi = 0.0, nvols * tr - min(onsets.min(), 0.0)
+        kernel_func = lambda s: _block_integral(s)[..., None]
+    else:
+        times, weights = onsets, np.ones(len(onsets))
+        lo, hi = _support(name, params)
+        kernel_func = lambda s: model_response(model, s[None, :])[0]
+
+    klo = int(np.floor(lo / dt))
+    kernel = kernel_func((klo + np.arange(int(np.ceil(hi / dt)) - klo + 1)) * dt)
+
+    qmin = int(np.floor(times.min() / dt))
+    qmax = min(int(np.floor(times.max() / dt)) + 2, nvols * up - klo)
+    train = _event_train(times, weights, qmin, max(qmax - qmin, 1), dt)
+    full = _fft_convolve(train, kernel)
+
+    # full[s] is the response at time (s + qmin + klo) * dt
+    s = np.arange(nvols) * up - qmin - klo
+    valid = (s >= 0) & (s < len(full))
+    out = np.zeros((nvols, ncols))
+    out[valid] = full[s[valid]]
+    return out
@@ -0,0 +1,75 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import str, bytes
+
+import errno
+import os
+from contextlib import contextmanager
+
+from nipype.interfaces.base import isdefined
+from nipype.interfaces.base.traits_extension import BasePath
+
+
+def abs_inputs(inputs):
+    """Make existing input paths absolute, for runs in other directories"""
+    def fix(value):
+        if isinstance(value, (str, bytes)) and os.path.exists(value):
+            return os.path.abspath(value)
+        if isinstance(value, list):
+            return [fix(v) for v in value]
+        return value
+    return dict((name, fix(value)) for name, value in inputs.items())
+
+
+def job_dirs(work_dir, count, prefix='job'):
+    """Create one working directory per job under work_dir"""
+    dirs = [os.path.join(os.path.abspath(work_dir), '%s%04d' % (prefix, k))
+            for k in range(count)]
+    for d in dirs:
+        try:
+            os.makedirs(d)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return dirs
+
+
+@contextmanager
+def working_directory(path):
+    """chdir into path for the duration of a with block
+
+    The working directory is shared by the whole process: only use this
+    where no other thread depends on it.
+    """
+    prev = os.getcwd()
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(prev)
+
+
+def output_paths(interface):
+    """Absolute paths of the files an interface lists as outputs,
+    resolved against the current directory"""
+    spec = interface.output_spec()
+    paths = []
+    for name, value in interface._list_outputs().items():
+        if not isdefined(value):
+            continue
+        ttype = spec.trait(name).trait_type
+        inner = ttype.inner_traits() if hasattr(ttype, 'inner_traits') else ()
+        if isinstance(ttype, BasePath):
+            paths.append(os.path.abspath(value))
+        elif inner and isinstance(inner[0].trait_type, BasePath):
+            paths += [os.path.abspath(v) for v in value]
+    return paths
+
+
+def check_collisions(paths_by_job):
+    """Raise ValueError when two jobs would write the same file"""
+    owner = {}
+    for k, paths in enumerate(paths_by_job):
+        for path in set(paths):
+            if path in owner:
+                raise ValueError('jobs %d and %d would both write %s' % (owner[path], k, path))
+            owner[path] = k
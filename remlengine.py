@@ -0,0 +1,216 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range, object
+
+from collections import OrderedDict
+
+import numpy as np
+
+from glmengine import OLSDesign
+
+
+def arma11_lambda(a, b):
+    """Lag-1 correlation of an ARMA(1,1) process (3dREMLfit's 'lam')"""
+    return (b + a) * (1 + a * b) / (1 + 2 * a * b + b * b)
+
+
+def arma11_corr(a, b, n):
+    """n x n correlation matrix of an ARMA(1,1) process:
+    r(0) = 1, r(k) = lam * a^(k-1)"""
+    lam = arma11_lambda(a, b)
+    r = np.empty(n)
+    r[0] = 1.0
+    if n > 1:
+        r[1:] = lam * a ** np.arange(n - 1)
+    idx = np.abs(np.subtract.outer(np.arange(n), np.arange(n)))
+    return r[idx]
+
+
+def _run_slices(run_starts, nt):
+    bounds = list(run_starts) + [nt]
+    return [slice(b0, b1) for b0, b1 in zip(bounds[:-1], bounds[1:])]
+
+
+def estimate_arma11(res, run_starts, max_a=0.8, max_b=0.8):
+    """Method-of-moments ARMA(1,1) parameters from residuals, the
+    starting point of the REML grid search
+
+    ``res`` is voxels x time. Lag-1 and lag-2 autocorrelations are
+    accumulated within runs only; then a = r2/r1 and b solves
+    lam(a, b) = r1 (the root inside the unit circle).
+    """
+    c0 = c1 = c2 = 0.0
+    for sl in _run_slices(run_starts, res.shape[1]):
+        e = res[:, sl]
+        c0 = c0 + np.einsum('ij,ij->i', e, e)
+        c1 = c1 + np.einsum('ij,ij->i', e[:, 1:], e[:, :-1])
+        c2 = c2 + np.einsum('ij,ij->i', e[:, 2:], e[:, :-2])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r1 = np.where(c0 > 0, c1 / c0, 0.0)
+        r2 = np.where(c0 > 0, c2 / c0, 0.0)
+        a = np.where(r1 > 1e-3, r2 / r1, 0.0)
+    a = np.clip(a, 0.0, max_a)
+    lam = np.clip(r1, -0.99, 0.99)
+
+    # lam * (1 + 2ab + b^2) = (b + a)(1 + ab)  ->  A b^2 + B b + A = 0
+    A = lam - a
+    B = 2 * lam * a - 1 - a * a
+    disc = np.maximum(B * B - 4 * A * A, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = np.where(np.abs(A) > 1e-8, (-B - np.sign(B) * np.sqrt(disc)) / (2 * A), 0.0)
+        # roots multiply to 1: keep the one with |b| <= 1
+        b = np.where(np.abs(b) > 1, 1.0 / b, b)
+    b = np.clip(np.nan_to_num(b), -max_b, max_b)
+    return a, b
+
+
+class _Cell(object):
+    """Whitening and GLS factorization for one (a, b) grid point"""
+
+    def __init__(self, X, runs, a, b):
+        self.a, self.b = a, b
+        self.lam = arma11_lambda(a, b)
+        self.runs = runs
+        self.whiteners = []
+        logdet = 0.0
+        wx = []
+        cache = {}
+        for sl in runs:
+            n = sl.stop - sl.start
+            if n not in cache:
+                L = np.linalg.cholesky(arma11_corr(a, b, n))
+                cache[n] = (np.linalg.inv(L), 2 * np.log(np.diag(L)).sum())
+            W, ld = cache[n]
+            self.whiteners.append(W)
+            logdet += ld
+            wx.append(np.dot(W, X[sl]))
+        self.WX = np.vstack(wx)
+        self.pinv = np.linalg.pinv(self.WX)
+        self.xtxinv = np.dot(self.pinv, self.pinv.T)
+        self.rank = np.linalg.matrix_rank(self.WX)
+        self.dof = X.shape[0] - self.rank
+        sign, ld_xtx = np.linalg.slogdet(np.dot(self.WX.T, self.WX))
+        self.logdet = logdet + (ld_xtx if sign > 0 else 0.0)
+
+    def whiten(self, y):
+        return np.hstack([np.dot(y[:, sl], W.T) for sl, W in zip(self.runs, self.whiteners)])
+
+
+class REMLEngine(object):
+    """Voxelwise GLS with ARMA(1,1) noise on a quantized (a, b) grid
+
+    The grid has a in [0, max_a] and b in [-max_b, max_b] with 2**grid
+    steps over [0, max] (3dREMLfit's -MAXa, -MAXb and -Grid). A moment
+    estimate of (a, b) from the OLS residuals picks a starting grid
+    point per voxel; the restricted log-likelihood is then evaluated at
+    that point and at its neighbours within ``search`` grid steps, and
+    the best of them is kept. Every voxel evaluated at the same grid
+    point shares one whitening matrix and one GLS factorization. At most
+    ``cache_size`` grid points are kept in memory; evicted ones are
+    recomputed if needed again.
+    """
+
+    def __init__(self, X, run_starts=(0,), max_a=0.8, max_b=0.8, grid=3,
+                 cache_size=64, search=1):
+        self.X = np.asarray(X, dtype=np.float64)
+        self.nt, self.p = self.X.shape
+        self.runs = _run_slices(run_starts, self.nt)
+        self.max_a, self.max_b = max_a, max_b
+        steps = 2 ** grid
+        self.a_values = np.linspace(0, max_a, steps + 1)
+        self.b_values = np.linspace(-max_b, max_b, 2 * steps + 1)
+        self.ols = OLSDesign(self.X)
+        self.cache_size = cache_size
+        self.search = search
+        self._cells = OrderedDict()
+
+    def quantize(self, a, b):
+        """Grid cell index of each (a, b) pair"""
+        steps = len(self.a_values) - 1
+        ia = np.rint(a / self.max_a * steps) if self.max_a > 0 else np.zeros_like(a)
+        ib = np.rint((b / self.max_b + 1) * steps) if self.max_b > 0 else np.zeros_like(b)
+        return ia.astype(int) * len(self.b_values) + ib.astype(int)
+
+    def cell(self, c):
+        c = int(c)
+        if c in self._cells:
+            self._cells[c] = self._cells.pop(c)
+            return self._cells[c]
+        ia, ib = divmod(c, len(self.b_values))
+        cell = _Cell(self.X, self.runs, self.a_values[ia], self.b_values[ib])
+        self._cells[c] = cell
+        while len(self._cells) > self.cache_size:
+            self._cells.popitem(last=False)
+        return cell
+
+    @staticmethod
+    def groups(cells):
+        """Yield (cell, voxel indices) for every cell in use"""
+        order = np.argsort(cells, kind='mergesort')
+        ids, starts = np.unique(cells[order], return_index=True)
+        bounds = list(starts[1:]) + [len(order)]
+        for c, s0, s1 in zip(ids, starts, bounds):
+            yield c, order[s0:s1]
+
+    def neighbours(self, cells):
+        """Grid cells within ``search`` steps of each cell (voxels x
+        candidates, -1 off the grid)"""
+        na, nb = len(self.a_values), len(self.b_values)
+        ia, ib = np.divmod(np.asarray(cells), nb)
+        steps = range(-self.search, self.search + 1)
+        cands = []
+        for da in steps:
+            for db in steps:
+                ja, jb = ia + da, ib + db
+                inside = (ja >= 0) & (ja < na) & (jb >= 0) & (jb < nb)
+                cands.append(np.where(inside, ja * nb + jb, -1))
+        return np.column_stack(cands)
+
+    def fit(self, Y, chunk_size=10000):
+        """REML fit of voxels x time data
+
+        Returns a dict with beta (voxels x regressors), sigma2, a, b, lam,
+        the negative restricted log-likelihood and the grid cell of every
+        voxel.
+        """
+        nvox = Y.shape[0]
+        out = {
+            'beta': np.zeros((nvox, self.p), dtype=np.float32),
+            'sigma2': np.zeros(nvox),
+            'loglik': np.zeros(nvox),
+            'cells': np.zeros(nvox, dtype=int),
+        }
+        for start in range(0, nvox, chunk_size):
+            stop = min(start + chunk_size, nvox)
+            y = np.asarray(Y[start:stop], dtype=np.float64)
+            b0 = np.dot(y, self.ols.pinv.T)
+            a, b = estimate_arma11(y - np.dot(b0, self.X.T), [sl.start for sl in self.runs],
+                                   self.max_a, self.max_b)
+            cands = self.neighbours(self.quantize(a, b))
+            voxels = np.repeat(np.arange(stop - start), cands.shape[1])
+            cands = cands.ravel()
+            voxels, cands = voxels[cands >= 0], cands[cands >= 0]
+            best = np.full(stop - start, np.inf)
+            for c, sel in self.groups(cands):
+                idx = voxels[sel]
+                cell = self.cell(c)
+                wy = cell.whiten(y[idx])
+                beta = np.dot(wy, cell.pinv.T)
+                res = wy - np.dot(beta, cell.WX.T)
+                sigma2 = np.einsum('ij,ij->i', res, res) / cell.dof
+                with np.errstate(divide='ignore'):
+                    logs2 = np.log(np.where(sigma2 > 0, 2 * np.pi * sigma2, 1.0))
+                nll = 0.5 * (cell.dof * (logs2 + 1) + cell.logdet)
+                better = nll < best[idx]
+                idx, keep = idx[better], start + idx[better]
+                best[idx] = nll[better]
+                out['beta'][keep] = beta[better]
+                out['sigma2'][keep] = sigma2[better]
+                out['loglik'][keep] = nll[better]
+                out['cells'][keep] = c
+
+        ia, ib = np.divmod(out['cells'], len(self.b_values))
+        out['a'] = self.a_values[ia]
+        out['b'] = self.b_values[ib]
+        out['lam'] = arma11_lambda(out['a'], out['b'])
+        return out
@@ -2,6 +2,7 @@ from __future__ import print_function, division, unicode_literals, absolute_impo
 from builtins import range, str, bytes
 
 import os
+import tempfile
 import warnings
 import sys
 import re
@@ -19,6 +20,18 @@ from nipype.interfaces.afni.base import (
     AFNICommand, AFNICommandBase, AFNICommandInputSpec,
     AFNICommandOutputSpec)
 
+from afniio import (read_xmat, load_mask, load_series, parcel_series, save_bucket,
+                    save_table, dataset_info)
+from glmengine import stat_bricks, blas_threads
+from glt import GLTMatrix
+from remlengine import REMLEngine
+from slabs import run_slabs
+from diagnostics import preflight
+from runprofile import RunProfile, phase
+from toolmonitor import run_monitored
+from resources import available_memory_gb, estimate_mem_gb
+
+
 class REMLfitInputSpec(CommandLineInputSpec):
     # TODO: Add position metadata. Check if better using traits.Enum for local and global options
 
@@ -37,6 +50,36 @@ class REMLfitInputSpec(CommandLineInputSpec):
         position=4
     )
 
+    num_threads = traits.Int(
+        1,
+        desc='number of OpenMP threads (OMP_NUM_THREADS); also tells the '
+             'nipype scheduler how many cores the node uses',
+        usedefault=True,
+        nohash=True
+    )
+
+    usetemp = traits.Enum(
+        'auto', 'yes', 'no',
+        desc='keep the data in temporary files instead of RAM (-usetemp; the '
+             'numpy engine memory-maps it). \'auto\' does so when the estimated '
+             'peak memory does not fit in mem_gb',
+        argstr='-usetemp \\\n',
+        usedefault=True,
+        nohash=True
+    )
+
+    mem_gb = traits.Float(
+        desc='RAM available to the run, in GB, for usetemp=\'auto\' (default: '
+             'free memory, within the cgroup limit of the job)',
+        nohash=True
+    )
+
+    tmpdir = Directory(
+        desc='directory for the temporary files (sets TMPDIR)',
+        exists=True,
+        nohash=True
+    )
+
     # TODO: check if it can be done with traits.List or traits.Dict (to include labels). Add position metadata
     in_file = InputMultiPath(
         File(
@@ -48,6 +91,27 @@ class REMLfitInputSpec(CommandLineInputSpec):
         copyfile=False
     )
 
+    mask = File(
+        desc='only fit the voxels inside this mask (zero elsewhere). The '
+             'in-process engine then keeps only in-mask voxels in memory',
+        argstr='-mask %s \\\n',
+        exists=True
+    )
+
+    atlas = File(
+        desc='atlas label volume on the data grid. Fits the mean time series of '
+             'every parcel in-process and writes a parcels x statistics table '
+             '(out_table) instead of the Rbuck, Rvar and Rbeta datasets',
+        exists=True
+    )
+
+    matrix = File(
+        desc='design matrix (.xmat.1D) written by 3dDeconvolve',
+        argstr='-matrix %s \\\n',
+        exists=True,
+        mandatory=True
+    )
+
     # num_stimts = traits.Int(
     #     desc='number of stim time files',
     #     argstr='-num_stimts %d \\\n',
@@ -162,6 +226,87 @@ class REMLfitInputSpec(CommandLineInputSpec):
                     usedefault=True
                     )
 
+    max_a = traits.Float(
+        desc='maximum AR parameter a of the ARMA(1,1) noise model (default 0.8)',
+        argstr='-MAXa %g \\\n'
+    )
+
+    max_b = traits.Float(
+        desc='maximum MA parameter |b| of the ARMA(1,1) noise model (default 0.8)',
+        argstr='-MAXb %g \\\n'
+    )
+
+    grid = traits.Int(
+        desc='the (a,b) grid has 2^grid steps over [0, max] (default 3)',
+        argstr='-Grid %d \\\n'
+    )
+
+    engine = traits.Enum(
+        'afni', 'numpy',
+        desc='\'afni\' runs 3dREMLfit. \'numpy\' fits in-process, without AFNI, '
+             'estimating the ARMA(1,1) parameters per voxel and sharing one '
+             'GLS factorization per (a,b) grid point',
+        usedefault=True
+    )
+
+    check_inputs = traits.Bool(
+        True,
+        desc='check that the runs share one grid and that the matrix has one '
+             'row per volume, from the headers, before running',
+        usedefault=True,
+        nohash=True
+    )
+
+    diagnostics = traits.Enum(
+        'report', 'fail', 'off',
+        desc='check the conditioning of the design matrix (condition number, '
+             'regressor correlations, variance inflation) before fitting: save '
+             'a JSON report, or also stop when the design has problems. Default: '
+             '\'report\' with the numpy engine, \'off\' with afni',
+        nohash=True
+    )
+
+    max_condition = traits.Float(
+        1000.0,
+        desc='largest tolerated condition number of the design (diagnostics)',
+        usedefault=True,
+        nohash=True
+    )
+
+    max_correlation = traits.Float(
+        0.9,
+        desc='largest tolerated correlation between two regressors (diagnostics)',
+        usedefault=True,
+        nohash=True
+    )
+
+    max_vif = traits.Float(
+        10.0,
+        desc='largest tolerated variance inflation factor (diagnostics)',
+        usedefault=True,
+        nohash=True
+    )
+
+    profile = traits.Bool(
+        False,
+        desc='record wall/CPU time, peak RSS, I/O and phase times of the run '
+             'in a JSON file next to out_file',
+        usedefault=True,
+        nohash=True
+    )
+
+    slab_workers = traits.Int(
+        desc='fit the volume in z-slabs with this many local worker processes '
+             'and stitch the slab outputs back together',
+        nohash=True
+    )
+
+    num_slabs = traits.Int(
+        desc='number of z-slabs (default: twice slab_workers)',
+        requires=['slab_workers'],
+        nohash=True
+    )
+
 
 class REMLfitOutputSpec(TraitedSpec):
     out_file = File(
@@ -176,6 +321,18 @@ class REMLfitOutputSpec(TraitedSpec):
         desc='Rbeta'
     )
 
+    out_table = File(
+        desc='parcel statistics and ARMA parameters (tab-separated), atlas mode only'
+    )
+
+    out_profile = File(
+        desc='resource profile of the run (JSON)'
+    )
+
+    out_diagnostics = File(
+        desc='design matrix diagnostics (JSON)'
+    )
+
 
 class REMLfit(CommandLine):
     # class Decon(AFNICommand):
@@ -184,6 +341,57 @@ class REMLfit(CommandLine):
     input_spec = REMLfitInputSpec
     output_spec = REMLfitOutputSpec
 
+    def __init__(self, **inputs):
+        super(REMLfit, self).__init__(**inputs)
+        self._profile = None
+        self._diagnostics = None
+        self._usetemp = None
+        self.inputs.on_trait_change(self._nthreads_update, 'num_threads')
+        self._nthreads_update()
+        self.inputs.on_trait_change(self._tmpdir_update, 'tmpdir')
+        self._tmpdir_update()
+
+    @property
+    def num_threads(self):
+        return self.inputs.num_threads
+
+    @num_threads.setter
+    def num_threads(self, value):
+        self.inputs.num_threads = value
+
+    def _nthreads_update(self):
+        self.inputs.environ['OMP_NUM_THREADS'] = '%d' % self.inputs.num_threads
+
+    def _tmpdir_update(self):
+        if isdefined(self.inputs.tmpdir):
+            self.inputs.environ['TMPDIR'] = os.path.abspath(self.inputs.tmpdir)
+
+    def _out_of_core(self):
+        """Whether to use temporary files. 'auto' is decided once per
+        run, by _decide_usetemp; it is False until then, so building the
+        command line reads no headers"""
+        if self.inputs.usetemp != 'auto':
+            return self.inputs.usetemp == 'yes'
+        return bool(self._usetemp)
+
+    def _decide_usetemp(self):
+        """Decide usetemp='auto' from the dataset headers, the matrix
+        size and the available RAM"""
+        self._usetemp = False
+        if self.inputs.usetemp != 'auto' or not isdefined(self.inputs.in_file):
+            return
+        available = self.inputs.mem_gb if isdefined(self.inputs.mem_gb) \
+            else available_memory_gb()
+        if available is None:
+            return
+        nreg = 20
+        if isdefined(self.inputs.matrix) and os.path.exists(self.inputs.matrix):
+            nreg = len(read_xmat(self.inputs.matrix)[1]['ColumnLabels'])
+        needed = estimate_mem_gb(self.inputs.in_file, nregressors=nreg, tool='3dREMLfit',
+                                 num_threads=self.inputs.num_threads)
+        # leave room for the page cache and the rest of the process
+        self._usetemp = needed > 0.8 * available
+
     def _format_arg(self, name, trait_spec, value):
 
         # if name == 'out_xmat':
@@ -193,6 +401,9 @@ class REMLfit(CommandLine):
         if name == 'out_file':
             bucket = self._gen_filename('out_file')
             return trait_spec.argstr % bucket
+
+        if name == 'usetemp':
+            return trait_spec.argstr if self._out_of_core() else None
         # TODO: is defined 'labels'
         if name == 'glt':
             #arg = trait_spec.argstr % value
@@ -220,8 +431,196 @@ class REMLfit(CommandLine):
             output = filename + '_REML.nii.gz'
             return output
 
+        if name == 'out_table':
+            _, filename, ext = split_filename(self._gen_filename('out_file'))
+            return filename + '_parcels.tsv'
+
+        if name == 'out_diagnostics':
+            _, filename, ext = split_filename(self._gen_filename('out_file'))
+            return filename + '_diagnostics.json'
+
+        if name == 'out_profile':
+            _, filename, ext = split_filename(self._gen_filename('out_file'))
+            return filename + '_profile.json'
+
         return None
 
+    def _check_inputs(self):
+        infos = [dataset_info(f) for f in self.inputs.in_file]
+        for fname, info in zip(self.inputs.in_file[1:], infos[1:]):
+            if info['shape'] != infos[0]['shape']:
+                raise ValueError('%s has grid %s but %s has %s' % (
+                    fname, info['shape'], self.inputs.in_file[0], infos[0]['shape']))
+        X, info = read_xmat(self.inputs.matrix)
+        nrows = int(info.get('NRowFull', X.shape[0]))
+        nvols = sum(i['nvols'] for i in infos)
+        if nrows != nvols:
+            raise ValueError('%s has %d rows but the input has %d volumes'
+                             % (self.inputs.matrix, nrows, nvols))
+
+    def _diagnostics_mode(self):
+        if isdefined(self.inputs.diagnostics):
+            return self.inputs.diagnostics
+        return 'off' if self.inputs.engine == 'afni' else 'report'
+
+    def _preflight(self):
+        """Design diagnostics on the matrix, before any data is loaded"""
+        self._diagnostics = None
+        mode = self._diagnostics_mode()
+        if mode == 'off':
+            return
+        X, info = read_xmat(self.inputs.matrix)
+        self._diagnostics = preflight(
+            X, info, mode=mode,
+            out_file=self._gen_filename('out_diagnostics'),
+            max_condition=self.inputs.max_condition,
+            max_correlation=self.inputs.max_correlation, max_vif=self.inputs.max_vif)
+
+    def _cmdline_only(self):
+        """True when a run is nothing but the 3dREMLfit command line
+        (after the input checks), so it can be launched directly"""
+        return not (self.inputs.engine == 'numpy' or isdefined(self.inputs.atlas)
+                    or self.inputs.profile
+                    or (isdefined(self.inputs.slab_workers) and self.inputs.slab_workers > 1))
+
+    def _run_interface(self, runtime):
+        if not self.inputs.profile:
+            return self._run_reml(runtime)
+
+        self._profile = RunProfile(self._cmd)
+        with self._profile:
+            runtime = self._run_reml(runtime)
+        self._profile.add_output('\n'.join([getattr(runtime, 'stdout', None) or '',
+                                            getattr(runtime, 'stderr', None) or '']))
+        self._profile.save(self._gen_filename('out_profile'))
+        return runtime
+
+    def _run_reml(self, runtime):
+        if self.inputs.check_inputs:
+            self._check_inputs()
+        self._preflight()
+        self._decide_usetemp()
+
+        # parcels span slabs, and parcel fits are cheap anyway
+        if isdefined(self.inputs.slab_workers) and self.inputs.slab_workers > 1 \
+                and not isdefined(self.inputs.atlas):
+            num_slabs = self.inputs.num_slabs if isdefined(self.inputs.num_slabs) else None
+            outputs = self._list_outputs()
+            stitch = dict((name, outputs[name]) for name in ('out_file', 'out_var', 'out_beta'))
+            run_slabs(self, stitch,
+                      num_workers=self.inputs.slab_workers, num_slabs=num_slabs)
+            runtime.returncode = 0
+            return runtime
+
+        if self.inputs.engine == 'numpy' or isdefined(self.inputs.atlas):
+            with blas_threads(self.inputs.num_threads):
+                self._fit_numpy()
+            runtime.returncode = 0
+            return runtime
+
+        if self._profile is None:
+            return super(REMLfit, self)._run_interface(runtime)
+        # run_monitored measures the tool process for the profile
+        runtime.cmdline = self.cmdline
+        runtime.environ.update(self._get_environ())
+        runtime.success_codes = (0,)
+        runtime = run_monitored(runtime)
+        self._profile.add_child(runtime.rusage)
+        return runtime
+
+    def _fit_numpy(self):
+        X, info = read_xmat(self.inputs.matrix)
+        glts = None
+        if isdefined(self.inputs.glt):
+            glts = GLTMatrix.from_sym(self.inputs.glt, self.inputs.labels, info['ColumnLabels'])
+
+        mask = load_mask(self.inputs.mask) if isdefined(self.inputs.mask) else None
+        parcels = mmap_file = None
+        if not isdefined(self.inputs.atlas) and self._out_of_core():
+            tmpdir = self.inputs.tmpdir if isdefined(self.inputs.tmpdir) else os.getcwd()
+            fd, mmap_file = tempfile.mkstemp(suffix='.dat', prefix='reml_', dir=tmpdir)
+            os.close(fd)
+
+        def param(name, default):
+            value = getattr(self.inputs, name)
+            return value if isdefined(value) else default
+
+        try:
+            with phase(self._profile, 'loading'):
+                if isdefined(self.inputs.atlas):
+                    Y, parcels = parcel_series(self.inputs.in_file, self.inputs.atlas,
+                                               mask=mask)
+                else:
+                    Y, shape, affine, header = load_series(self.inputs.in_file, mask=mask,
+                                                           mmap_file=mmap_file)
+            if Y.shape[1] != X.shape[0]:
+                raise ValueError('Design matrix has %d rows but the input has %d volumes'
+                                 % (X.shape[0], Y.shape[1]))
+
+            with phase(self._profile, 'matrix_setup'):
+                engine = REMLEngine(X, info['RunStart'], max_a=param('max_a', 0.8),
+                                    max_b=param('max_b', 0.8), grid=param('grid', 3))
+            with phase(self._profile, 'fitting'):
+                fit = engine.fit(Y)
+            del Y
+        finally:
+            if mmap_file is not None:
+                os.remove(mmap_file)
+
+        if not np.any(fit['sigma2'] > 0):
+            raise ValueError('the input (%s) has no voxel with a nonzero residual variance%s'
+                             % (', '.join(self.inputs.in_file),
+                                ' in the mask' if mask is not None else ''))
+
+        var = np.column_stack([fit['a'], fit['b'], fit['lam'], np.sqrt(fit['sigma2']),
+                               fit['loglik']])
+        var_labels = ['a', 'b', 'lam', 'StDev', '-LogLik']
+
+        flags = dict(fout=bool(self.inputs.fout), rout=bool(self.inputs.rout),
+                     tout=bool(self.inputs.tout), vout=bool(self.inputs.vout),
+                     bout=bool(self.inputs.bout))
+        bucket = names = None
+        with phase(self._profile, 'statistics'):
+            for c, idx in engine.groups(fit['cells']):
+                cell = engine.cell(c)
+                beta = fit['beta'][idx].astype(np.float64)
+                bricks, names = stat_bricks(cell.xtxinv, cell.dof, info, beta,
+                                            fit['sigma2'][idx], **flags)
+                if glts is not None:
+                    br, nm = glts.bricks(beta, fit['sigma2'][idx], cell.xtxinv, cell.dof,
+                                         fout=flags['fout'], rout=flags['rout'])
+                    bricks = np.hstack([bricks, br])
+                    names = names + nm
+                if bucket is None:
+                    bucket = np.zeros((len(fit['cells']), bricks.shape[1]), dtype=np.float32)
+                bucket[idx] = bricks
+
+        with phase(self._profile, 'output'):
+            if parcels is not None:
+                save_table(self._gen_filename('out_table'), np.hstack([bucket, var]),
+                           names + var_labels, parcels)
+                return
+            save_bucket(os.path.abspath(self.inputs.out_beta), fit['beta'], shape, affine,
+                        info['ColumnLabels'], header=header, mask=mask)
+            save_bucket(os.path.abspath(self.inputs.out_var), var, shape, affine,
+                        var_labels, header=header, mask=mask)
+            save_bucket(self._list_outputs()['out_file'], bucket, shape, affine, names,
+                        header=header, mask=mask)
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        if isdefined(self.inputs.atlas):
+            outputs['out_table'] = os.path.abspath(self._gen_filename('out_table'))
+        else:
+            outputs['out_file'] = os.path.abspath(self._gen_filename('out_file'))
+            outputs['out_var'] = os.path.abspath(self.inputs.out_var)
+            outputs['out_beta'] = os.path.abspath(self.inputs.out_beta)
+        if self.inputs.profile:
+            outputs['out_profile'] = os.path.abspath(self._gen_filename('out_profile'))
+        if self._diagnostics is not None:
+            outputs['out_diagnostics'] = os.path.abspath(self._gen_filename('out_diagnostics'))
+        return outputs
+
     # def _parse_inputs(self, skip=None):
     #     # Skip the arguments without argstr metadata
     #     if skip is None:
@@ -0,0 +1,131 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import str, bytes
+
+import nibabel as nb
+import numpy as np
+
+from nipype.interfaces.base import isdefined
+
+try:
+    from nipype.utils.ram_estimator import RamEstimator
+except ImportError:  # nipype < 1.11 has no runtime memory estimators
+    RamEstimator = object
+
+
+def _dims(in_files):
+    if isinstance(in_files, (str, bytes)):
+        in_files = [in_files]
+    nvox = ntime = 0
+    for fname in in_files:
+        shape = nb.load(fname).shape
+        nvox = int(np.prod(shape[:3]))
+        ntime += shape[3] if len(shape) > 3 else 1
+    return nvox, ntime
+
+
+def estimate_mem_gb(in_files, nregressors=20, nbricks=None, tool='3dDeconvolve',
+                    num_threads=1):
+    """Rough peak memory of a 3dDeconvolve / 3dREMLfit run, in GB
+
+    Both tools keep the whole time series in memory as floats, plus the
+    output buckets. 3dREMLfit keeps a second copy of the data (OLS and
+    REML passes) and, per thread, a workspace of doubles for one voxel's
+    whitened design and series, ntime x (ntime + nregressors). Only
+    headers are read.
+    """
+    nvox, ntime = _dims(in_files)
+    if nbricks is None:
+        nbricks = 2 * nregressors + 1
+    gb = 4.0 / 1024 ** 3
+    data = nvox * ntime * gb
+    outputs = nvox * nbricks * gb
+    if tool == '3dREMLfit':
+        workspace = num_threads * 8.0 * ntime * (ntime + nregressors) / 1024 ** 3
+        mem = 2 * data + 3 * outputs + workspace
+    else:
+        mem = 1.2 * data + outputs
+    return round(mem + 0.3, 2)
+
+
+def available_memory_gb():
+    """RAM this process can still use, in GB, or None when unknown
+
+    The smaller of the free system memory and what is left under the
+    cgroup limit, which is how batch schedulers and containers cap a
+    job's memory.
+    """
+    avail = None
+    try:
+        import psutil
+        avail = psutil.virtual_memory().available
+    except ImportError:
+        try:
+            with open('/proc/meminfo') as fp:
+                for line in fp:
+                    if line.startswith('MemAvailable:'):
+                        avail = int(line.split()[1]) * 1024
+        except (IOError, OSError, ValueError):
+            pass
+
+    for limit_file, usage_file in (
+            ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+            ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+             '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        try:
+            with open(limit_file) as fp:
+                limit = fp.read().strip()
+            with open(usage_file) as fp:
+                usage = int(fp.read().strip())
+        except (IOError, OSError, ValueError):
+            continue
+        if limit == 'max' or int(limit) >= 2 ** 60:  # no limit
+            continue
+        free = max(int(limit) - usage, 0)
+        avail = free if avail is None else min(avail, free)
+        break
+    return None if avail is None else avail / 1024.0 ** 3
+
+
+class DeconRamEstimator(RamEstimator):
+    """Memory estimate for Decon and REMLfit nodes under MultiProc
+
+    Attach to a node with ``node.ram_estimator = DeconRamEstimator()``;
+    the estimate is evaluated from the node inputs right before the job
+    is scheduled.
+    """
+
+    def __init__(self, tool='3dDeconvolve', min_gb=0.5, max_gb=None):
+        self.tool = tool
+        self.min_gb = min_gb
+        self.max_gb = max_gb
+
+    def __call__(self, inputs):
+        if not isdefined(inputs.in_file):
+            return self.min_gb, 'in_file undefined'
+        nreg = 20
+        if hasattr(inputs, 'num_stimts') and isdefined(inputs.num_stimts):
+            nreg = 4 * inputs.num_stimts
+        threads = inputs.num_threads if isdefined(inputs.num_threads) else 1
+        mem = estimate_mem_gb(inputs.in_file, nregressors=nreg, tool=self.tool,
+                              num_threads=threads)
+        mem = max(mem, self.min_gb)
+        if self.max_gb is not None:
+            mem = min(mem, self.max_gb)
+        return mem, '%s: %.2f GB for %s' % (self.tool, mem, inputs.in_file)
+
+
+def resource_hints(interface):
+    """n_procs / mem_gb keyword arguments for a Node wrapping interface
+
+    >>> node = pe.Node(decon, name='decon', **resource_hints(decon))
+    """
+    tool = interface._cmd
+    hints = {'n_procs': interface.inputs.num_threads}
+    if isdefined(interface.inputs.in_file):
+        nreg = 20
+        if hasattr(interface.inputs, 'num_stimts') and isdefined(interface.inputs.num_stimts):
+            nreg = 4 * interface.inputs.num_stimts
+        hints['mem_gb'] = estimate_mem_gb(interface.inputs.in_file, nregressors=nreg,
+                                          tool=tool,
+                                          num_threads=interface.inputs.num_threads)
+    return hints
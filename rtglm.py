@@ -0,0 +1,160 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import object, range
+
+import nibabel as nb
+import numpy as np
+
+from nipype.interfaces.base import isdefined
+
+from afniio import load_mask
+from design import build_design
+
+
+class RealtimeGLM(object):
+    """Recursive least-squares fit of a design, one frame at a time
+
+    For real-time runs (neurofeedback): the design rows are known before
+    the run, and ``update`` takes each new frame as it arrives. All
+    voxels share the design, so the gain and the inverse cross-product
+    P = (X'X)^-1 are updated once per frame in O(p^2), and the betas and
+    residual sums of squares of all voxels in O(p) each. Until the rows
+    seen so far have full rank, frames are kept and ``beta`` is their
+    minimum-norm solution; the first full-rank batch fit then starts the
+    recursion, whose estimates are the least-squares fit of the frames
+    so far.
+
+    With ``forgetting`` < 1, older frames are down-weighted by that
+    factor per frame (exponentially weighted RLS), so the estimates
+    track slow drifts.
+    """
+
+    def __init__(self, X, mask=None, forgetting=1.0):
+        self.X = np.asarray(X, dtype=np.float64)
+        self.nt, self.p = self.X.shape
+        if not 0 < forgetting <= 1:
+            raise ValueError('forgetting must be in (0, 1]')
+        self.forgetting = forgetting
+        self.mask = mask
+        self.n = 0
+        self.P = None
+        self._beta = None
+        self.sse = None
+        self._frames = []
+
+    @classmethod
+    def from_decon(cls, decon, run_lengths, tr, run=0, mask=None, forgetting=1.0):
+        """Design of a Decon interface (stim_files, models, labels,
+        polort, timing, ortvec) for one real-time run
+
+        ``run_lengths`` are the frames of every run the timing files
+        cover (an int for a single run) and ``run`` the index of the run
+        to fit. Columns that are zero in that run (other runs'
+        baselines, stimuli without events) are dropped; ``columns`` holds
+        the labels of the ones kept.
+        """
+        inputs = decon.inputs
+        if isinstance(run_lengths, int):
+            run_lengths = [run_lengths]
+        X, info = build_design(inputs.stim_files, inputs.models, inputs.labels, run_lengths,
+                               tr, polort=inputs.polort, timing=inputs.timing,
+                               ortvec=inputs.ortvec if isdefined(inputs.ortvec) else None,
+                               convolution=inputs.convolution)
+        start = info['RunStart'][run]
+        X = X[start:start + run_lengths[run]]
+        keep = np.flatnonzero(np.any(X != 0, axis=0))
+        if mask is not None and not isinstance(mask, np.ndarray):
+            mask = load_mask(mask)
+        glm = cls(X[:, keep], mask=mask, forgetting=forgetting)
+        glm.columns = [info['ColumnLabels'][j] for j in keep]
+        return glm
+
+    def _voxels(self, frame):
+        frame = np.asarray(frame, dtype=np.float64)
+        if frame.ndim == 1:
+            return frame
+        if self.mask is not None:
+            if frame.shape != self.mask.shape:
+                raise ValueError('frame has grid %s, the mask %s' % (frame.shape, self.mask.shape))
+            return frame[self.mask]
+        return frame.ravel()
+
+    def update(self, frame):
+        """Add the next frame: a volume, or a vector of (in-mask) voxels"""
+        if self.n >= self.nt:
+            raise ValueError('the design has %d rows; no frame %d' % (self.nt, self.n + 1))
+        y = self._voxels(frame)
+        x = self.X[self.n]
+        lam = self.forgetting
+        self.n += 1
+
+        if self.P is None:
+            self._frames.append(y)
+            if self.n >= self.p and np.linalg.matrix_rank(self.X[:self.n]) == self.p:
+                Xw, Yw = self._weighted()
+                self.P = np.linalg.inv(np.dot(Xw.T, Xw))
+                self._beta = np.linalg.lstsq(Xw, Yw, rcond=None)[0].T
+                self.sse = ((Yw - np.dot(Xw, self._beta.T)) ** 2).sum(axis=0)
+                self._frames = None
+            return
+
+        if self._beta.shape[0] != len(y):
+            raise ValueError('frame has %d voxels, earlier frames %d'
+                             % (len(y), self._beta.shape[0]))
+        Px = np.dot(self.P, x)
+        gain = Px / (lam + np.dot(x, Px))
+        e_prior = y - np.dot(self._beta, x)
+        self._beta += np.outer(e_prior, gain)
+        e_post = y - np.dot(self._beta, x)
+        self.P = (self.P - np.outer(gain, Px)) / lam
+        self.P = (self.P + self.P.T) / 2
+        self.sse = lam * self.sse + e_prior * e_post
+
+    def _weighted(self):
+        """Rows and frames seen so far, weighted by the forgetting factor"""
+        w = np.sqrt(self.forgetting ** np.arange(self.n - 1, -1, -1))[:, None]
+        return self.X[:self.n] * w, np.array(self._frames) * w
+
+    @property
+    def full_rank(self):
+        return self.P is not None
+
+    @property
+    def beta(self):
+        """Current estimates (voxels x regressors)"""
+        if self.P is not None:
+            return self._beta
+        if not self._frames:
+            return None
+        Xw, Yw = self._weighted()
+        return np.dot(np.linalg.pinv(Xw), Yw).T
+
+    @property
+    def dof(self):
+        return self.n - self.p
+
+    @property
+    def sigma2(self):
+        """Residual variance per voxel (None before the fit has full rank
+        and more frames than regressors)"""
+        if self.P is None or self.dof <= 0:
+            return None
+        return self.sse / self.dof
+
+    def tstat(self, columns=None):
+        """t-statistics of the betas (voxels x columns), from the diagonal
+        of P; with forgetting < 1 they are only approximate"""
+        sigma2 = self.sigma2
+        if sigma2 is None:
+            return None
+        cols = np.arange(self.p) if columns is None else np.atleast_1d(columns)
+        se = np.sqrt(sigma2[:, None] * np.diag(self.P)[cols][None, :])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(se > 0, self._beta[:, cols] / np.where(se > 0, se, 1.0), 0.0)
+
+
+def replay(fname):
+    """Frames of a 4D dataset, one volume at a time, as a stand-in for a
+    scanner feed"""
+    img = nb.load(fname)
+    for k in range(img.shape[3]):
+        yield np.asanyarray(img.dataobj[..., k])
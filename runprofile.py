@@ -0,0 +1,189 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import str
+
+import json
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Progress lines of 3dDeconvolve / 3dREMLfit that carry an elapsed time,
+# and the phase that ends when they are printed.
+_STAMP = re.compile(r'[Ee]lapsed(?: time)?\s*[=:]\s*([\d.]+)')
+_SETUP_END = re.compile(r'Calculations starting|REML setup|[Vv]oxel loop|starting.*loop')
+_FIT_END = re.compile(r'[Ww]rot|[Ww]riting|[Oo]utput dataset|GLT|loop.*(done|finished)'
+                      r'|ARMA voxel parameters')
+
+
+# ru_maxrss is in bytes on macOS, KB elsewhere
+_MAXRSS_SCALE = 1.0 if sys.platform == 'darwin' else 1024.0
+
+
+def _usage():
+    if resource is None:
+        return None
+    scale = _MAXRSS_SCALE
+    out = {}
+    for who, name in ((resource.RUSAGE_SELF, 'self'), (resource.RUSAGE_CHILDREN, 'children')):
+        ru = resource.getrusage(who)
+        out[name] = {
+            'cpu': ru.ru_utime + ru.ru_stime,
+            'maxrss': ru.ru_maxrss * scale,
+            'read': ru.ru_inblock * 512,
+            'written': ru.ru_oublock * 512,
+        }
+    return out
+
+
+def _reset_peak_rss():
+    """Reset this process's peak RSS (Linux: VmHWM). False when the
+    system has no way to do so"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss():
+    """Peak RSS of this process since the last reset, in bytes"""
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def parse_phases(output, total=None):
+    """Matrix setup / fitting / output times from AFNI progress lines
+
+    Only lines with an elapsed-time stamp can be used, so phases the
+    tool does not time are None.
+    """
+    stamps = []
+    for line in output.splitlines():
+        m = _STAMP.search(line)
+        if m:
+            stamps.append((float(m.group(1)), line))
+    stamps.sort(key=lambda s: s[0])
+
+    setup_end = next((t for t, line in stamps if _SETUP_END.search(line)), None)
+    fit_end = next((t for t, line in stamps
+                    if _FIT_END.search(line) and (setup_end is None or t > setup_end)), None)
+    if total is None and stamps:
+        total = stamps[-1][0]
+
+    phases = {'matrix_setup': setup_end, 'fitting': None, 'output': None}
+    if fit_end is not None:
+        phases['fitting'] = fit_end - (setup_end or 0.0)
+        if total is not None:
+            phases['output'] = max(total - fit_end, 0.0)
+    return phases
+
+
+class RunProfile(object):
+    """Wall/CPU time, peak RSS, I/O and phase times of one interface run
+
+    CPU time and I/O come from getrusage, for this process (in-process
+    engines) and for its waited-for children (the AFNI tools). I/O is
+    counted in file system blocks, so reads served from the page cache
+    do not show up.
+
+    ru_maxrss is a high-water mark over a process's lifetime, which in a
+    reused worker would report the largest earlier job. The peak RSS of
+    a run is therefore measured per run: for the tool, from os.wait4 on
+    its process (``add_child``); for this process, from its peak RSS
+    reset at the start of the run (Linux), or else from how much the
+    high-water mark rose during the run (None if it did not).
+    """
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.phases = {}
+        self._start = None
+        self._children = []
+        self.record = None
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._children = []
+        self._hwm_reset = _reset_peak_rss()
+        self._start = _usage()
+        return self
+
+    def add_child(self, rusage):
+        """Resource usage of a tool process run by this profile, as
+        returned by os.wait4"""
+        if rusage is not None:
+            self._children.append(rusage)
+
+    def _self_peak(self, start, end):
+        if self._hwm_reset:
+            peak = _peak_rss()
+            if peak is not None:
+                return peak
+        if end['self']['maxrss'] > start['self']['maxrss']:
+            return end['self']['maxrss']
+        return None
+
+    def __exit__(self, *args):
+        wall = time.time() - self._wall
+        end = _usage()
+        self.record = {'tool': self.tool, 'wall_time': wall}
+        if end is not None:
+            delta = dict((who, dict((k, end[who][k] - self._start[who][k])
+                                    for k in ('cpu', 'read', 'written')))
+                         for who in ('self', 'children'))
+            self_peak = self._self_peak(self._start, end)
+            child_peak = max([ru.ru_maxrss * _MAXRSS_SCALE for ru in self._children] or [None])
+            peaks = [p for p in (self_peak, child_peak) if p is not None]
+            self.record.update({
+                'cpu_time': delta['self']['cpu'] + delta['children']['cpu'],
+                'bytes_read': delta['self']['read'] + delta['children']['read'],
+                'bytes_written': delta['self']['written'] + delta['children']['written'],
+                'subprocess_cpu_time': delta['children']['cpu'],
+                'peak_rss_mb': max(peaks) / 1024.0 ** 2 if peaks else None,
+                'subprocess_peak_rss_mb': child_peak / 1024.0 ** 2
+                if child_peak is not None else None,
+            })
+        self.record['phases'] = self.phases
+        return False
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of an in-process fit"""
+        t0 = time.time()
+        yield
+        self.phases[name] = self.phases.get(name, 0.0) + time.time() - t0
+
+    def add_output(self, output):
+        """Parse phase times from the tool's stdout/stderr"""
+        for name, value in parse_phases(output).items():
+            if value is not None:
+                self.phases.setdefault(name, value)
+
+    def save(self, fname):
+        with open(fname, 'w') as fp:
+            json.dump(self.record, fp, indent=2, sort_keys=True)
+        return os.path.abspath(fname)
+
+
+@contextmanager
+def phase(profile, name):
+    """profile.phase(name), or nothing when profiling is off"""
+    if profile is None:
+        yield
+    else:
+        with profile.phase(name):
+            yield
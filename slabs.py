@@ -0,0 +1,137 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import range, str, bytes
+
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nb
+import numpy as np
+
+from jobdirs import abs_inputs
+
+
+def slab_bounds(nz, num_slabs):
+    """Split nz slices into num_slabs contiguous, near-equal ranges"""
+    num_slabs = max(1, min(num_slabs, nz))
+    edges = np.linspace(0, nz, num_slabs + 1).round().astype(int)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def _as_nifti(img, data, affine):
+    out = nb.Nifti1Image(data, affine)
+    zooms = img.header.get_zooms()
+    out.header.set_zooms(tuple(zooms[:3]) + tuple(zooms[3:len(data.shape)]))
+    if isinstance(img, nb.Nifti1Image):
+        out.header.set_xyzt_units(*img.header.get_xyzt_units())
+    else:
+        out.header.set_xyzt_units('mm', 'sec')
+    return out
+
+
+def split_slabs(in_files, bounds, out_dirs, prefix='run'):
+    """Write the z-slabs of every run
+
+    Returns, for each slab, the list of slab files (one per run).
+    """
+    slab_files = [[] for _ in bounds]
+    for r, fname in enumerate(in_files):
+        img = nb.load(fname)
+        data = np.asanyarray(img.dataobj)
+        for k, (z0, z1) in enumerate(bounds):
+            affine = img.slicer[:, :, z0:z1].affine
+            slab = _as_nifti(img, data[:, :, z0:z1], affine)
+            path = os.path.join(out_dirs[k], '%s%02d_slab.nii' % (prefix, r))
+            nb.save(slab, path)
+            slab_files[k].append(path)
+    return slab_files
+
+
+def _fix_afni_ext(header, shape):
+    """Keep the AFNI extension (sub-brick labels) consistent with the new
+    grid, otherwise AFNI ignores it"""
+    def repl(m):
+        nums = m.group(1).split(',')
+        nums[:len(shape)] = ['%d' % n for n in shape]
+        return 'NIfTI_nums="%s"' % ','.join(nums)
+
+    for i, ext in enumerate(header.extensions):
+        if ext.get_code() != 4:
+            continue
+        content = ext.get_content()
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'ignore')
+        content = re.sub(r'NIfTI_nums="([^"]*)"', repl, content)
+        header.extensions[i] = nb.nifti1.Nifti1Extension('afni', content.encode('utf-8'))
+    return header
+
+
+def stitch_slabs(slab_outputs, affine, out_file):
+    """Concatenate slab datasets along z into out_file"""
+    imgs = [nb.load(f) for f in slab_outputs]
+    data = np.concatenate([np.asanyarray(img.dataobj) for img in imgs], axis=2)
+    header = imgs[0].header.copy()
+    out = nb.Nifti1Image(data, affine, header=header)
+    _fix_afni_ext(out.header, data.shape)
+    nb.save(out, out_file)
+    return out_file
+
+
+def _run_slab(args):
+    klass, inputs, cwd = args
+    os.chdir(cwd)
+    result = klass(**inputs).run()
+    return result.outputs.get()
+
+
+def run_slabs(interface, stitch, copy=None, num_workers=2, num_slabs=None,
+              slab_inputs=('slab_workers', 'num_slabs', 'profile'), split=('mask',)):
+    """Fit an interface slab by slab in a local process pool
+
+    The input volume is cut into z-slabs, a copy of ``interface`` (same
+    inputs except ``in_file``) runs on each slab in its own directory,
+    and the outputs named in ``stitch`` (output name -> destination) are
+    concatenated back into full datasets. Outputs that do not depend on
+    the voxels (e.g. the design matrix) are taken from the first slab and
+    copied to the destinations in ``copy``. Volume inputs named in
+    ``split`` (e.g. a mask) are cut into the same slabs. More slabs than
+    workers (twice as many by default) keeps the pool busy when edge
+    slabs contain few brain voxels.
+    """
+    in_files = interface.inputs.in_file
+    if not isinstance(in_files, list):
+        in_files = [in_files]
+    first = nb.load(in_files[0])
+    if num_slabs is None:
+        num_slabs = 2 * num_workers
+    bounds = slab_bounds(first.shape[2], num_slabs)
+
+    workdir = os.path.abspath('slabs')
+    out_dirs = [os.path.join(workdir, 'slab%03d' % k) for k in range(len(bounds))]
+    for d in out_dirs:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    slab_files = split_slabs(in_files, bounds, out_dirs)
+
+    inputs = abs_inputs(interface.inputs.get_traitsfree())
+    for name in slab_inputs:
+        inputs.pop(name, None)
+    split_files = dict((name, split_slabs([inputs[name]], bounds, out_dirs, prefix=name))
+                       for name in split if name in inputs)
+    jobs = []
+    for k, (files, d) in enumerate(zip(slab_files, out_dirs)):
+        slab_in = dict(inputs)
+        slab_in['in_file'] = files
+        for name, parts in split_files.items():
+            slab_in[name] = parts[k][0]
+        jobs.append((interface.__class__, slab_in, d))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        results = list(pool.map(_run_slab, jobs))
+
+    for name, dest in stitch.items():
+        stitch_slabs([res[name] for res in results], first.affine, dest)
+    for name, dest in (copy or {}).items():
+        shutil.copyfile(results[0][name], dest)
+    shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,165 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import str
+
+import hashlib
+import re
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+
+# onset[*amp1,amp2,...][:duration]
+_EVENT = re.compile(r'(?:^|(?<=\s))([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+                    r'(?:\*([^\s:]*))?'
+                    r'(?::([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?))?(?=\s|$)')
+_NUMBER_TOKEN = re.compile(r'[^\s*]')
+
+_CACHE = OrderedDict()
+_CACHE_SIZE = 4096
+
+
+class StimRun(object):
+    """Events of one run: onsets, durations (NaN when not given) and
+    amplitudes (events x amplitudes, empty when not married)"""
+
+    __slots__ = ('onsets', 'durations', 'amplitudes')
+
+    def __init__(self, onsets, durations, amplitudes):
+        self.onsets = onsets
+        self.durations = durations
+        self.amplitudes = amplitudes
+
+    def __len__(self):
+        return len(self.onsets)
+
+
+def _frozen(a):
+    a.flags.writeable = False
+    return a
+
+
+def _parse_uniform(line):
+    """Fast path: every event has the same fields as the first one, so
+    the whole line is one array of numbers. Returns None otherwise."""
+    tokens = line.split()
+    if '*' in tokens:
+        return None
+    first = tokens[0]
+    namps = first.count(',') + 1 if '*' in first else 0
+    has_dur = ':' in first
+    n = len(tokens)
+    if line.count('*') != (n if namps else 0) or line.count(':') != (n if has_dur else 0) \
+            or line.count(',') != n * max(namps - 1, 0):
+        return None
+    nfields = 1 + namps + has_dur
+    text = line.replace('*', ' ').replace(':', ' ').replace(',', ' ')
+    try:
+        # trailing garbage is a DeprecationWarning or a ValueError depending on numpy
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            flat = np.fromstring(text, dtype=np.float64, sep=' ')
+    except ValueError:
+        return None
+    if flat.size != n * nfields:
+        return None
+    fields = flat.reshape(n, nfields)
+    durations = fields[:, -1].copy() if has_dur else np.full(n, np.nan)
+    return StimRun(_frozen(fields[:, 0].copy()), _frozen(durations),
+                   _frozen(fields[:, 1:1 + namps].copy()))
+
+
+def _parse_line(line, fname, lineno):
+    run = _parse_uniform(line) if line.strip('* \t') else None
+    if run is not None:
+        return run
+
+    events = _EVENT.findall(line)
+    ntokens = sum(1 for tok in line.split() if _NUMBER_TOKEN.match(tok))
+    if len(events) != ntokens:
+        raise ValueError('%s, line %d: cannot parse %r' % (fname, lineno, line))
+    if not events:
+        empty = np.zeros(0)
+        return StimRun(_frozen(empty), _frozen(empty.copy()), _frozen(np.zeros((0, 0))))
+
+    onsets = np.array([e[0] for e in events], dtype=np.float64)
+    durations = np.array([e[2] or 'nan' for e in events], dtype=np.float64)
+    amplitudes = np.zeros((len(onsets), 0))
+    if any(e[1] for e in events):
+        amps = [e[1].split(',') if e[1] else [] for e in events]
+        if len(set(len(a) for a in amps)) != 1:
+            raise ValueError('%s, line %d: events have different numbers of amplitudes'
+                             % (fname, lineno))
+        amplitudes = np.array(amps, dtype=np.float64)
+    return StimRun(_frozen(onsets), _frozen(durations), _frozen(amplitudes))
+
+
+def parse_stim_file(fname):
+    """Events of every line of an AFNI stim_times file
+
+    Comments ('#') and blank lines are skipped; a line holding only '*'
+    is a run without events. Parsed files are cached by content hash,
+    so the same timing under many names or read by several steps is
+    parsed once. The returned arrays are read-only.
+    """
+    with open(fname, 'rb') as fp:
+        raw = fp.read()
+    key = hashlib.sha1(raw).hexdigest()
+    if key in _CACHE:
+        _CACHE[key] = _CACHE.pop(key)
+        return _CACHE[key]
+
+    runs = []
+    for lineno, line in enumerate(raw.decode('utf-8', 'replace').splitlines(), 1):
+        line = line.split('#', 1)[0].strip()
+        if line:
+            runs.append(_parse_line(line, fname, lineno))
+
+    _CACHE[key] = runs
+    while len(_CACHE) > _CACHE_SIZE:
+        _CACHE.popitem(last=False)
+    return runs
+
+
+def _concat(runs):
+    if not runs:
+        return StimRun(np.zeros(0), np.zeros(0), np.zeros((0, 0)))
+    namps = set(r.amplitudes.shape[1] for r in runs if len(r))
+    if len(namps) > 1:
+        raise ValueError('runs have different numbers of amplitudes')
+    width = namps.pop() if namps else 0
+    return StimRun(np.concatenate([r.onsets for r in runs]),
+                   np.concatenate([r.durations for r in runs]),
+                   np.vstack([r.amplitudes.reshape(len(r), width) for r in runs]))
+
+
+def stim_runs(fname, timing='local', run_lengths=None, tr=None):
+    """Events per run of a stim_times file, as StimRun objects
+
+    Onsets are relative to the start of their run. Local files have one
+    line per run. Global files list times from the start of the first
+    run and are split using ``run_lengths`` (volumes) and ``tr``.
+    """
+    lines = parse_stim_file(fname)
+    if timing == 'local':
+        if run_lengths is not None and len(lines) != len(run_lengths):
+            raise ValueError('%s has %d runs of timing but there are %d input runs'
+                             % (fname, len(lines), len(run_lengths)))
+        return lines
+
+    events = _concat(lines)
+    if run_lengths is None:
+        return [events]
+    bounds = np.concatenate([[0], np.cumsum(run_lengths)]) * tr
+    run = np.searchsorted(bounds, events.onsets, side='right') - 1
+    runs = []
+    for r, start in enumerate(bounds[:-1]):
+        sel = run == r
+        runs.append(StimRun(events.onsets[sel] - start, events.durations[sel],
+                            events.amplitudes[sel]))
+    return runs
+
+
+def read_stim_times(fname, timing='local', run_lengths=None, tr=None):
+    """(onsets, durations) arrays per run of a stim_times file; see stim_runs"""
+    return [(r.onsets, r.durations) for r in stim_runs(fname, timing, run_lengths, tr)]
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def dataset(tmpdir):
+    """Two 120-volume runs (TR 2s) on a 4x5x6 grid with two stimuli:
+    the timing files, the runs and the design matrix they were made from
+
+    The data is the design times random betas plus AR(1) noise, so
+    every voxel has signal and a nonzero residual variance.
+    """
+    import nibabel as nb
+    import numpy as np
+    from design import build_design, save_design
+
+    rng = np.random.RandomState(42)
+    nt, tr, shape = 120, 2.0, (4, 5, 6)
+    stims = []
+    for name, times in [('aud', [[10, 52.5, 97, 150], [20, 61, 130.5, 200]]),
+                        ('vis', [[30, 80, 121, 170, 215], [5.5, 44, 90, 160]])]:
+        fname = str(tmpdir.join('%s.1D' % name))
+        with open(fname, 'w') as fp:
+            for run in times:
+                fp.write(' '.join('%g' % t for t in run) + '\n')
+        stims.append(fname)
+    models, labels = ['GAM', 'BLOCK(5,1)'], ['aud', 'vis']
+    X, info = build_design(stims, models, labels, [nt, nt], tr, polort=1)
+    xmat = str(tmpdir.join('X.xmat.1D'))
+    save_design(xmat, X, info)
+
+    nvox = int(np.prod(shape))
+    beta = rng.randn(nvox, X.shape[1]) + 100 * (np.arange(X.shape[1]) % 2 == 0)
+    noise = rng.randn(nvox, 2 * nt)
+    for k in range(1, 2 * nt):
+        noise[:, k] += 0.4 * noise[:, k - 1]
+    Y = np.dot(beta, X.T) + noise
+    runs = []
+    for r in range(2):
+        img = nb.Nifti1Image(Y[:, r * nt:(r + 1) * nt].reshape(shape + (nt,)).astype(np.float32),
+                             np.eye(4))
+        img.header.set_zooms((2.0, 2.0, 2.0, tr))
+        fname = str(tmpdir.join('r%d.nii.gz' % (r + 1)))
+        nb.save(img, fname)
+        runs.append(fname)
+    return {'runs': runs, 'stims': stims, 'models': models, 'labels': labels,
+            'xmat': xmat, 'X': X, 'info': info, 'Y': Y, 'shape': shape, 'tr': tr}
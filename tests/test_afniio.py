@@ -0,0 +1,79 @@
+import nibabel as nb
+import numpy as np
+
+from afniio import load_bucket, load_series, parcel_series
+from deconv1 import Decon
+
+
+def _mask(dataset, tmpdir):
+    rng = np.random.RandomState(5)
+    mask = rng.rand(*dataset['shape']) > 0.4
+    fname = str(tmpdir.join('mask.nii.gz'))
+    nb.save(nb.Nifti1Image(mask.astype(np.uint8), np.eye(4)), fname)
+    return mask, fname
+
+
+def test_masked_series_are_the_in_mask_rows(dataset, tmpdir):
+    mask, _ = _mask(dataset, tmpdir)
+    full, shape, _, _ = load_series(dataset['runs'])
+    assert tuple(shape) == dataset['shape']
+    np.testing.assert_allclose(full, dataset['Y'], rtol=1e-6)
+    masked = load_series(dataset['runs'], mask=mask)[0]
+    np.testing.assert_array_equal(masked, full[mask.ravel()])
+    mapped = load_series(dataset['runs'], mask=mask, mmap_file=str(tmpdir.join('Y.dat')))[0]
+    np.testing.assert_array_equal(mapped, masked)
+
+
+def test_masked_decon_matches_full_volume(dataset, tmpdir):
+    mask, fname = _mask(dataset, tmpdir)
+
+    def run(name, **kwargs):
+        out = Decon(in_file=dataset['runs'], stim_files=dataset['stims'], num_stimts=2,
+                    models=dataset['models'], labels=dataset['labels'], polort=1,
+                    xmat_builder='python', engine='numpy', fout=True, tout=True,
+                    **kwargs).run(cwd=str(tmpdir.mkdir(name))).outputs
+        return load_bucket(out.out_file)[0]
+
+    full = run('full')
+    masked = run('masked', mask=fname)
+    inside = mask.ravel()
+    np.testing.assert_array_equal(masked[inside], full[inside])
+    assert not masked[~inside].any()
+
+
+def _atlas(dataset, tmpdir):
+    rng = np.random.RandomState(6)
+    labels = rng.choice([0, 3, 7, 12], size=dataset['shape'])
+    fname = str(tmpdir.join('atlas.nii.gz'))
+    nb.save(nb.Nifti1Image(labels.astype(np.int16), np.eye(4)), fname)
+    return labels, fname
+
+
+def test_parcel_series_are_parcel_means(dataset, tmpdir):
+    labels, fname = _atlas(dataset, tmpdir)
+    mask, _ = _mask(dataset, tmpdir)
+    Y = np.float32(dataset['Y'])
+    series, parcels = parcel_series(dataset['runs'], fname, mask=mask, chunk_size=7)
+    assert list(parcels) == [3, 7, 12]
+    for k, p in enumerate(parcels):
+        sel = (labels.ravel() == p) & mask.ravel()
+        np.testing.assert_allclose(series[k], Y[sel].mean(axis=0), rtol=1e-5)
+
+
+def test_atlas_decon_fits_parcel_means(dataset, tmpdir):
+    labels, fname = _atlas(dataset, tmpdir)
+    out = Decon(in_file=dataset['runs'], stim_files=dataset['stims'], num_stimts=2,
+                models=dataset['models'], labels=dataset['labels'], polort=1,
+                xmat_builder='python', atlas=fname, tout=True,
+                ).run(cwd=str(tmpdir.mkdir('atlas'))).outputs
+    with open(out.out_table) as fp:
+        names = fp.readline().rstrip('\n').split('\t')
+    table = np.loadtxt(out.out_table, skiprows=1, ndmin=2)
+    assert list(table[:, 0]) == [3, 7, 12]
+    X, Y = dataset['X'], np.float32(dataset['Y']).astype(np.float64)
+    cols = dataset['info']['ColumnLabels']
+    for row, p in zip(table, [3, 7, 12]):
+        beta = np.linalg.lstsq(X, Y[labels.ravel() == p].mean(axis=0), rcond=None)[0]
+        for label in ['aud#0', 'vis#0']:
+            np.testing.assert_allclose(row[names.index('%s_Coef' % label)],
+                                       beta[cols.index(label)], rtol=1e-4, atol=1e-5)
@@ -0,0 +1,49 @@
+import os
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from batchrun import run_batch
+from deconv1 import Decon
+from jobdirs import abs_inputs, check_collisions, job_dirs, output_paths, working_directory
+
+
+def _decon(dataset, **kwargs):
+    inputs = dict(in_file=dataset['runs'], stim_files=dataset['stims'], num_stimts=2,
+                  models=dataset['models'], labels=dataset['labels'], polort=1,
+                  xmat_builder='python', engine='numpy', tout=True)
+    inputs.update(kwargs)
+    return Decon(**inputs)
+
+
+def test_batch_results_match_single_runs(dataset, tmpdir):
+    single = _decon(dataset).run(cwd=str(tmpdir.mkdir('single'))).outputs.out_file
+    lines = []
+    # the afni job cannot run here (or fails on the test data) without stopping the batch
+    results = run_batch([_decon(dataset), _decon(dataset, engine='afni'), _decon(dataset)],
+                        max_jobs=2, on_line=lambda *args: lines.append(args),
+                        work_dir=str(tmpdir.join('batch')))
+    assert [r.index for r in results] == [0, 1, 2]
+    assert results[0].ok and results[2].ok and not results[1].ok
+    assert results[1].error and all(index == 1 for index, _, _ in lines)
+    assert results[0].outputs['out_file'] != results[2].outputs['out_file']
+    for res in (results[0], results[2]):
+        np.testing.assert_array_equal(nb.load(res.outputs['out_file']).get_fdata(),
+                                      nb.load(single).get_fdata())
+
+
+def test_job_directories(dataset, tmpdir):
+    dirs = job_dirs(str(tmpdir.join('work')), 2)
+    assert [os.path.basename(d) for d in dirs] == ['job0000', 'job0001']
+    assert all(os.path.isdir(d) for d in dirs)
+    with working_directory(dirs[1]):
+        relative = abs_inputs({'in_file': [os.path.basename(dataset['runs'][0])],
+                               'polort': 1})
+        paths = output_paths(_decon(dataset, out_file='/elsewhere/stats.nii.gz'))
+    assert relative['in_file'] == ['r1.nii.gz'] and relative['polort'] == 1
+    assert os.path.join(dirs[1], 'stats_stats.nii.gz') in paths
+    assert all(os.path.dirname(p) == dirs[1] for p in paths)
+    check_collisions([paths, [p.replace('job0001', 'job0000') for p in paths]])
+    with pytest.raises(ValueError, match='jobs 0 and 1 would both write'):
+        check_collisions([paths[:1], paths])
@@ -0,0 +1,67 @@
+import nibabel as nb
+import numpy as np
+import pytest
+
+from afniio import save_bucket
+from betastore import BetaStore
+from groupbetasv1 import GroupBetas
+
+SHAPE = (3, 4, 2)
+LABELS = ['Run#1Pol#0_Coef', 'aud#0_Coef', 'aud#0_Tstat', 'vis#0_Coef']
+
+
+def _buckets(tmpdir, nsub=4):
+    rng = np.random.RandomState(4)
+    nvox = int(np.prod(SHAPE))
+    buckets, data = [], []
+    for s in range(nsub):
+        bricks = rng.randn(nvox, len(LABELS)).astype(np.float32)
+        fname = str(tmpdir.join('sub%d.nii.gz' % s))
+        save_bucket(fname, bricks, SHAPE, np.diag([2, 2, 2, 1]), LABELS)
+        buckets.append(fname)
+        data.append(bricks)
+    return buckets, np.array(data)
+
+
+def test_store_holds_selected_bricks(tmpdir):
+    buckets, data = _buckets(tmpdir)
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[1:, 2:] = True
+    store = BetaStore.create(str(tmpdir.join('store')), buckets, ['s0', 's1', 's2', 's3'],
+                             labels=['vis#0_Coef', 'aud#0_Coef'], mask=mask)
+    inside = mask.ravel()
+    expected = data[:, inside][:, :, [3, 1]]
+    np.testing.assert_array_equal(store.data, expected)
+    np.testing.assert_array_equal(store.get(label='aud#0_Coef'), expected[:, :, 1])
+    np.testing.assert_array_equal(store.get(subject='s2'), expected[2])
+    np.testing.assert_array_equal(store.get(subject=['s3', 's0'], label='vis#0_Coef'),
+                                  expected[[3, 0], :, 0])
+    assert isinstance(store.data, np.memmap)
+
+    # reopened from disk
+    again = BetaStore(store.path)
+    assert again.subjects == ['s0', 's1', 's2', 's3'] and again.shape == SHAPE
+    np.testing.assert_array_equal(again.mask, mask)
+    np.testing.assert_array_equal(again.affine, np.diag([2, 2, 2, 1]))
+    with pytest.raises(ValueError):
+        again.get(label='nope')
+
+
+def test_store_errors(tmpdir):
+    buckets, _ = _buckets(tmpdir, 2)
+    with pytest.raises(ValueError):
+        BetaStore.create(str(tmpdir.join('a')), buckets, ['s0'])
+    with pytest.raises(ValueError):
+        BetaStore.create(str(tmpdir.join('b')), buckets, ['s0', 's0'])
+    with pytest.raises(ValueError, match='no sub-brick labelled'):
+        BetaStore.create(str(tmpdir.join('c')), buckets, ['s0', 's1'], labels=['x#0_Coef'])
+
+
+def test_groupbetas_interface(tmpdir):
+    buckets, data = _buckets(tmpdir, 3)
+    mask = str(tmpdir.join('mask.nii.gz'))
+    nb.save(nb.Nifti1Image(np.ones(SHAPE, dtype=np.uint8), np.eye(4)), mask)
+    out = GroupBetas(in_files=buckets, subjects=['a', 'b', 'c'], labels=['aud#0_Coef'],
+                     mask=mask, out_dir=str(tmpdir.join('store'))).run().outputs
+    store = BetaStore(out.out_dir)
+    np.testing.assert_array_equal(store.get(label='aud#0_Coef'), data[:, :, 1])
@@ -0,0 +1,78 @@
+import os
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from afniio import load_bucket
+from deconv1 import Decon, fit_shared_designs
+
+
+def _decon(dataset, **kwargs):
+    inputs = dict(in_file=dataset['runs'], stim_files=dataset['stims'], num_stimts=2,
+                  models=dataset['models'], labels=dataset['labels'], polort=1,
+                  xmat_builder='python', engine='numpy', fout=True, tout=True)
+    inputs.update(kwargs)
+    return Decon(**inputs)
+
+
+def test_shared_designs_match_single_fits(dataset, tmpdir):
+    single = []
+    for k in range(3):
+        out = _decon(dataset).run(cwd=str(tmpdir.mkdir('single%d' % k))).outputs
+        single.append(nb.load(out.out_file).get_fdata())
+    shared = fit_shared_designs([_decon(dataset) for _ in range(3)], batch_size=2,
+                                work_dir=str(tmpdir.join('shared')))
+    assert len(set(out['out_file'] for out in shared)) == 3
+    for out, expected in zip(shared, single):
+        assert os.path.exists(out['out_xmat'])
+        np.testing.assert_allclose(nb.load(out['out_file']).get_fdata(), expected, rtol=1e-5)
+
+
+def test_shared_designs_reject_afni_engine(dataset, tmpdir):
+    interfaces = [_decon(dataset), _decon(dataset)]
+    interfaces[1].inputs.engine = 'afni'
+    with pytest.raises(ValueError, match='afni engine'):
+        fit_shared_designs(interfaces, work_dir=str(tmpdir))
+
+
+def test_numpy_engine_matches_lstsq(dataset, tmpdir):
+    out = _decon(dataset).run(cwd=str(tmpdir.mkdir('single'))).outputs
+    data, names, shape, _ = load_bucket(out.out_file)
+    assert tuple(shape) == dataset['shape']
+    np.testing.assert_allclose(np.loadtxt(out.out_xmat), dataset['X'], atol=1e-4)
+    Y = np.float32(dataset['Y']).astype(np.float64)
+    beta = np.linalg.lstsq(dataset['X'], Y.T, rcond=None)[0].T
+    labels = dataset['info']['ColumnLabels']
+    for col, label in enumerate(labels):
+        if not label.startswith('Run#'):
+            np.testing.assert_allclose(data[:, names.index('%s_Coef' % label)], beta[:, col],
+                                       rtol=1e-4, atol=1e-3)
+
+
+def test_alternatives_match_separate_fits(dataset, tmpdir):
+    alternatives = [{'name': 'spm', 'models': ['SPMG2', 'BLOCK(5,1)']},
+                    {'name': 'p3', 'polort': 3}]
+    out = _decon(dataset, alternatives=alternatives).run(cwd=str(tmpdir.mkdir('all'))).outputs
+    assert len(out.out_alternatives) == 2
+
+    Y = np.float32(dataset['Y']).astype(np.float64)
+    sse, ranks = [], []
+    for alt, bucket, xmat in zip([{}] + alternatives, [out.out_file] + out.out_alternatives,
+                                 [out.out_xmat] + out.out_alt_xmats):
+        overrides = dict((k, v) for k, v in alt.items() if k != 'name')
+        expected = _decon(dataset, **overrides).run(cwd=str(tmpdir.mkdir('single_%s' % alt.get('name', 'main'))))
+        np.testing.assert_allclose(load_bucket(bucket)[0],
+                                   load_bucket(expected.outputs.out_file)[0],
+                                   rtol=1e-5, atol=1e-4)
+        X = np.loadtxt(xmat)
+        res = np.linalg.lstsq(X, Y.T, rcond=None)[1]
+        sse.append(res)
+        ranks.append(np.linalg.matrix_rank(X))
+
+    nt = Y.shape[1]
+    aic = np.column_stack([nt * np.log(s / nt) + 2 * k for s, k in zip(sse, ranks)])
+    comparison, names, _, _ = load_bucket(out.out_comparison)
+    assert names == ['main_AIC', 'spm_AIC', 'p3_AIC', 'best_AIC', 'best_BIC']
+    np.testing.assert_allclose(comparison[:, :3], aic, rtol=1e-4, atol=1e-2)
+    np.testing.assert_array_equal(comparison[:, 3], np.argmin(aic, axis=1))
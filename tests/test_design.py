@@ -0,0 +1,106 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import warnings
+
+import numpy as np
+import pytest
+
+from design import build_design, check_design_inputs
+
+
+def _write(tmpdir, name, lines):
+    fname = str(tmpdir.join(name))
+    with open(fname, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    return fname
+
+
+def test_onsets_outside_run_ignored(tmpdir, dataset):
+    # 3dDeconvolve drops stimulus times before the start or past the end
+    # of their run; the design equals one built without them
+    outside = _write(tmpdir, 'outside.1D', ['-3 10 52.5 239.9 240 300', '-0.5 20'])
+    inside = _write(tmpdir, 'inside.1D', ['10 52.5 239.9', '20'])
+    for model in ['GAM', 'BLOCK(5,1)', 'TENT(0,10,6)']:
+        X_out, _ = build_design([outside], [model], ['x'], [120, 120], 2.0, polort=-1)
+        X_in, _ = build_design([inside], [model], ['x'], [120, 120], 2.0, polort=-1)
+        np.testing.assert_array_equal(X_out, X_in)
+
+    # no tail of the event at -3s in the first volumes
+    X, _ = build_design([_write(tmpdir, 'early.1D', ['-3', '*'])], ['GAM'], ['x'],
+                        [120, 120], 2.0, polort=-1)
+    assert not X.any()
+
+
+def test_outside_onsets_warn(tmpdir, dataset):
+    late = _write(tmpdir, 'late.1D', ['10 400', '20 30'])
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        lengths, tr = check_design_inputs(dataset['runs'], [late], ['GAM'], ['x'], 1)
+    assert lengths == [120, 120] and tr == 2.0
+    assert any('ignored' in str(w.message) for w in caught)
+
+
+def test_inconsistent_inputs_raise(tmpdir, dataset):
+    with pytest.raises(ValueError):
+        check_design_inputs(dataset['runs'], dataset['stims'], dataset['models'],
+                            dataset['labels'], 3)
+    one_run = _write(tmpdir, 'one.1D', ['10 20'])
+    with pytest.raises(ValueError):
+        check_design_inputs(dataset['runs'], [one_run], ['GAM'], ['x'], 1)
+
+
+def _gam(t, p=8.6, q=0.547):
+    ts = np.maximum(t, 0)
+    return np.where(t > 0, (ts / (p * q)) ** p * np.exp(p - ts / q), 0.0)
+
+
+def _tents(t, start, stop, n):
+    width = (stop - start) / (n - 1)
+    knots = start + width * np.arange(n)
+    return np.maximum(0, 1 - np.abs(t[..., None] - knots) / width)
+
+
+def test_design_matches_afni_definitions(tmpdir):
+    # the regressors written out from the 3dDeconvolve model definitions
+    tr, lengths = 2.0, [100, 80]
+    times = [[10, 33.3, 150], [4, 71.5]]
+    stim = _write(tmpdir, 'stim.1D', [' '.join(map(str, run)) for run in times])
+    X, info = build_design([stim, stim], ['GAM', 'TENT(0,12,4)'], ['g', 't'],
+                           lengths, tr, polort='A')
+
+    assert info['ColumnLabels'] == ['Run#1Pol#0', 'Run#1Pol#1', 'Run#1Pol#2',
+                                    'Run#2Pol#0', 'Run#2Pol#1', 'Run#2Pol#2',
+                                    'g#0', 't#0', 't#1', 't#2', 't#3']
+    assert info['ColumnGroups'] == [-1] * 6 + [1] + [2] * 4
+    assert list(info['RunStart']) == [0, 100]
+
+    expected = np.zeros((180, 11))
+    for r, (start, n) in enumerate(zip([0, 100], lengths)):
+        x = np.linspace(-1, 1, n)
+        expected[start:start + n, 3 * r:3 * r + 3] = np.column_stack(
+            [np.ones(n), x, (3 * x ** 2 - 1) / 2])
+        t = tr * np.arange(n)[:, None] - np.array(times[r])[None, :]
+        expected[start:start + n, 6] = _gam(t).sum(axis=1)
+        expected[start:start + n, 7:] = _tents(t, 0, 12, 4).sum(axis=1)
+    np.testing.assert_allclose(X, expected, atol=1e-10)
+
+
+def test_block_regressor_shape(tmpdir):
+    from scipy.integrate import quad
+    stim = _write(tmpdir, 'block.1D', ['20'])
+    X, _ = build_design([stim], ['BLOCK(6,1)'], ['b'], [60], 1.5, polort=-1)
+
+    def block(t):
+        return quad(lambda s: (t - s) ** 4 * np.exp(-(t - s)), 0, min(t, 6))[0] if t > 0 else 0
+    ref = np.array([block(1.5 * k - 20) for k in range(60)])
+    fine = np.array([block(t) for t in np.arange(0, 25, 0.01)])
+    # BLOCK(d,1) is scaled to a peak of 1
+    np.testing.assert_allclose(X[:, 0], ref / fine.max(), atol=1e-3)
+
+
+def test_global_timing_matches_local(tmpdir):
+    local = _write(tmpdir, 'local.1D', ['10 50', '6 30.5'])
+    glob = _write(tmpdir, 'global.1D', ['10 50 206 230.5'])
+    X_l, _ = build_design([local], ['GAM'], ['x'], [100, 100], 2.0, polort=1)
+    X_g, _ = build_design([glob], ['GAM'], ['x'], [100, 100], 2.0, polort=1, timing='global')
+    np.testing.assert_array_equal(X_l, X_g)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from diagnostics import design_diagnostics, preflight
+
+
+def _design(rng, nt=100):
+    base = np.column_stack([np.ones(nt), np.linspace(-1, 1, nt)])
+    sig = rng.randn(nt, 3)
+    sig[:, 2] += 0.9 * sig[:, 0]
+    info = {'ColumnLabels': ['Run#1Pol#0', 'Run#1Pol#1', 'a#0', 'b#0', 'c#0'],
+            'ColumnGroups': [-1, -1, 1, 2, 3]}
+    return np.column_stack([base, sig]), info
+
+
+def test_condition_and_vif_match_definitions():
+    X, info = _design(np.random.RandomState(0))
+    report = design_diagnostics(X, info, max_vif=1e9)
+    Xn = X / np.linalg.norm(X, axis=0)
+    np.testing.assert_allclose(report['condition']['X'], np.linalg.cond(Xn))
+    np.testing.assert_allclose(report['condition']['Xsignal'], np.linalg.cond(Xn[:, 2:]))
+    for j, label in zip([2, 3, 4], ['a#0', 'b#0', 'c#0']):
+        # VIF = 1 / (1 - R^2) of the regressor on all other columns
+        others = np.delete(X, j, axis=1)
+        fit = np.dot(others, np.linalg.lstsq(others, X[:, j], rcond=None)[0])
+        centred = X[:, j] - np.dot(X[:, :2], np.linalg.lstsq(X[:, :2], X[:, j], rcond=None)[0])
+        r2 = 1 - np.sum((X[:, j] - fit) ** 2) / np.sum(centred ** 2)
+        np.testing.assert_allclose(report['vif'][label], 1 / (1 - r2), rtol=1e-8)
+    assert report['problems'] == []
+
+
+def test_problems_are_reported():
+    X, info = _design(np.random.RandomState(1))
+    X[:, 3] = 0
+    X[:, 4] = X[:, 2] + 1e-3 * np.random.RandomState(2).randn(len(X))
+    report = design_diagnostics(X, info)
+    problems = '\n'.join(report['problems'])
+    assert 'b#0 is all zero' in problems
+    assert 'a#0 and c#0 are correlated' in problems
+    assert 'variance inflation of a#0' in problems
+    with pytest.raises(ValueError, match='Ill-conditioned'):
+        preflight(X, info, mode='fail')
+
+    X, info = _design(np.random.RandomState(3))
+    X[:, 3] = 2 * X[:, 0] - X[:, 1]
+    assert 'regressor b#0 is explained by the baseline' in design_diagnostics(X, info)['problems']
@@ -0,0 +1,61 @@
+import numpy as np
+
+from glmengine import OLSDesign, decon_bucket, shared_design
+
+
+def _design(rng, nt=80):
+    X = np.column_stack([np.ones(nt), np.linspace(-1, 1, nt), rng.randn(nt, 3)])
+    info = {'ColumnLabels': ['Run#1Pol#0', 'Run#1Pol#1', 'a#0', 'b#0', 'b#1'],
+            'ColumnGroups': [-1, -1, 1, 2, 2], 'StimLabels': ['a', 'b'],
+            'StimBots': [2, 3], 'StimTops': [2, 4]}
+    return X, info
+
+
+def test_ols_matches_lstsq():
+    rng = np.random.RandomState(0)
+    X, _ = _design(rng)
+    Y = rng.randn(25, X.shape[0])
+    beta, sse = OLSDesign(X).fit(Y, chunk_size=7)
+    expected, res = np.linalg.lstsq(X, Y.T, rcond=None)[:2]
+    np.testing.assert_allclose(beta, expected.T, atol=1e-10)
+    np.testing.assert_allclose(sse, res, rtol=1e-10)
+
+
+def test_collinear_design_gives_minimum_norm_solution():
+    rng = np.random.RandomState(1)
+    X, _ = _design(rng)
+    X = np.column_stack([X, X[:, 2]])
+    Y = rng.randn(5, X.shape[0])
+    design = OLSDesign(X)
+    assert design.rank == X.shape[1] - 1 and design.dof == X.shape[0] - design.rank
+    np.testing.assert_allclose(design.fit(Y)[0], np.linalg.lstsq(X, Y.T, rcond=None)[0].T,
+                               atol=1e-10)
+
+
+def test_bucket_statistics_match_nested_models():
+    rng = np.random.RandomState(2)
+    X, info = _design(rng)
+    Y = rng.randn(30, X.shape[0]) + np.dot(rng.randn(30, X.shape[1]), X.T)
+    design = OLSDesign(X)
+    beta, sse = design.fit(Y)
+    bricks, names = decon_bucket(design, info, beta, sse, fout=True, rout=True, tout=True)
+    sigma2 = sse / design.dof
+
+    def reduced_sse(drop):
+        keep = [c for c in range(X.shape[1]) if c not in drop]
+        return OLSDesign(X[:, keep]).fit(Y)[1]
+
+    for name, cols in [('Full', [2, 3, 4]), ('a', [2]), ('b', [3, 4])]:
+        F = (reduced_sse(cols) - sse) / len(cols) / sigma2
+        np.testing.assert_allclose(bricks[:, names.index('%s_Fstat' % name)], F, rtol=1e-4)
+    np.testing.assert_allclose(bricks[:, names.index('Full_R^2')],
+                               1 - sse / reduced_sse([2, 3, 4]), rtol=1e-4)
+    t = beta[:, 3] / np.sqrt(sigma2 * np.linalg.inv(np.dot(X.T, X))[3, 3])
+    np.testing.assert_allclose(bricks[:, names.index('b#0_Tstat')], t, rtol=1e-4)
+    np.testing.assert_allclose(bricks[:, names.index('b#1_Coef')], beta[:, 4], rtol=1e-5)
+
+
+def test_shared_design_is_reused_for_equal_matrices():
+    X, _ = _design(np.random.RandomState(3))
+    assert shared_design(X) is shared_design(X.copy())
+    assert shared_design(X) is not shared_design(X[:, :-1])
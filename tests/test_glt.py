@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from glmengine import contrast_stats
+from glt import GLTMatrix, parse_sym
+
+COLUMNS = ['Run#1Pol#0', 'Run#1Pol#1', 'vis#0', 'aud#0',
+           'ten#0', 'ten#1', 'ten#2', 'ten#3']
+
+
+def _row(**weights):
+    row = np.zeros(len(COLUMNS))
+    for label, w in weights.items():
+        row[COLUMNS.index(label.replace('_', '#'))] = w
+    return row
+
+
+@pytest.mark.parametrize('sym, rows', [
+    ('+vis', [_row(vis_0=1)]),
+    ('SYM: +vis -aud', [_row(vis_0=1, aud_0=-1)]),
+    ('-0.5*aud + 2*vis', [_row(vis_0=2, aud_0=-0.5)]),
+    ('+ten[2]', [_row(ten_2=1)]),
+    ('+ten[1..3]', [_row(ten_1=1, ten_2=1, ten_3=1)]),
+    ('+ten', [_row(ten_0=1, ten_1=1, ten_2=1, ten_3=1)]),
+    ('+ten[[1..2]]', [_row(ten_1=1), _row(ten_2=1)]),
+    ('+vis \\ +aud', [_row(vis_0=1), _row(aud_0=1)]),
+    ('+vis#0 -ten#3', [_row(vis_0=1, ten_3=-1)]),
+])
+def test_parse_sym(sym, rows):
+    np.testing.assert_array_equal(parse_sym(sym, COLUMNS), np.array(rows))
+
+
+@pytest.mark.parametrize('sym', ['+nope', '+ten[4]', '', '+vis * *'])
+def test_parse_sym_errors(sym):
+    with pytest.raises(ValueError):
+        parse_sym(sym, COLUMNS)
+
+
+def test_glt_matrix_matches_contrast_stats():
+    rng = np.random.RandomState(0)
+    nvox, ncol, dof = 50, len(COLUMNS), 100
+    X = rng.randn(dof + ncol, ncol)
+    xtxinv = np.linalg.inv(np.dot(X.T, X))
+    beta = rng.randn(nvox, ncol)
+    sigma2 = rng.rand(nvox) + 0.5
+    sigma2[0] = 0.0
+    syms = ['+vis -aud', '+ten[[0..2]]', '+vis \\ +aud', '+ten[[1..3]]', '+ten[1..3]']
+    labels = ['va', 'ten3', 'both', 'late', 'sum']
+    glts = GLTMatrix.from_sym(syms, labels, COLUMNS)
+    out, names = glts.bricks(beta, sigma2, xtxinv, dof, fout=True, rout=True)
+    assert len(glts) == len(syms)
+    assert out.shape == (nvox, len(names))
+
+    for label, sym in zip(labels, syms):
+        C = parse_sym(sym, COLUMNS)
+        est, t, F = contrast_stats(beta, sigma2, xtxinv, C)
+        q = C.shape[0]
+        for k in range(q):
+            np.testing.assert_allclose(out[:, names.index('%s_GLT#%d_Coef' % (label, k))],
+                                       est[:, k], rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(out[:, names.index('%s_GLT#%d_Tstat' % (label, k))],
+                                       t[:, k], rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(out[:, names.index('%s_GLT_Fstat' % label)],
+                                   F, rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(out[:, names.index('%s_GLT_R^2' % label)],
+                                   q * F / (q * F + dof), rtol=1e-4, atol=1e-6)
+
+
+def test_glt_matrix_layout():
+    glts = GLTMatrix.from_sym(['+vis', '+ten[[0..1]]'], ['a', 'b'], COLUMNS)
+    _, names = glts.bricks(np.zeros((1, len(COLUMNS))), np.ones(1), np.eye(len(COLUMNS)),
+                           10, fout=True, rout=True)
+    assert names == ['a_GLT#0_Coef', 'a_GLT#0_Tstat', 'a_GLT_R^2', 'a_GLT_Fstat',
+                     'b_GLT#0_Coef', 'b_GLT#0_Tstat', 'b_GLT#1_Coef', 'b_GLT#1_Tstat',
+                     'b_GLT_R^2', 'b_GLT_Fstat']
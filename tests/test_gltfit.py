@@ -0,0 +1,30 @@
+import numpy as np
+
+from afniio import load_bucket
+from gltfitv1 import GLTfit
+from remlfitv1 import REMLfit
+
+GLTS, LABELS = ['+aud -vis', '+aud \\ +vis'], ['diff', 'both']
+
+
+def test_gltfit_matches_glts_of_the_fit(dataset, tmpdir):
+    # the GLTs evaluated afterwards equal those computed during the fit
+    reml = REMLfit(in_file=dataset['runs'], matrix=dataset['xmat'], engine='numpy',
+                   glt=GLTS, labels=LABELS, fout=True, rout=True, tout=True,
+                   out_beta='Rbeta.nii.gz', out_var='Rvar.nii.gz')
+    out = reml.run(cwd=str(tmpdir.mkdir('reml'))).outputs
+    glt = GLTfit(beta_file=out.out_beta, var_file=out.out_var, matrix=dataset['xmat'],
+                 glt=GLTS, labels=LABELS, rout=True,
+                 out_file=str(tmpdir.join('glt.nii.gz'))).run().outputs
+    stats, stat_names, _, _ = load_bucket(out.out_file)
+    data, names, _, _ = load_bucket(glt.out_file)
+    assert names == ['diff_GLT#0_Coef', 'diff_GLT#0_Tstat', 'diff_GLT_R^2', 'diff_GLT_Fstat',
+                     'both_GLT#0_Coef', 'both_GLT#0_Tstat', 'both_GLT#1_Coef',
+                     'both_GLT#1_Tstat', 'both_GLT_R^2', 'both_GLT_Fstat']
+    for k, name in enumerate(names):
+        np.testing.assert_allclose(data[:, k], stats[:, stat_names.index(name)],
+                                   rtol=1e-4, atol=1e-4)
+    beta, beta_names, _, _ = load_bucket(out.out_beta)
+    cols = dataset['info']['ColumnLabels']
+    np.testing.assert_allclose(data[:, 0], beta[:, cols.index('aud#0')] - beta[:, cols.index('vis#0')],
+                               rtol=1e-4, atol=1e-4)
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from scipy import optimize, stats
+
+from afniio import load_bucket, save_bucket
+from betastore import BetaStore
+from groupengine import beta_variance, group_bricks, mema_one, ttest_one, ttest_two
+from grouptestv1 import GroupTest
+
+
+def test_ttests_match_scipy():
+    rng = np.random.RandomState(1)
+    ya = rng.randn(12, 40) + 0.5
+    yb = 2 * rng.randn(9, 40)
+    mean, t, dof = ttest_one(ya)
+    np.testing.assert_allclose(t, stats.ttest_1samp(ya, 0).statistic)
+    np.testing.assert_allclose(mean, ya.mean(axis=0))
+    assert dof == 11
+    for pooled in (True, False):
+        diff, t, dof = ttest_two(ya, yb, pooled=pooled)
+        np.testing.assert_allclose(t, stats.ttest_ind(ya, yb, equal_var=pooled).statistic)
+    # a paired test is the one-sample test of the differences
+    bricks, names = group_bricks(ya, ya - 1 + rng.randn(12, 40), test='paired')
+    assert names == ['SetA-SetB_mean', 'SetA-SetB_Tstat']
+
+
+def _reml_tau2(y, v):
+    def nll(tau2):
+        w = 1.0 / (v + tau2)
+        mu = np.sum(w * y) / np.sum(w)
+        return np.sum(np.log(v + tau2)) + np.log(np.sum(w)) + np.sum(w * (y - mu) ** 2)
+    return optimize.minimize_scalar(nll, bounds=(0, 100), method='bounded',
+                                    options={'xatol': 1e-10}).x
+
+
+def test_mema_matches_direct_reml():
+    rng = np.random.RandomState(2)
+    n, nvox = 15, 20
+    v = rng.uniform(0.2, 2.0, (n, nvox))
+    y = 1.0 + rng.randn(n, nvox) * np.sqrt(v + 0.8)
+    mu, t, tau2, dof = mema_one(y, v)
+    for j in range(nvox):
+        expected = _reml_tau2(y[:, j], v[:, j])
+        assert abs(tau2[j] - expected) < 1e-4 * max(1.0, expected)
+        w = 1.0 / (v[:, j] + tau2[j])
+        np.testing.assert_allclose(mu[j], np.sum(w * y[:, j]) / np.sum(w))
+        np.testing.assert_allclose(t[j], mu[j] * np.sqrt(np.sum(w)))
+
+
+def test_beta_variance():
+    np.testing.assert_allclose(beta_variance(np.array([2.0, 1.0]), np.array([4.0, 0.0])),
+                               [0.25, np.inf])
+
+
+def _store(tmpdir, mask):
+    rng = np.random.RandomState(3)
+    shape, affine = (3, 4, 2), np.eye(4)
+    nvox = int(np.prod(shape))
+    buckets, coefs = [], []
+    for s in range(6):
+        coef = rng.randn(nvox) + 1
+        tstat = coef / 0.5
+        fname = str(tmpdir.join('sub%d.nii.gz' % s))
+        save_bucket(fname, np.column_stack([coef, tstat]), shape, affine,
+                    ['aud#0_Coef', 'aud#0_Tstat'])
+        buckets.append(fname)
+        coefs.append(coef)
+    store = BetaStore.create(str(tmpdir.join('store')), buckets,
+                             ['s%d' % s for s in range(6)], mask=mask)
+    return store, np.array(coefs)
+
+
+def test_grouptest_chunks_match_engine(tmpdir):
+    mask = np.ones((3, 4, 2), dtype=bool)
+    mask[0] = False
+    store, coefs = _store(tmpdir, mask)
+    out = GroupTest(store=store.path, coef='aud#0_Coef', chunk_size=5,
+                    out_file=str(tmpdir.join('group.nii.gz'))).run().outputs.out_file
+    data, names, _, _ = load_bucket(out)
+    assert names == ['SetA_mean', 'SetA_Tstat']
+    expected, _ = group_bricks(coefs[:, mask.ravel()])
+    np.testing.assert_allclose(data[mask.ravel()], expected, rtol=1e-5)
+    assert not data[~mask.ravel()].any()
+
+
+def test_grouptest_empty_mask(tmpdir):
+    store, _ = _store(tmpdir, np.zeros((3, 4, 2), dtype=bool))
+    with pytest.raises(ValueError, match='no voxel'):
+        GroupTest(store=store.path, coef='aud#0_Coef',
+                  out_file=str(tmpdir.join('group.nii.gz'))).run()
@@ -0,0 +1,40 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import numpy as np
+import pytest
+
+from hrfbasis import model_ncols, regressors
+
+
+ONSETS = np.array([-30.0, -3.3, 10.2, 50.7, 180.0, 290.0, 320.0])
+DURATIONS = np.array([5.0, 12.0, 3.2, 20.0, 8.0, 30.0, 4.0])
+
+
+@pytest.mark.parametrize('model,tol', [
+    ('GAM', 1e-3), ('BLOCK(5,1)', 1e-3), ('dmBLOCK', 1e-3), ('dmBLOCK(1)', 1e-3),
+    ('SPMG2', 1e-3), ('SPMG3', 5e-3), ('CSPLIN(0,12,7)', 5e-3), ('TENT(0,12,7)', 2e-2),
+])
+@pytest.mark.parametrize('tr', [2.0, 1.37])
+def test_fft_matches_direct(model, tol, tr):
+    # onsets before the run and after its end included
+    direct = regressors(model, ONSETS, DURATIONS, 150, tr, 'direct')
+    fft = regressors(model, ONSETS, DURATIONS, 150, tr, 'fft')
+    assert direct.shape == fft.shape == (150, model_ncols(model))
+    assert np.abs(fft - direct).max() <= tol * np.abs(direct).max()
+
+
+def test_fft_exact_on_grid():
+    # onsets on the 0.1s grid convolve without interpolation
+    onsets = np.array([-4.0, 0.0, 12.2, 100.4])
+    direct = regressors('GAM', onsets, None, 100, 2.0, 'direct')
+    fft = regressors('GAM', onsets, None, 100, 2.0, 'fft')
+    np.testing.assert_allclose(fft, direct, atol=1e-10 * np.abs(direct).max())
+
+
+def test_no_events():
+    assert not regressors('SPMG2', [], None, 20, 2.0).any()
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        regressors('GAM', [1.0], None, 20, 2.0, 'auto')
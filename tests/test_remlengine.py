@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from remlengine import REMLEngine, arma11_corr, estimate_arma11
+
+
+def _arma11(rng, a, b, shape):
+    e = rng.randn(shape[0], shape[1] + 200)
+    x = np.zeros_like(e)
+    for t in range(1, e.shape[1]):
+        x[:, t] = a * x[:, t - 1] + e[:, t] + b * e[:, t - 1]
+    return x[:, 200:]
+
+
+@pytest.mark.parametrize('a, b', [(0.5, 0.2), (0.8, -0.4), (0.0, 0.3), (0.3, 0.0)])
+def test_arma11_corr_matches_ma_expansion(a, b):
+    # autocovariances of the MA(inf) form: psi_0 = 1, psi_j = (a + b) a^(j-1)
+    psi = np.concatenate([[1.0], (a + b) * a ** np.arange(400)])
+    gamma = np.array([np.dot(psi[:len(psi) - k], psi[k:]) for k in range(6)])
+    np.testing.assert_allclose(arma11_corr(a, b, 6)[0], gamma / gamma[0], atol=1e-12)
+
+
+def test_moment_estimate_recovers_parameters():
+    rng = np.random.RandomState(0)
+    res = _arma11(rng, 0.6, 0.2, (4, 20000))
+    a, b = estimate_arma11(res, [0, 10000])
+    np.testing.assert_allclose(a, 0.6, atol=0.05)
+    np.testing.assert_allclose(b, 0.2, atol=0.08)
+
+
+def _direct_reml(X, y, runs, a, b):
+    """GLS estimate and negative restricted log-likelihood with the full
+    block-diagonal correlation matrix"""
+    n, p = X.shape
+    R = np.zeros((n, n))
+    for r0, r1 in runs:
+        R[r0:r1, r0:r1] = arma11_corr(a, b, r1 - r0)
+    Ri = np.linalg.inv(R)
+    xtrx = X.T.dot(Ri).dot(X)
+    beta = np.linalg.solve(xtrx, X.T.dot(Ri).dot(y))
+    res = y - X.dot(beta)
+    sigma2 = res.dot(Ri).dot(res) / (n - p)
+    nll = 0.5 * ((n - p) * (np.log(2 * np.pi * sigma2) + 1)
+                 + np.linalg.slogdet(R)[1] + np.linalg.slogdet(xtrx)[1])
+    return beta, sigma2, nll
+
+
+def test_engine_matches_full_grid_search():
+    rng = np.random.RandomState(1)
+    nt = 60
+    X = np.column_stack([np.repeat([[1, 0], [0, 1]], nt // 2, axis=0),
+                         np.sin(np.arange(nt) / 3.0), rng.randn(nt)])
+    runs = [(0, nt // 2), (nt // 2, nt)]
+    Y = np.dot(rng.randn(6, 4), X.T) + np.hstack([_arma11(rng, 0.5, 0.1, (6, nt // 2)),
+                                                  _arma11(rng, 0.5, 0.1, (6, nt // 2))])
+    # a search reaching every grid point is a full grid search
+    engine = REMLEngine(X, run_starts=[0, nt // 2], grid=2, search=8)
+    out = engine.fit(Y)
+    for v in range(len(Y)):
+        fits = [(_direct_reml(X, Y[v], runs, a, b), a, b)
+                for a in engine.a_values for b in engine.b_values]
+        (beta, sigma2, nll), a, b = min(fits, key=lambda f: f[0][2])
+        assert (out['a'][v], out['b'][v]) == (a, b)
+        np.testing.assert_allclose(out['loglik'][v], nll, rtol=1e-8)
+        np.testing.assert_allclose(out['sigma2'][v], sigma2, rtol=1e-8)
+        np.testing.assert_allclose(out['beta'][v], beta, rtol=1e-5, atol=1e-5)
+
+
+def test_local_search_improves_on_start():
+    rng = np.random.RandomState(2)
+    nt = 80
+    X = np.column_stack([np.ones(nt), rng.randn(nt)])
+    Y = _arma11(rng, 0.7, -0.2, (20, nt)) + 3
+    start = REMLEngine(X, search=0).fit(Y)
+    local = REMLEngine(X, search=1).fit(Y)
+    assert np.all(local['loglik'] <= start['loglik'] + 1e-9)
@@ -0,0 +1,24 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from remlfitv1 import REMLfit
+
+
+def test_usetemp_auto_decided_once(dataset):
+    reml = REMLfit(in_file=dataset['runs'], matrix=dataset['xmat'], usetemp='auto',
+                   mem_gb=1e-6)
+    # building the command line reads no headers and decides nothing
+    assert '-usetemp' not in reml.cmdline
+    reml._decide_usetemp()
+    assert '-usetemp' in reml.cmdline
+
+    reml.inputs.mem_gb = 1000.0
+    reml._decide_usetemp()
+    assert '-usetemp' not in reml.cmdline
+
+
+def test_usetemp_explicit(dataset):
+    reml = REMLfit(in_file=dataset['runs'], matrix=dataset['xmat'], usetemp='yes')
+    assert '-usetemp' in reml.cmdline
+    reml.inputs.usetemp = 'no'
+    reml._decide_usetemp()
+    assert '-usetemp' not in reml.cmdline
@@ -0,0 +1,38 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from resources import estimate_mem_gb
+
+
+def _header_only(path, shape):
+    """A NIfTI file with the header of a dataset of the given shape and
+    no data; the estimate reads headers only"""
+    hdr = nb.Nifti1Header()
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(np.float32)
+    hdr['vox_offset'] = 352
+    with open(path, 'wb') as fp:
+        hdr.write_to(fp)
+    return str(path)
+
+
+@pytest.mark.parametrize('tool', ['3dDeconvolve', '3dREMLfit'])
+@pytest.mark.parametrize('threads', [1, 4, 16])
+def test_estimate_scales_with_data(tmpdir, tool, threads):
+    shape = (64, 64, 40, 1200)
+    fname = _header_only(tmpdir.join('big.nii'), shape)
+    nreg = 40
+    data = np.prod(shape) * 4.0 / 1024 ** 3
+    outputs = np.prod(shape[:3]) * (2 * nreg + 1) * 4.0 / 1024 ** 3
+    mem = estimate_mem_gb(fname, nregressors=nreg, tool=tool, num_threads=threads)
+    assert data + outputs < mem < 4 * (data + outputs) + 1
+
+
+def test_threads_add_workspace_only(tmpdir):
+    fname = _header_only(tmpdir.join('run.nii'), (10, 10, 10, 400))
+    one = estimate_mem_gb(fname, tool='3dREMLfit', num_threads=1)
+    many = estimate_mem_gb(fname, tool='3dREMLfit', num_threads=16)
+    assert 0 < many - one < 0.5
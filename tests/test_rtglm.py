@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from deconv1 import Decon
+from rtglm import RealtimeGLM, replay
+
+
+def _weighted_lstsq(X, Y, lam):
+    w = np.sqrt(lam ** np.arange(len(X) - 1, -1, -1))[:, None]
+    beta, sse = np.linalg.lstsq(X * w, Y * w, rcond=None)[:2]
+    return beta.T, sse
+
+
+@pytest.mark.parametrize('forgetting', [1.0, 0.97])
+def test_rls_matches_batch_lstsq(forgetting):
+    rng = np.random.RandomState(0)
+    nt, p = 90, 4
+    X = np.column_stack([np.ones(nt), np.linspace(-1, 1, nt), rng.randn(nt, p - 2)])
+    Y = rng.randn(nt, 30) + np.dot(X, rng.randn(p, 30))
+    glm = RealtimeGLM(X, forgetting=forgetting)
+    for k in range(nt):
+        glm.update(Y[k])
+        if k + 1 in (2, p, 20, 55, nt):
+            beta, sse = _weighted_lstsq(X[:k + 1], Y[:k + 1], forgetting)
+            np.testing.assert_allclose(glm.beta, beta, rtol=1e-7, atol=1e-9)
+            if glm.full_rank and k + 1 > p:
+                np.testing.assert_allclose(glm.sse, sse, rtol=1e-6)
+    with pytest.raises(ValueError):
+        glm.update(Y[0])
+
+
+def test_tstat_matches_batch_fit():
+    rng = np.random.RandomState(1)
+    X = np.column_stack([np.ones(50), rng.randn(50, 2)])
+    Y = rng.randn(50, 10)
+    glm = RealtimeGLM(X)
+    for y in Y:
+        glm.update(y)
+    beta, sse = _weighted_lstsq(X, Y, 1.0)
+    se = np.sqrt(sse[:, None] / 47 * np.diag(np.linalg.inv(np.dot(X.T, X)))[None, :])
+    np.testing.assert_allclose(glm.tstat(), beta / se, rtol=1e-6)
+
+
+def test_from_decon_replays_one_run(dataset):
+    decon = Decon(stim_files=dataset['stims'], models=dataset['models'],
+                  labels=dataset['labels'], polort=1)
+    glm = RealtimeGLM.from_decon(decon, [120, 120], dataset['tr'], run=1)
+    assert glm.columns == ['Run#2Pol#0', 'Run#2Pol#1', 'aud#0', 'vis#0']
+    for frame in replay(dataset['runs'][1]):
+        glm.update(frame)
+    X = dataset['X'][120:, [2, 3, 4, 5]]
+    Y = np.float32(dataset['Y'][:, 120:]).astype(np.float64)
+    np.testing.assert_allclose(glm.beta, np.linalg.lstsq(X, Y.T, rcond=None)[0].T,
+                               rtol=1e-6, atol=1e-6)
@@ -0,0 +1,69 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from nipype.interfaces.base import Bunch
+
+from runprofile import RunProfile, parse_phases
+from toolmonitor import run_monitored
+
+needs_wait4 = pytest.mark.skipif(not hasattr(os, 'wait4'), reason='no os.wait4')
+
+
+def _tool(mb):
+    """Command line of a process that holds about mb MB"""
+    return ('%s -c "import numpy; a = numpy.ones(%d * 131072); print(a.sum())"'
+            % (sys.executable, mb))
+
+
+def _run(profile, cmdline, tmpdir):
+    runtime = Bunch(cmdline=cmdline, environ=dict(os.environ), cwd=str(tmpdir))
+    runtime = run_monitored(runtime)
+    profile.add_child(runtime.rusage)
+    return runtime
+
+
+@needs_wait4
+def test_child_peak_is_per_run(tmpdir):
+    # a large run first, then a small one in the same process: the second
+    # profile must not report the first run's peak
+    with RunProfile('tool') as big:
+        assert _run(big, _tool(400), tmpdir).returncode == 0
+    with RunProfile('tool') as small:
+        assert _run(small, _tool(50), tmpdir).returncode == 0
+    assert big.record['subprocess_peak_rss_mb'] > 350
+    assert 40 < small.record['subprocess_peak_rss_mb'] < 200
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/clear_refs'), reason='Linux only')
+def test_self_peak_is_per_run():
+    with RunProfile('numpy') as big:
+        a = np.ones(400 * 131072)
+        a += 1
+        del a
+    with RunProfile('numpy') as small:
+        a = np.ones(10 * 131072)
+        del a
+    assert big.record['peak_rss_mb'] > 400
+    assert small.record['peak_rss_mb'] < big.record['peak_rss_mb'] - 300
+    assert small.record['subprocess_peak_rss_mb'] is None
+
+
+def test_exit_code_and_output(tmpdir):
+    with RunProfile('tool') as prof:
+        runtime = _run(prof, 'echo hello; exit 3', tmpdir)
+    assert runtime.returncode == 3
+    assert runtime.stdout == 'hello'
+
+
+def test_parse_phases():
+    out = '\n'.join(['++ Calculations starting; elapsed time=1.5',
+                     '++ voxel loop done; elapsed time=10.0',
+                     '++ Wrote bucket; elapsed time=12.0'])
+    phases = parse_phases(out)
+    assert phases['matrix_setup'] == 1.5
+    assert phases['fitting'] == pytest.approx(8.5)
+    assert phases['output'] == pytest.approx(2.0)
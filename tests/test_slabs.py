@@ -0,0 +1,55 @@
+import nibabel as nb
+import numpy as np
+import pytest
+
+from deconv1 import Decon
+from remlfitv1 import REMLfit
+from slabs import slab_bounds
+
+
+@pytest.mark.parametrize('nz, num_slabs', [(6, 3), (7, 3), (5, 8), (40, 6), (1, 1)])
+def test_slab_bounds_cover_volume(nz, num_slabs):
+    bounds = slab_bounds(nz, num_slabs)
+    assert bounds[0][0] == 0 and bounds[-1][1] == nz
+    assert all(b0[1] == b1[0] for b0, b1 in zip(bounds[:-1], bounds[1:]))
+    sizes = [b - a for a, b in bounds]
+    assert len(bounds) == min(num_slabs, nz) and max(sizes) - min(sizes) <= 1
+
+
+def _mask(dataset, tmpdir):
+    mask = np.ones(dataset['shape'], dtype=np.uint8)
+    mask[0, 0] = 0
+    fname = str(tmpdir.join('mask.nii.gz'))
+    nb.save(nb.Nifti1Image(mask, np.eye(4)), fname)
+    return fname
+
+
+def _compare(single, slabbed):
+    a, b = nb.load(single), nb.load(slabbed)
+    assert a.shape == b.shape
+    np.testing.assert_allclose(b.get_fdata(), a.get_fdata(), rtol=1e-5, atol=1e-5)
+
+
+def test_decon_slabs_match_single_run(dataset, tmpdir):
+    def run(name, **kwargs):
+        return Decon(in_file=dataset['runs'], stim_files=dataset['stims'], num_stimts=2,
+                     models=dataset['models'], labels=dataset['labels'], polort=1,
+                     xmat_builder='python', engine='numpy', fout=True, tout=True,
+                     mask=_mask(dataset, tmpdir), **kwargs).run(cwd=str(tmpdir.mkdir(name)))
+
+    single = run('single').outputs
+    slabbed = run('slabbed', slab_workers=2, num_slabs=4).outputs
+    _compare(single.out_file, slabbed.out_file)
+    np.testing.assert_array_equal(np.loadtxt(slabbed.out_xmat), np.loadtxt(single.out_xmat))
+
+
+def test_remlfit_slabs_match_single_run(dataset, tmpdir):
+    def run(name, **kwargs):
+        return REMLfit(in_file=dataset['runs'], matrix=dataset['xmat'], engine='numpy',
+                       tout=True, fout=True, mask=_mask(dataset, tmpdir),
+                       **kwargs).run(cwd=str(tmpdir.mkdir(name)))
+
+    single = run('single').outputs
+    slabbed = run('slabbed', slab_workers=2, num_slabs=3).outputs
+    _compare(single.out_file, slabbed.out_file)
+    _compare(single.out_var, slabbed.out_var)
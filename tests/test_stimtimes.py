@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+import stimtimes
+from stimtimes import parse_stim_file, read_stim_times, stim_runs
+
+
+def _write(tmpdir, name, text):
+    fname = str(tmpdir.join(name))
+    with open(fname, 'w') as fp:
+        fp.write(text)
+    return fname
+
+
+def _reference(line):
+    """Events of a line parsed token by token"""
+    onsets, durs, amps = [], [], []
+    for tok in line.split():
+        if tok == '*':
+            continue
+        tok, _, dur = tok.partition(':')
+        tok, _, amp = tok.partition('*')
+        onsets.append(float(tok))
+        durs.append(float(dur) if dur else np.nan)
+        amps.append([float(a) for a in amp.split(',')] if amp else [])
+    return onsets, durs, amps
+
+
+@pytest.mark.parametrize('line', [
+    '10 20.5 33',
+    '1e1 .5 +3 -2',
+    '10:5 20:2.5 30:1',
+    '10*2 20*3.5 30*-1',
+    '10*2,1:4 20*3,0.5:6',
+    '10 * 20',
+])
+def test_lines_match_token_parser(tmpdir, line):
+    run, = parse_stim_file(_write(tmpdir, 'stim.1D', line + '\n'))
+    onsets, durs, amps = _reference(line)
+    np.testing.assert_array_equal(run.onsets, onsets)
+    np.testing.assert_array_equal(run.durations, durs)
+    if any(amps):
+        np.testing.assert_array_equal(run.amplitudes, amps)
+    else:
+        assert run.amplitudes.size == 0
+
+
+def test_runs_comments_and_empty_runs(tmpdir):
+    fname = _write(tmpdir, 'stim.1D', '# header\n10 20  # first run\n\n*\n5\n')
+    runs = read_stim_times(fname, run_lengths=[50, 50, 50], tr=2.0)
+    assert [list(onsets) for onsets, _ in runs] == [[10, 20], [], [5]]
+    with pytest.raises(ValueError):
+        read_stim_times(fname, run_lengths=[50, 50], tr=2.0)
+
+
+def test_global_times_split_by_run(tmpdir):
+    fname = _write(tmpdir, 'global.1D', '5 99.9 100 150.5 230\n')
+    runs = stim_runs(fname, 'global', run_lengths=[50, 40, 30], tr=2.0)
+    assert [list(r.onsets) for r in runs] == [[5, 99.9], [0, 50.5], [50]]
+
+
+def test_bad_lines_raise(tmpdir):
+    for text in ['10 abc\n', '10*1 20*1,2\n', '10:3 20 30*1:2\n']:
+        with pytest.raises(ValueError):
+            parse_stim_file(_write(tmpdir, 'bad.1D', text))
+
+
+def test_cache_is_keyed_by_content(tmpdir):
+    a = _write(tmpdir, 'a.1D', '10 20\n')
+    b = _write(tmpdir, 'b.1D', '10 20\n')
+    assert parse_stim_file(a) is parse_stim_file(b)
+    _write(tmpdir, 'a.1D', '10 30\n')
+    assert list(parse_stim_file(a)[0].onsets) == [10, 30]
+    assert len(stimtimes._CACHE) <= stimtimes._CACHE_SIZE
+    with pytest.raises(ValueError):
+        parse_stim_file(a)[0].onsets[0] = 1
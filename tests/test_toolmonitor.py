@@ -0,0 +1,46 @@
+import os
+import time
+
+from nipype.interfaces.base import Bunch
+
+from toolmonitor import WarningMonitor, run_monitored
+
+OUTPUT = """++ 3dDeconvolve: AFNI version=AFNI_23.0.00
+++ ----- Signal+Baseline matrix condition [X] (240x6):  4.2 ++ VERY GOOD ++
+*+ WARNING: !! in Signal+Baseline matrix:
+ * Largest singular value=2.1
+*+ WARNING: -------------------------------------------------
+*+ WARNING: Smallest FDR q [2 aud#0_Tstat] = 0.001
+** WARNING: Regression matrix column 3 is all zero""".splitlines()
+
+
+def test_warning_lines_are_classified():
+    monitor = WarningMonitor()
+    for line in OUTPUT:
+        assert monitor.feed(line) is None
+    summary = monitor.summary()
+    assert summary['condition'] == {'X': 4.2}
+    assert len(summary['warnings']) == 4
+    assert summary['num_matrix_warnings'] == 2
+
+
+def test_limits_set_the_abort_reason():
+    monitor = WarningMonitor(max_warnings=1)
+    reasons = [monitor.feed(line) for line in OUTPUT]
+    assert reasons[-1] == '2 matrix warnings (limit 1)'
+    monitor = WarningMonitor(max_condition=3)
+    assert 'condition number of matrix [X]' in monitor.feed(OUTPUT[1])
+    monitor = WarningMonitor()
+    assert monitor.feed("** FATAL ERROR: can't open file").startswith('fatal message')
+
+
+def test_abort_kills_the_command(tmpdir):
+    runtime = Bunch(cmdline='echo "** ERROR: bad input"; sleep 30; echo never',
+                    environ=dict(os.environ), cwd=str(tmpdir))
+    monitor = WarningMonitor()
+    start = time.time()
+    run_monitored(runtime, monitor)
+    assert time.time() - start < 10
+    assert monitor.abort_reason.startswith('fatal message')
+    assert runtime.returncode < 0
+    assert 'never' not in runtime.stdout
@@ -0,0 +1,34 @@
+import numpy as np
+
+from afniio import load_bucket
+from remlfitv1 import REMLfit
+from workflows import create_decon_reml_wf
+
+
+def test_decon_reml_wf_matches_remlfit_on_the_matrix(dataset, tmpdir):
+    wf = create_decon_reml_wf(engine='numpy', xmat_builder='python')
+    wf.base_dir = str(tmpdir.join('work'))
+    wf.inputs.inputnode.in_file = dataset['runs']
+    wf.inputs.inputnode.stim_files = dataset['stims']
+    wf.inputs.inputnode.models = dataset['models']
+    wf.inputs.inputnode.labels = dataset['labels']
+    wf.inputs.inputnode.num_stimts = 2
+    wf.inputs.inputnode.polort = 1
+    wf.inputs.inputnode.glt = ['+aud -vis']
+    wf.inputs.inputnode.glt_labels = ['diff']
+    wf.inputs.inputnode.tout = True
+    wf.inputs.inputnode.fout = True
+    wf.inputs.inputnode.rout = False
+    result = wf.run()
+    outputs = dict((n.name, n.result.outputs) for n in result.nodes())
+    reml = outputs['remlfit']
+
+    # the matrix of the design-only Decon is the one REMLfit fitted
+    np.testing.assert_allclose(np.loadtxt(outputs['design'].out_xmat), dataset['X'], atol=1e-4)
+    expected = REMLfit(in_file=dataset['runs'], matrix=dataset['xmat'], engine='numpy',
+                       glt=['+aud -vis'], labels=['diff'], tout=True, fout=True,
+                       ).run(cwd=str(tmpdir.mkdir('direct'))).outputs
+    data, names, _, _ = load_bucket(reml.out_file)
+    ref, ref_names, _, _ = load_bucket(expected.out_file)
+    assert names == ref_names
+    np.testing.assert_allclose(data, ref, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,49 @@
+import os
+import shutil
+
+from deconv1 import Decon
+from xmatcache import XmatCache, design_key
+
+
+def test_design_key_hashes_content(dataset, tmpdir):
+    stims = dataset['stims']
+    copy = str(tmpdir.join('copy.1D'))
+    shutil.copyfile(stims[0], copy)
+    args = (['GAM', 'GAM'], ['a', 'b'], [120, 120], 2.0)
+    key = design_key(stims, *args)
+    assert design_key([copy, stims[1]], *args) == key
+    assert design_key(stims[::-1], *args) != key
+    assert design_key(stims, ['GAM', 'BLOCK(5,1)'], ['a', 'b'], [120, 120], 2.0) != key
+    assert design_key(stims, *args, polort=2) != key
+    assert design_key(stims, ['GAM', 'GAM'], ['a', 'b'], [120, 120], 2.5) != key
+
+
+def test_cache_get_put_and_evict(tmpdir):
+    cache = XmatCache(str(tmpdir.join('cache')), max_entries=2)
+    src = tmpdir.join('X.xmat.1D')
+    dest = str(tmpdir.join('out.xmat.1D'))
+    assert not cache.get('a', dest)
+    for k, key in enumerate('abc'):
+        src.write('# %s\n1 2\n' % key)
+        cache.put(key, str(src))
+        # distinct mtimes, oldest first
+        os.utime(cache._path(key), (k, k))
+    assert len(cache) == 2
+    assert not cache.get('a', dest)
+    assert cache.get('b', dest) and open(dest).read() == '# b\n1 2\n'
+
+
+def test_decon_uses_cached_matrix(dataset, tmpdir):
+    def run(name):
+        return Decon(in_file=dataset['runs'], stim_files=dataset['stims'], num_stimts=2,
+                     models=dataset['models'], labels=dataset['labels'], polort=1,
+                     xmat_builder='python', stop=True,
+                     xmat_cache=str(tmpdir.join('cache'))).run(cwd=str(tmpdir.mkdir(name)))
+
+    first = run('first').outputs.out_xmat
+    cached = os.listdir(str(tmpdir.join('cache')))
+    assert len(cached) == 1
+    with open(str(tmpdir.join('cache', cached[0])), 'a') as fp:
+        fp.write('# from the cache\n')
+    second = run('second').outputs.out_xmat
+    assert open(second).read() == open(first).read() + '# from the cache\n'
@@ -0,0 +1,162 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import object
+
+import os
+import re
+import signal
+import subprocess
+import threading
+
+from queue import Queue, Empty
+
+
+_WARNING = re.compile(r'^\s*(\*\*|\*\+)\s*WARNING')
+# warnings about the design matrix, the ones -GOFORIT lets through
+_MATRIX = re.compile(r'[Mm]atrix|[Cc]ondition|[Cc]ollinear|all zero|[Dd]uplicate'
+                     r'|BEWARE|TERRIBLE|BAD')
+_CONDITION = re.compile(r'[Mm]atrix condition \[(\w+)\][^:]*:\s*([\d.eE+-]+)')
+
+FATAL_PATTERNS = (
+    r'^\s*\*\* ?(FATAL )?ERROR',
+    r"[Cc]an'?t continue",
+    r'[Ss]ingular matrix',
+)
+
+
+class WarningMonitor(object):
+    """Parse AFNI warnings from tool output while the tool runs
+
+    Every line goes through ``feed``. Warning lines are recorded, and
+    the ones about the design matrix are counted; the run should be
+    aborted when that count exceeds ``max_warnings``, when a reported
+    matrix condition number exceeds ``max_condition``, or when a line
+    matches one of the ``fatal`` patterns. ``abort_reason`` is then set.
+    """
+
+    def __init__(self, max_warnings=None, max_condition=None, fatal=FATAL_PATTERNS):
+        self.max_warnings = max_warnings
+        self.max_condition = max_condition
+        self.fatal = [re.compile(p) for p in fatal]
+        self.warnings = []
+        self.num_matrix_warnings = 0
+        self.condition = {}
+        self.abort_reason = None
+
+    def feed(self, line, stream='stdout'):
+        """Parse one output line; returns the abort reason, if any"""
+        m = _CONDITION.search(line)
+        if m:
+            try:
+                value = float(m.group(2))
+            except ValueError:
+                value = None
+            if value is not None:
+                self.condition[m.group(1)] = value
+                if self.max_condition is not None and value > self.max_condition:
+                    self._abort('condition number of matrix [%s] is %g (limit %g)'
+                                % (m.group(1), value, self.max_condition))
+
+        if _WARNING.search(line):
+            matrix = bool(_MATRIX.search(line))
+            self.warnings.append({'line': line.strip(), 'stream': stream, 'matrix': matrix})
+            if matrix:
+                self.num_matrix_warnings += 1
+                if self.max_warnings is not None \
+                        and self.num_matrix_warnings > self.max_warnings:
+                    self._abort('%d matrix warnings (limit %d)'
+                                % (self.num_matrix_warnings, self.max_warnings))
+
+        for pattern in self.fatal:
+            if pattern.search(line):
+                self._abort('fatal message: %s' % line.strip())
+                break
+        return self.abort_reason
+
+    def _abort(self, reason):
+        if self.abort_reason is None:
+            self.abort_reason = reason
+
+    def summary(self):
+        return {
+            'warnings': [w['line'] for w in self.warnings],
+            'num_matrix_warnings': self.num_matrix_warnings,
+            'condition': dict(self.condition),
+            'abort_reason': self.abort_reason,
+        }
+
+
+def _reader(stream, name, queue):
+    for line in iter(stream.readline, b''):
+        queue.put((name, line.decode('utf-8', 'replace').rstrip('\n')))
+    stream.close()
+    queue.put((name, None))
+
+
+def kill_process(proc):
+    """Kill a shell command started in its own session, with the AFNI
+    tool it started (they share a process group)"""
+    if os.name != 'nt':
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+            return
+        except OSError:
+            pass
+    proc.kill()
+
+
+def _wait(proc):
+    """Reap proc; returns its exit code and, where os.wait4 exists, the
+    resource usage of that process alone"""
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), None
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except OSError:  # already reaped
+        return proc.wait(), None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, usage
+
+
+def run_monitored(runtime, monitor=None):
+    """Run runtime.cmdline as nipype's run_command does, feeding every
+    output line to monitor (if any) and killing the process on an abort
+
+    Fills runtime.stdout, stderr, merged, returncode and rusage (the
+    resource usage of the command, or None where os.wait4 is missing).
+    """
+    env = dict((str(k), str(v)) for k, v in runtime.environ.items())
+    proc = subprocess.Popen(runtime.cmdline, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, shell=True, cwd=runtime.cwd,
+                            env=env, close_fds=(os.name != 'nt'),
+                            start_new_session=(os.name != 'nt'))
+    queue = Queue()
+    for stream, name in ((proc.stdout, 'stdout'), (proc.stderr, 'stderr')):
+        thread = threading.Thread(target=_reader, args=(stream, name, queue))
+        thread.daemon = True
+        thread.start()
+
+    lines = {'stdout': [], 'stderr': []}
+    merged = []
+    open_streams = 2
+    while open_streams:
+        try:
+            name, line = queue.get(timeout=0.1)
+        except Empty:
+            continue
+        if line is None:
+            open_streams -= 1
+            continue
+        lines[name].append(line)
+        merged.append(line)
+        if monitor is not None and monitor.abort_reason is None \
+                and monitor.feed(line, name):
+            kill_process(proc)
+
+    runtime.returncode, runtime.rusage = _wait(proc)
+    runtime.stdout = '\n'.join(lines['stdout'])
+    runtime.stderr = '\n'.join(lines['stderr'])
+    runtime.merged = '\n'.join(merged)
+    return runtime
@@ -0,0 +1,64 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+from nipype.pipeline import engine as pe
+from nipype.interfaces import utility as niu
+
+from deconv1 import Decon
+from remlfitv1 import REMLfit
+from resources import DeconRamEstimator
+
+
+def create_decon_reml_wf(name='decon_reml', num_threads=1, engine='afni',
+                         xmat_builder='afni'):
+    """First-level REML fit without the OLS pass
+
+    Decon only builds the design matrix (``stop=True``, i.e. -x1D_stop)
+    and its out_xmat goes straight to REMLfit's -matrix, instead of
+    running a full 3dDeconvolve fit just to get the matrix.
+
+    Inputs (inputnode): in_file, stim_files, models, labels, num_stimts,
+    timing, polort, ortvec, mask, glt, glt_labels, and the tout, fout,
+    rout flags of the REML bucket.
+    Outputs (outputnode): out_xmat, out_file (Rbuck), out_var, out_beta.
+    """
+    wf = pe.Workflow(name=name)
+
+    inputnode = pe.Node(niu.IdentityInterface(fields=[
+        'in_file', 'stim_files', 'models', 'labels', 'num_stimts', 'timing', 'polort',
+        'ortvec', 'mask', 'glt', 'glt_labels', 'tout', 'fout', 'rout']),
+        name='inputnode')
+    inputnode.inputs.timing = 'local'
+    inputnode.inputs.polort = 'A'
+
+    design = pe.Node(Decon(stop=True, xmat_builder=xmat_builder), name='design')
+
+    reml = pe.Node(REMLfit(engine=engine, num_threads=num_threads), name='remlfit',
+                   n_procs=num_threads)
+    reml.ram_estimator = DeconRamEstimator(tool='3dREMLfit')
+
+    outputnode = pe.Node(niu.IdentityInterface(fields=[
+        'out_xmat', 'out_file', 'out_var', 'out_beta']), name='outputnode')
+
+    wf.connect([
+        (inputnode, design, [('in_file', 'in_file'),
+                             ('stim_files', 'stim_files'),
+                             ('models', 'models'),
+                             ('labels', 'labels'),
+                             ('num_stimts', 'num_stimts'),
+                             ('timing', 'timing'),
+                             ('polort', 'polort'),
+                             ('ortvec', 'ortvec')]),
+        (inputnode, reml, [('in_file', 'in_file'),
+                           ('mask', 'mask'),
+                           ('glt', 'glt'),
+                           ('glt_labels', 'labels'),
+                           ('tout', 'tout'),
+                           ('fout', 'fout'),
+                           ('rout', 'rout')]),
+        (design, reml, [('out_xmat', 'matrix')]),
+        (design, outputnode, [('out_xmat', 'out_xmat')]),
+        (reml, outputnode, [('out_file', 'out_file'),
+                            ('out_var', 'out_var'),
+                            ('out_beta', 'out_beta')]),
+    ])
+    return wf
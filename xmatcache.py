@@ -0,0 +1,115 @@
+from __future__ import print_function, division, unicode_literals, absolute_import
+from builtins import str
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+def file_digest(fname, blocksize=1 << 20):
+    """sha256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def design_key(stim_files, models, labels, run_lengths, tr, polort='A',
+               timing='local', ortvec=None, builder='python', convolution='direct'):
+    """Content hash identifying a design matrix
+
+    Timing files (and the ortvec file) are hashed by content, so the
+    same paradigm stored under different paths maps to the same key.
+    """
+    spec = {
+        'stim_times': [file_digest(f) for f in stim_files],
+        'models': list(models),
+        'labels': list(labels),
+        'polort': str(polort),
+        'timing': timing,
+        'run_lengths': [int(n) for n in run_lengths],
+        'tr': round(float(tr), 6),
+        'ortvec': file_digest(ortvec) if ortvec else None,
+        'builder': builder,
+        'convolution': convolution,
+    }
+    blob = json.dumps(spec, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(blob).hexdigest()
+
+
+class XmatCache(object):
+    """Directory of .xmat.1D files addressed by design_key
+
+    Entries are written to a temporary file and renamed into place, and
+    a hit refreshes the entry's mtime, which is what eviction orders on.
+    Both are atomic on a local or NFS file system, so several nipype
+    workers can share one cache directory without locking. When more
+    than ``max_entries`` files are present, the least recently used ones
+    are removed.
+    """
+
+    suffix = '.xmat.1D'
+
+    def __init__(self, cache_dir, max_entries=1000):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_entries = max_entries
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key, dest):
+        """Copy the cached matrix to dest. Returns False on a miss"""
+        path = self._path(key)
+        try:
+            os.utime(path, None)
+            shutil.copyfile(path, dest)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    def put(self, key, src):
+        """Store a copy of src under key and evict old entries"""
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp)
+            os.rename(tmp, self._path(key))
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                # removed by another worker
+                continue
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len([n for n in os.listdir(self.cache_dir) if n.endswith(self.suffix)])